@@ -6,6 +6,9 @@ from dotenv import load_dotenv
 import os
 from typing import Optional
 from datetime import timedelta
+from fastapi.concurrency import run_in_threadpool
+from auth.email_index import EmailIndex
+from auth.jwt_verifier import TokenVerifier, InvalidToken, KeyUnavailable, user_from_claims
 
 load_dotenv()
 
@@ -25,6 +28,42 @@ supabase: Client = create_client(supabase_url, supabase_key)
 supabase_service: Client = create_client(
     supabase_url, supabase_service_key)
 
+# Registered emails, so check-email doesn't list every user per request
+email_index = EmailIndex(supabase_service.auth.admin.list_users)
+
+# Local access-token verification (JWT secret and/or the project's JWKS)
+token_verifier = TokenVerifier(supabase_url, os.environ.get("SUPABASE_JWT_SECRET"))
+
+
+async def verify_access_token(token: str, full_profile: bool = False):
+    """
+    User dict for a valid access token, raising HTTPException(401) otherwise.
+    Checked locally; Supabase is only asked when no local key can verify
+    the token's signature, or once per token for `full_profile` (fields
+    such as created_at and identities that the token doesn't carry). What
+    Supabase returns is remembered until the token expires.
+    """
+    user = token_verifier.cached_user(token)
+    if user is not None:
+        return user
+
+    try:
+        claims = token_verifier.verify(token)
+        if not full_profile:
+            return user_from_claims(claims)
+    except InvalidToken:
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+    except KeyUnavailable:
+        pass
+
+    try:
+        user_response = await run_in_threadpool(supabase.auth.get_user, token)
+        user = user_response.user.model_dump()
+    except Exception:
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+    token_verifier.remember_user(token, user)
+    return user
+
 
 class LoginRequest(BaseModel):
     email: str
@@ -50,9 +89,7 @@ class EmailCheckResponse(BaseModel):
 @router.post("/check-email", response_model=EmailCheckResponse)
 async def check_email(request: EmailRequest):
     try:
-        # List all users and check if email exists
-        response = supabase_service.auth.admin.list_users()
-        email_exists = any(user.email == request.email for user in response)
+        email_exists = await run_in_threadpool(email_index.contains, request.email)
 
         if email_exists:
             return {
@@ -83,6 +120,7 @@ async def login(request: LoginRequest):
             "email": request.email,
             "password": request.password
         })
+        email_index.add(request.email)
         return {
             "message": "Signup successful. Please check your email to confirm your account."
         }
@@ -168,13 +206,9 @@ async def get_current_user(request: Request):
 
     token = auth_header.split(" ")[1]
 
-    try:
-        # Get user from token
-        user_response = supabase.auth.get_user(token)
-        # Return a structured response that matches what the frontend expects
-        return {
-            "user": user_response.user.model_dump(),
-            "message": "User authenticated"
-        }
-    except Exception as e:
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
+    user = await verify_access_token(token, full_profile=True)
+    # Return a structured response that matches what the frontend expects
+    return {
+        "user": user,
+        "message": "User authenticated"
+    }
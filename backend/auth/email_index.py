@@ -0,0 +1,126 @@
+import os
+import threading
+import time
+
+from metrics import log_event
+
+EMAIL_INDEX_REFRESH_SECONDS = int(os.getenv("EMAIL_INDEX_REFRESH_SECONDS", "300"))
+# Floor between two refreshes, however many lookups find the index stale
+EMAIL_INDEX_MIN_REFRESH_SECONDS = int(os.getenv("EMAIL_INDEX_MIN_REFRESH_SECONDS", "15"))
+EMAIL_INDEX_PAGE_SIZE = 1000
+
+
+def normalize_email(email: str):
+    return email.strip().lower()
+
+
+class EmailIndex:
+    """
+    In-memory hash set of registered emails, so an existence check is one
+    set lookup instead of listing every auth user.
+
+    The set is built by paging through the admin user list. Once loaded,
+    misses are answered from the index like hits, and a stale index keeps
+    answering while a background thread rebuilds it, so lookups never turn
+    into admin API traffic. Rebuilds are rate-limited to one per
+    `min_refresh_interval`. Signups through this API are added
+    immediately; a user created elsewhere is picked up by the next
+    periodic rebuild.
+    """
+
+    def __init__(self, list_users, refresh_interval: float = EMAIL_INDEX_REFRESH_SECONDS,
+                 min_refresh_interval: float = EMAIL_INDEX_MIN_REFRESH_SECONDS,
+                 page_size: int = EMAIL_INDEX_PAGE_SIZE):
+        # list_users(page, per_page) -> list of users with an `email` attribute
+        self._list_users = list_users
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self.page_size = page_size
+        self._emails = frozenset()
+        self._added = set()
+        self._loaded_at = None
+        self._last_attempt = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "refreshes": 0, "refresh_errors": 0}
+
+    def _build(self):
+        emails = set()
+        page = 1
+        while True:
+            users = self._list_users(page=page, per_page=self.page_size)
+            emails.update(normalize_email(user.email) for user in users if user.email)
+            if len(users) < self.page_size:
+                break
+            page += 1
+        return frozenset(emails)
+
+    def refresh(self):
+        started = time.time()
+        try:
+            emails = self._build()
+        except Exception as e:
+            with self._lock:
+                self.stats["refresh_errors"] += 1
+            log_event("email_index_refresh_failed", error=repr(str(e)))
+            raise
+        with self._lock:
+            # Keep signups recorded while the listing was in flight
+            self._emails = emails | self._added
+            self._added = set()
+            self._loaded_at = started
+            self.stats["refreshes"] += 1
+
+    def _ensure_loaded(self):
+        if self._loaded_at is not None:
+            return
+        with self._load_lock:
+            if self._loaded_at is None:
+                with self._lock:
+                    self._last_attempt = time.time()
+                self.refresh()
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception:
+            pass
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _schedule_refresh(self):
+        now = time.time()
+        with self._lock:
+            if self._refreshing or now - self._last_attempt < self.min_refresh_interval:
+                return
+            self._refreshing = True
+            self._last_attempt = now
+        threading.Thread(target=self._refresh_in_background, daemon=True).start()
+
+    def contains(self, email: str):
+        """
+        Whether `email` is registered. Blocks only for the very first load.
+        """
+        self._ensure_loaded()
+        email = normalize_email(email)
+        with self._lock:
+            found = email in self._emails or email in self._added
+            stale = time.time() - self._loaded_at > self.refresh_interval
+            self.stats["hits" if found else "misses"] += 1
+        if stale:
+            self._schedule_refresh()
+        return found
+
+    def add(self, email: str):
+        with self._lock:
+            self._added.add(normalize_email(email))
+
+    def info(self):
+        with self._lock:
+            return {
+                **self.stats,
+                "size": len(self._emails) + len(self._added),
+                "age_seconds": None if self._loaded_at is None else time.time() - self._loaded_at,
+            }
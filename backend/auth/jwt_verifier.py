@@ -0,0 +1,237 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+import httpx
+import jwt
+
+from metrics import log_event
+
+SUPABASE_JWT_AUDIENCE = os.getenv("SUPABASE_JWT_AUDIENCE", "authenticated")
+JWKS_REFRESH_SECONDS = int(os.getenv("JWKS_REFRESH_SECONDS", "600"))
+# An unknown key id triggers at most one JWKS fetch per this many seconds
+JWKS_MIN_REFRESH_SECONDS = int(os.getenv("JWKS_MIN_REFRESH_SECONDS", "30"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "1024"))
+JWT_LEEWAY_SECONDS = 30
+
+_SYMMETRIC_ALGORITHMS = {"HS256", "HS384", "HS512"}
+_ASYMMETRIC_ALGORITHMS = {"RS256", "RS384", "RS512", "ES256", "ES384", "PS256", "EdDSA"}
+
+
+class InvalidToken(Exception):
+    pass
+
+
+class KeyUnavailable(Exception):
+    """
+    The token may be valid but no local key can check it (no JWT secret
+    configured and its key id isn't in the JWKS); callers can fall back to
+    asking Supabase.
+    """
+
+
+class TokenVerifier:
+    """
+    Verifies Supabase access tokens locally.
+
+    HS* tokens are checked against the project's JWT secret, asymmetric ones
+    against the project's JWKS, which a background thread keeps refreshed
+    (a token naming an unknown key also triggers a rate-limited refresh,
+    off the request path). Expiry and audience are always validated. Recently
+    verified tokens are kept in a small LRU until they expire, so repeat
+    checks are a dictionary lookup. Users that Supabase returned for a token
+    (the fallback when no local key applies, and the full profile behind
+    /me) are kept the same way.
+    """
+
+    def __init__(self, supabase_url: str, jwt_secret: str = None, audience: str = SUPABASE_JWT_AUDIENCE,
+                 refresh_interval: float = JWKS_REFRESH_SECONDS, cache_size: int = TOKEN_CACHE_SIZE):
+        self.jwks_url = f"{(supabase_url or '').rstrip('/')}/auth/v1/.well-known/jwks.json"
+        self.jwt_secret = jwt_secret
+        self.audience = audience
+        self.refresh_interval = refresh_interval
+        self.cache_size = cache_size
+        self._keys = {}
+        self._keys_fetched_at = 0.0
+        self._last_refresh_request = 0.0
+        self._keys_lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._users = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._refresher = None
+        self._stopped = threading.Event()
+        self.stats = {"cache_hits": 0, "user_cache_hits": 0, "verified": 0, "rejected": 0, "jwks_refreshes": 0}
+
+    def refresh_keys(self):
+        response = httpx.get(self.jwks_url, timeout=10)
+        response.raise_for_status()
+        keys = {}
+        for jwk in response.json().get("keys", []):
+            try:
+                key = jwt.PyJWK(jwk)
+            except jwt.PyJWTError:
+                continue
+            keys[jwk.get("kid")] = key
+        with self._keys_lock:
+            self._keys = keys
+            self._keys_fetched_at = time.time()
+            self.stats["jwks_refreshes"] += 1
+
+    def _refresh_loop(self):
+        while not self._stopped.is_set():
+            try:
+                self.refresh_keys()
+            except Exception as e:
+                log_event("jwks_refresh_failed", error=repr(str(e)))
+            self._stopped.wait(self.refresh_interval)
+
+    def _schedule_refresh(self):
+        now = time.time()
+        with self._keys_lock:
+            if now - self._last_refresh_request < JWKS_MIN_REFRESH_SECONDS:
+                return
+            self._last_refresh_request = now
+
+        def refresh():
+            try:
+                self.refresh_keys()
+            except Exception as e:
+                log_event("jwks_refresh_failed", error=repr(str(e)))
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def start(self):
+        """
+        Start refreshing the JWKS in the background.
+        """
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=self._refresh_loop, daemon=True)
+            self._refresher.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _key_for(self, header: dict):
+        algorithm = header.get("alg")
+        if algorithm in _SYMMETRIC_ALGORITHMS:
+            if not self.jwt_secret:
+                raise KeyUnavailable("No JWT secret configured")
+            return self.jwt_secret, algorithm
+        if algorithm not in _ASYMMETRIC_ALGORITHMS:
+            raise InvalidToken(f"Unsupported token algorithm {algorithm}")
+
+        kid = header.get("kid")
+        with self._keys_lock:
+            key = self._keys.get(kid)
+        if key is None:
+            # Possibly a rotated key: fetch the JWKS again off the request path
+            self._schedule_refresh()
+            raise KeyUnavailable(f"Unknown signing key {kid}")
+        if key.algorithm_name != algorithm:
+            raise InvalidToken("Token algorithm does not match its signing key")
+        return key.key, algorithm
+
+    def _lookup(self, cache: OrderedDict, cache_key: bytes):
+        # Caller holds _cache_lock; entries are (exp, value)
+        entry = cache.get(cache_key)
+        if entry is None:
+            return None
+        if entry[0] + JWT_LEEWAY_SECONDS <= time.time():
+            del cache[cache_key]
+            return None
+        cache.move_to_end(cache_key)
+        return entry[1]
+
+    def _store(self, cache: OrderedDict, cache_key: bytes, exp: float, value):
+        # Caller holds _cache_lock
+        cache[cache_key] = (exp, value)
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+    def verify(self, token: str):
+        """
+        Claims of a valid token. Raises InvalidToken (bad signature, expired,
+        wrong audience, malformed) or KeyUnavailable.
+        """
+        cache_key = hashlib.sha256(token.encode()).digest()
+        with self._cache_lock:
+            cached = self._lookup(self._cache, cache_key)
+            if cached is not None:
+                self.stats["cache_hits"] += 1
+                return cached
+
+        try:
+            key, algorithm = self._key_for(jwt.get_unverified_header(token))
+            claims = jwt.decode(
+                token,
+                key,
+                algorithms=[algorithm],
+                audience=self.audience,
+                leeway=JWT_LEEWAY_SECONDS,
+                options={"require": ["exp", "sub"]},
+            )
+        except jwt.PyJWTError as e:
+            with self._cache_lock:
+                self.stats["rejected"] += 1
+            raise InvalidToken(str(e))
+
+        with self._cache_lock:
+            self.stats["verified"] += 1
+            self._store(self._cache, cache_key, claims["exp"], claims)
+        return claims
+
+    def cached_user(self, token: str):
+        """
+        The user Supabase returned for `token`, if remembered and unexpired.
+        """
+        cache_key = hashlib.sha256(token.encode()).digest()
+        with self._cache_lock:
+            user = self._lookup(self._users, cache_key)
+            if user is not None:
+                self.stats["user_cache_hits"] += 1
+            return user
+
+    def remember_user(self, token: str, user: dict):
+        """
+        Keep the user Supabase returned for `token` until the token expires.
+        Only call this after Supabase accepted the token: its claims are read
+        without checking the signature.
+        """
+        try:
+            exp = jwt.decode(token, options={"verify_signature": False}).get("exp")
+        except jwt.PyJWTError:
+            return
+        if not exp:
+            return
+        cache_key = hashlib.sha256(token.encode()).digest()
+        with self._cache_lock:
+            self._store(self._users, cache_key, exp, user)
+
+    def info(self):
+        with self._cache_lock:
+            return {
+                **self.stats,
+                "cached_tokens": len(self._cache),
+                "cached_users": len(self._users),
+                "jwks_keys": len(self._keys),
+                "jwks_age_seconds": time.time() - self._keys_fetched_at if self._keys_fetched_at else None,
+            }
+
+
+def user_from_claims(claims: dict):
+    """
+    The user fields that a Supabase access token carries, shaped like
+    supabase.auth.get_user().user.
+    """
+    return {
+        "id": claims["sub"],
+        "aud": claims.get("aud"),
+        "role": claims.get("role"),
+        "email": claims.get("email"),
+        "phone": claims.get("phone"),
+        "app_metadata": claims.get("app_metadata", {}),
+        "user_metadata": claims.get("user_metadata", {}),
+        "is_anonymous": claims.get("is_anonymous", False),
+        "aal": claims.get("aal"),
+        "session_id": claims.get("session_id"),
+    }
@@ -0,0 +1,311 @@
+"""
+Benchmark the prediction and viewing pipelines on synthetic NIfTI data.
+
+Each stage (NIfTI load, masking, connectivity, graph construction, GCN
+forward pass, slice extraction, JSON serialization) is timed on its own,
+with the peak RSS seen while it ran. Results are written as JSON and can be
+compared against a saved baseline; the exit code is 1 when a stage got
+slower than the tolerance allows.
+
+Runs fully offline: synthetic scans are written to a temporary directory,
+the local BASC-064 template is used for both masking and slicing, and
+Supabase is replaced by a stub that refuses any call.
+
+Usage:
+    python benchmark.py --output bench.json
+    python benchmark.py --sizes 61x73x61x200 --save-baseline benchmark_baseline.json
+    python benchmark.py --baseline benchmark_baseline.json --tolerance 0.2
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+import numpy as np
+
+DEFAULT_SIZES = ["61x73x61x200", "91x109x91x300"]
+# MNI152 origin shared by the 2 mm and 3 mm templates
+MNI_ORIGIN = (-90.0, -126.0, -72.0)
+RSS_SAMPLE_SECONDS = 0.005
+
+
+def _stub_supabase():
+    """
+    Make sure nothing imported by the benchmark can reach Supabase.
+    """
+    def create_client(*args, **kwargs):
+        raise RuntimeError("Supabase is disabled while benchmarking")
+
+    stub = types.ModuleType("supabase")
+    stub.create_client = create_client
+    stub.Client = object
+    sys.modules["supabase"] = stub
+
+
+def _current_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # No procfs (macOS): fall back to the process-wide peak
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class StageTimer:
+    """
+    Time a block of code and sample the RSS in a background thread while it runs.
+    """
+
+    def __init__(self):
+        self.results = {}
+
+    def run(self, name, func, *args, repeat: int = 1, **kwargs):
+        gc.collect()
+        start_rss = _current_rss()
+        peak = [start_rss]
+        done = threading.Event()
+
+        def sample():
+            while not done.wait(RSS_SAMPLE_SECONDS):
+                peak[0] = max(peak[0], _current_rss())
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        timings = []
+        try:
+            for _ in range(repeat):
+                started = time.perf_counter()
+                result = func(*args, **kwargs)
+                timings.append(time.perf_counter() - started)
+        finally:
+            done.set()
+            sampler.join()
+        peak[0] = max(peak[0], _current_rss())
+
+        self.results[name] = {
+            "wall_s": min(timings),
+            "wall_s_all": timings,
+            "peak_rss_mb": peak[0] / 2 ** 20,
+            "rss_delta_mb": (peak[0] - start_rss) / 2 ** 20,
+        }
+        print(f"  {name:<24} {min(timings) * 1000:10.1f} ms  peak {peak[0] / 2 ** 20:8.1f} MB")
+        return result
+
+
+def parse_size(text: str):
+    shape = tuple(int(n) for n in text.lower().split("x"))
+    if len(shape) not in (3, 4):
+        raise argparse.ArgumentTypeError(f"expected XxYxZ or XxYxZxT, got {text}")
+    return shape
+
+
+def write_synthetic_nifti(path: str, shape, seed: int = 0):
+    """
+    Write a float32 NIfTI of `shape` on the MNI grid matching its size, one
+    volume at a time so generating a large 4D scan needs about one volume
+    of memory. Voxels get a smooth spatial baseline plus noise, so masking
+    and correlations see realistic, non-constant signals.
+    """
+    import nibabel as nib
+
+    voxel_size = 2.0 if shape[0] > 70 else 3.0
+    affine = np.diag([voxel_size, voxel_size, voxel_size, 1.0])
+    affine[:3, 3] = MNI_ORIGIN
+
+    header = nib.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(np.float32)
+    header.set_qform(affine, code=1)
+    header.set_sform(affine, code=1)
+    header.set_xyzt_units("mm", "sec")
+    header["vox_offset"] = 352
+    header["scl_slope"] = 1.0
+    header["scl_inter"] = 0.0
+    with open(path, "wb") as f:
+        f.write(header.binaryblock)
+        f.write(b"\0" * (352 - len(header.binaryblock)))
+
+    n_volumes = shape[3] if len(shape) == 4 else 1
+    data = np.memmap(path, dtype=np.float32, mode="r+", offset=352, shape=shape, order="F")
+    rng = np.random.default_rng(seed)
+    grid = np.meshgrid(*(np.linspace(-1, 1, n, dtype=np.float32) for n in shape[:3]), indexing="ij")
+    baseline = 1000.0 * np.exp(-(grid[0] ** 2 + grid[1] ** 2 + grid[2] ** 2))
+    for t in range(n_volumes):
+        volume = baseline + rng.standard_normal(shape[:3], dtype=np.float32) * 20.0
+        if len(shape) == 4:
+            data[..., t] = volume
+        else:
+            data[...] = volume
+    data.flush()
+    del data
+    return path
+
+
+def bench_size(shape, workdir: str, population: int, repeat: int):
+    import nibabel as nib
+    import torch
+    from nilearn.input_data import NiftiLabelsMasker
+    from torch_geometric.data import Data
+    from fastapi.encoders import jsonable_encoder
+    import model
+    from src.plotlyViz import controller
+    from src.plotlyViz.binary import encode_slices
+
+    name = "x".join(str(n) for n in shape)
+    path = os.path.join(workdir, f"synthetic_{name}.nii")
+    print(f"{name}: writing synthetic scan...")
+    write_synthetic_nifti(path, shape)
+
+    timer = StageTimer()
+    img = timer.run("nifti_load", lambda: nib.load(path).get_fdata(dtype=np.float32))
+    del img
+
+    fmri = nib.load(path)
+    masker = NiftiLabelsMasker(labels_img=model.ATLAS_PATH, standardize=True, verbose=0)
+    time_series = timer.run("masker_fit_transform", masker.fit_transform, fmri)
+    model.get_fitted_masker(fmri)
+    timer.run("masker_cached_transform", lambda: model.get_fitted_masker(fmri).transform(fmri), repeat=repeat)
+
+    connectome = timer.run("connectivity_measure", model.connectome_from_time_series, time_series, repeat=repeat)
+
+    # Population graph as built at prediction time: the subject plus its cohort
+    rng = np.random.default_rng(1)
+    cohort = connectome + rng.standard_normal((population, connectome.shape[0]), dtype=np.float32) * 0.1
+    features = torch.as_tensor(np.vstack([connectome[None, :], cohort]))
+    edge_index = timer.run("graph_construction", model._build_knn_edge_index, features, repeat=repeat)
+
+    gcn = _load_gcn(model)
+    data = Data(x=features, edge_index=edge_index)
+    with torch.inference_mode():
+        timer.run("gcn_forward", gcn, data, repeat=repeat)
+
+    slice_index = shape[2] // 2
+    slices = timer.run("slice_extraction", controller.extract_slices, path, slice_index, "BASC064")
+    timer.run("slice_extraction_cached", controller.extract_slices, path, slice_index, "BASC064",
+              timepoint=0 if len(shape) == 4 else None, repeat=repeat)
+
+    def to_json():
+        payload = {
+            "brain": {view: plane.tolist() for view, plane in slices["brain"].items()},
+            "atlas": {view: plane.tolist() for view, plane in slices["atlas"].items()},
+            "labels": slices["labels"],
+            "max_index": slices["max_index"],
+        }
+        return json.dumps(jsonable_encoder(payload)).encode()
+
+    body = timer.run("json_serialization", to_json, repeat=repeat)
+    binary = timer.run("binary_serialization", encode_slices, slices, "uint16", repeat=repeat)
+    timer.results["json_serialization"]["bytes"] = len(body)
+    timer.results["binary_serialization"]["bytes"] = len(binary)
+
+    os.unlink(path)
+    return timer.results
+
+
+def _load_gcn(model):
+    if os.path.exists(model.MODEL_PATH):
+        return model.load_model()
+    # No trained weights checked out: time the same architecture untrained
+    from GNN import SpectralGCN
+    print(f"  {model.MODEL_PATH} not found, using untrained weights")
+    gcn = SpectralGCN(in_channels=model.IN_CHANNELS, hidden_channels=128, out_channels=1, K=3)
+    return gcn.eval()
+
+
+def compare(results, baseline, tolerance: float):
+    """
+    Print per-stage ratios against `baseline` and return the stages that got
+    slower than (1 + tolerance) times their baseline time.
+    """
+    regressions = []
+    print(f"\n{'size':<16} {'stage':<24} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for size, stages in results["results"].items():
+        for stage, current in stages.items():
+            previous = baseline.get("results", {}).get(size, {}).get(stage)
+            if previous is None:
+                continue
+            ratio = current["wall_s"] / max(previous["wall_s"], 1e-9)
+            flag = ""
+            if ratio > 1 + tolerance:
+                flag = "  SLOWER"
+                regressions.append((size, stage, ratio))
+            elif ratio < 1 - tolerance:
+                flag = "  faster"
+            print(f"{size:<16} {stage:<24} {previous['wall_s'] * 1000:8.1f}ms {current['wall_s'] * 1000:8.1f}ms "
+                  f"{ratio:6.2f}x{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the prediction and slice pipelines on synthetic NIfTI data")
+    parser.add_argument("--sizes", nargs="+", type=parse_size, default=[parse_size(s) for s in DEFAULT_SIZES],
+                        help="scan shapes as XxYxZ or XxYxZxT")
+    parser.add_argument("--population", type=int, default=256, help="cohort size for the GCN graph")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of the repeatable stages (best is kept)")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="results file to compare against")
+    parser.add_argument("--save-baseline", help="also write the results to this baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown before a stage counts as a regression")
+    args = parser.parse_args()
+
+    _stub_supabase()
+    workdir = tempfile.mkdtemp(prefix="cnh_bench_")
+    try:
+        # Keep the on-disk caches of the code under test out of the real ones
+        for var in ("ATLAS_CACHE_DIR", "FEATURE_BANK_DIR", "CONNECTOME_STORE_DIR"):
+            os.environ[var] = os.path.join(workdir, var.lower())
+
+        import nilearn
+        import torch
+        import model
+        from src.plotlyViz import controller
+
+        labels = ["Background"] + [f"BASC-{i}" for i in range(1, 65)]
+        controller.register_atlas("BASC064", model.ATLAS_PATH, labels)
+
+        results = {
+            "created_at": time.time(),
+            "machine": {
+                "platform": platform.platform(),
+                "python": platform.python_version(),
+                "cpus": os.cpu_count(),
+                "numpy": np.__version__,
+                "torch": torch.__version__,
+                "nilearn": nilearn.__version__,
+            },
+            "population": args.population,
+            "results": {},
+        }
+        for shape in args.sizes:
+            results["results"]["x".join(str(n) for n in shape)] = bench_size(shape, workdir, args.population, args.repeat)
+
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+        if args.save_baseline:
+            with open(args.save_baseline, "w") as f:
+                json.dump(results, f, indent=2)
+            print(f"Baseline written to {args.save_baseline}")
+
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            regressions = compare(results, baseline, args.tolerance)
+            if regressions:
+                print(f"\n{len(regressions)} stage(s) slower than the baseline by more than {args.tolerance:.0%}")
+                sys.exit(1)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+Build (or extend) the healthy baseline used for z-scores.
+
+Each worker streams its share of subjects: a subject's 4D series is averaged
+over time in chunks, then folded into running Welford statistics, so memory
+stays at about one volume per worker regardless of cohort size. Partial
+statistics from the workers are combined with Chan's parallel merge.
+
+Usage:
+    python build_baseline.py /data/healthy/*.nii.gz --workers 8
+    python build_baseline.py /data/new_subjects/*.nii.gz --update
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import nibabel as nib
+
+from src.plotlyViz.controller import temporal_mean, MEAN_CHUNK_VOLUMES
+
+DEFAULT_OUTPUT_DIR = "brain_analysis_results"
+STATS_FILE = "baseline_stats.json"
+# Same floor the notebook applied before dividing by std
+STD_FLOOR = 1e-6
+
+
+class RunningStats:
+    """
+    Voxelwise count/mean/M2 accumulator (Welford), mergeable with Chan et al.
+    """
+
+    def __init__(self, shape=None, count=0, mean=None, m2=None):
+        self.count = count
+        self.mean = mean if mean is not None else (np.zeros(shape, dtype=np.float64) if shape else None)
+        self.m2 = m2 if m2 is not None else (np.zeros(shape, dtype=np.float64) if shape else None)
+
+    def add(self, volume):
+        volume = np.asarray(volume, dtype=np.float64)
+        if self.mean is None:
+            self.mean = np.zeros(volume.shape, dtype=np.float64)
+            self.m2 = np.zeros(volume.shape, dtype=np.float64)
+        self.count += 1
+        delta = volume - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (volume - self.mean)
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            return self
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * (other.count / total)
+        self.m2 += other.m2 + delta ** 2 * (self.count * other.count / total)
+        self.count = total
+        return self
+
+    def std(self):
+        # Population std (ddof=0), matching np.std in the notebook
+        return np.sqrt(self.m2 / max(self.count, 1))
+
+
+def _subject_mean(path: str, chunk_volumes: int):
+    img = nib.load(path, mmap=True)
+    if len(img.shape) > 3:
+        return temporal_mean(img, chunk_volumes), img.affine
+    return np.asarray(img.dataobj, dtype=np.float32), img.affine
+
+
+def accumulate(paths, reference_shape, reference_affine, chunk_volumes: int = MEAN_CHUNK_VOLUMES):
+    """
+    Worker task: fold a group of subjects into one RunningStats. Returns
+    (count, mean, m2, included paths, skipped (path, reason) pairs).
+    """
+    stats = RunningStats(reference_shape)
+    included = []
+    skipped = []
+    for path in paths:
+        try:
+            volume, affine = _subject_mean(path, chunk_volumes)
+        except Exception as e:
+            skipped.append((path, str(e)))
+            continue
+        if volume.shape != tuple(reference_shape) or not np.allclose(affine, reference_affine, atol=1e-4):
+            skipped.append((path, f"geometry {volume.shape} does not match baseline {tuple(reference_shape)}"))
+            continue
+        stats.add(volume)
+        included.append(path)
+    return stats.count, stats.mean, stats.m2, included, skipped
+
+
+def load_existing(output_dir: str):
+    """
+    Subject count and list recorded in baseline_stats.json for an existing baseline.
+    """
+    stats_path = os.path.join(output_dir, STATS_FILE)
+    if not os.path.exists(stats_path):
+        raise SystemExit(f"{stats_path} not found; --update needs a baseline built by this tool "
+                         f"(or pass --existing-count for an older baseline)")
+    with open(stats_path) as f:
+        meta = json.load(f)
+    return meta
+
+
+def build(paths, output_dir: str = DEFAULT_OUTPUT_DIR, workers: int = None, update: bool = False,
+          existing_count: int = None, chunk_volumes: int = MEAN_CHUNK_VOLUMES):
+    started = time.time()
+    workers = workers or os.cpu_count() or 1
+
+    total = RunningStats()
+    subjects = []
+    if update:
+        mean_img = nib.load(os.path.join(output_dir, "baseline_mean.nii.gz"))
+        std_img = nib.load(os.path.join(output_dir, "baseline_std.nii.gz"))
+        if existing_count is not None:
+            meta = {"n_subjects": existing_count, "subjects": []}
+        else:
+            meta = load_existing(output_dir)
+        subjects = list(meta.get("subjects", []))
+        mean = np.asarray(mean_img.dataobj, dtype=np.float64)
+        std = np.asarray(std_img.dataobj, dtype=np.float64)
+        total = RunningStats(count=meta["n_subjects"], mean=mean, m2=std ** 2 * meta["n_subjects"])
+        reference_shape, reference_affine = mean.shape, mean_img.affine
+
+        known = set(subjects)
+        new_paths = [path for path in paths if os.path.abspath(path) not in known]
+        if len(new_paths) != len(paths):
+            print(f"Skipping {len(paths) - len(new_paths)} subjects already in the baseline")
+        paths = new_paths
+    else:
+        first = nib.load(paths[0])
+        reference_shape, reference_affine = first.shape[:3], first.affine
+
+    if not paths:
+        print("No new subjects to add")
+        return total
+
+    # A few groups per worker keeps the pool busy without shipping one
+    # volume back per subject
+    n_groups = min(len(paths), workers * 4)
+    groups = [paths[i::n_groups] for i in range(n_groups)]
+
+    print(f"Processing {len(paths)} subjects with {workers} workers...")
+    skipped = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(accumulate, group, reference_shape, reference_affine, chunk_volumes)
+            for group in groups
+        ]
+        for future in as_completed(futures):
+            count, mean, m2, included, group_skipped = future.result()
+            total.merge(RunningStats(count=count, mean=mean, m2=m2))
+            subjects.extend(os.path.abspath(path) for path in included)
+            skipped.extend(group_skipped)
+            print(f"  {total.count} subjects in baseline")
+
+    for path, reason in skipped:
+        print(f"  skipped {path}: {reason}")
+
+    if total.count == 0:
+        raise SystemExit("No subjects could be added to the baseline")
+
+    os.makedirs(output_dir, exist_ok=True)
+    std = total.std()
+    std[std < STD_FLOOR] = STD_FLOOR
+    nib.save(nib.Nifti1Image(total.mean.astype(np.float32), reference_affine),
+             os.path.join(output_dir, "baseline_mean.nii.gz"))
+    nib.save(nib.Nifti1Image(std.astype(np.float32), reference_affine),
+             os.path.join(output_dir, "baseline_std.nii.gz"))
+    with open(os.path.join(output_dir, STATS_FILE), "w") as f:
+        json.dump({
+            "n_subjects": total.count,
+            "shape": list(reference_shape),
+            "affine": np.asarray(reference_affine).tolist(),
+            "subjects": subjects,
+            "updated_at": time.time(),
+        }, f, indent=2)
+
+    print(f"Baseline with {total.count} subjects written to {output_dir} in {time.time() - started:.1f}s")
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the healthy-subject baseline mean/std volumes")
+    parser.add_argument("inputs", nargs="+", help="NIfTI files (3D or 4D) of healthy subjects")
+    parser.add_argument("--output-dir", default=DEFAULT_OUTPUT_DIR)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument("--update", action="store_true",
+                        help="add the inputs to the existing baseline instead of rebuilding it")
+    parser.add_argument("--existing-count", type=int, default=None,
+                        help="subject count of an existing baseline that has no baseline_stats.json")
+    parser.add_argument("--chunk-volumes", type=int, default=MEAN_CHUNK_VOLUMES,
+                        help="timepoints read at once when averaging a 4D scan")
+    args = parser.parse_args()
+
+    build(args.inputs, args.output_dir, args.workers, args.update, args.existing_count, args.chunk_volumes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+import httpx
+
+from metrics import time_stage, BYTES, log_event
+from supabase_async import SupabaseError, RESUMABLE_CHUNK_BYTES
+
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR", "upload_spool")
+# Client part size; a multiple of the storage chunk so parts map onto whole chunks
+UPLOAD_PART_BYTES = int(os.getenv("UPLOAD_PART_MB", "6")) * 1024 * 1024
+# Largest scan a resumable upload may declare; its spool file is preallocated to that size
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "4096")) * 1024 * 1024
+UPLOAD_SESSION_TTL_SECONDS = int(os.getenv("UPLOAD_SESSION_TTL_SECONDS", "86400"))
+FORWARD_RETRIES = 5
+STORAGE_BUCKET = "fmri-uploads"
+
+
+def _read_range(path: str, offset: int, length: int):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def _write_range(path: str, offset: int, data: bytes):
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        os.pwrite(fd, data, offset)
+    finally:
+        os.close(fd)
+
+
+class UploadSession:
+    """
+    One resumable upload: the client sends fixed-size parts in any order
+    (and may resend them); the server tracks which have arrived and how far
+    the bytes have been forwarded to storage.
+    """
+
+    def __init__(self, id: str, filename: str, size: int, content_type: str, fields: dict,
+                 storage_path: str, suffix: str = "", part_size: int = UPLOAD_PART_BYTES, received=(),
+                 forwarded: int = 0,
+                 storage_url: str = None, status: str = "receiving", job_id: str = None, error: str = None,
+                 created_at: float = None, updated_at: float = None):
+        self.id = id
+        self.filename = filename
+        self.size = size
+        self.content_type = content_type
+        self.fields = fields
+        self.storage_path = storage_path
+        self.suffix = suffix
+        self.part_size = part_size
+        self.received = set(received)
+        self.forwarded = forwarded
+        self.storage_url = storage_url
+        self.status = status
+        self.job_id = job_id
+        self.error = error
+        self.created_at = created_at or time.time()
+        self.updated_at = updated_at or self.created_at
+        # Keeps the scan's own suffix so nibabel can open the spool file directly
+        self.spool_path = os.path.join(UPLOAD_SPOOL_DIR, f"{id}{suffix}")
+        self.lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+        self._stored = asyncio.Event()
+        self._forwarder = None
+
+    @property
+    def n_parts(self):
+        return max(1, -(-self.size // self.part_size))
+
+    def part_range(self, part_number: int):
+        start = part_number * self.part_size
+        return start, min(self.size, start + self.part_size)
+
+    def missing_parts(self):
+        return [n for n in range(self.n_parts) if n not in self.received]
+
+    def contiguous_bytes(self):
+        """
+        Bytes from the start of the file that have all arrived.
+        """
+        n = 0
+        while n in self.received:
+            n += 1
+        return min(self.size, n * self.part_size)
+
+    def to_dict(self):
+        received_bytes = sum(end - start for start, end in map(self.part_range, self.received))
+        return {
+            "upload_id": self.id,
+            "filename": self.filename,
+            "size": self.size,
+            "part_size": self.part_size,
+            "parts": self.n_parts,
+            "received_parts": sorted(self.received),
+            "missing_parts": self.missing_parts(),
+            "received_bytes": received_bytes,
+            "forwarded_bytes": self.forwarded,
+            "status": self.status,
+            "job_id": self.job_id,
+            "error": self.error,
+        }
+
+    def save(self):
+        self.updated_at = time.time()
+        state = {
+            "id": self.id, "filename": self.filename, "size": self.size,
+            "content_type": self.content_type, "fields": self.fields,
+            "storage_path": self.storage_path, "suffix": self.suffix, "part_size": self.part_size,
+            "received": sorted(self.received), "forwarded": self.forwarded,
+            "storage_url": self.storage_url, "status": self.status, "job_id": self.job_id,
+            "error": self.error, "created_at": self.created_at, "updated_at": self.updated_at,
+        }
+        path = os.path.join(UPLOAD_SPOOL_DIR, f"{self.id}.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+
+
+class UploadSessionManager:
+    """
+    Resumable chunked uploads. Parts are written at their offset in a
+    preallocated spool file; a forwarder task per session streams the
+    contiguous prefix to Supabase Storage's resumable endpoint as soon as
+    each storage chunk is complete, so the storage transfer overlaps the
+    client transfer. Session state is kept on disk, so uploads survive a
+    restart and forwarding resumes from the offset storage reports; a
+    session whose forwarding failed resumes the same way on `retry`.
+    """
+
+    def __init__(self, directory: str = UPLOAD_SPOOL_DIR, ttl: float = UPLOAD_SESSION_TTL_SECONDS):
+        self.directory = directory
+        self.ttl = ttl
+        self.client = None
+        self._sessions = {}
+
+    def start(self, client):
+        """
+        Called on app startup with the storage client; reloads unfinished sessions.
+        """
+        self.client = client
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    session = UploadSession(**json.load(f))
+            except (ValueError, TypeError) as e:
+                log_event("upload_session_unreadable", file=name, error=repr(str(e)))
+                continue
+            self._sessions[session.id] = session
+            if session.status in ("receiving", "stored"):
+                self._start_forwarder(session)
+            elif session.status == "completed":
+                session._stored.set()
+        self.expire()
+
+    def create(self, filename: str, size: int, content_type: str, fields: dict, storage_path: str, suffix: str = ""):
+        self.expire()
+        session = UploadSession(str(uuid.uuid4()), filename, size, content_type, fields, storage_path, suffix)
+        with open(session.spool_path, "wb") as f:
+            f.truncate(size)
+        session.save()
+        self._sessions[session.id] = session
+        self._start_forwarder(session)
+        return session
+
+    def get(self, upload_id: str):
+        return self._sessions.get(upload_id)
+
+    async def write_part(self, session, part_number: int, data: bytes):
+        """
+        Store one part. Raises ValueError for an out-of-range part or a
+        body of the wrong length. Re-sending a part is harmless.
+        """
+        self.retry(session)
+        if session.status not in ("receiving", "stored"):
+            raise ValueError(f"Upload is {session.status}")
+        if part_number < 0 or part_number >= session.n_parts:
+            raise ValueError(f"Part must be between 0 and {session.n_parts - 1}")
+        start, end = session.part_range(part_number)
+        if len(data) != end - start:
+            raise ValueError(f"Part {part_number} must be {end - start} bytes, got {len(data)}")
+
+        if part_number not in session.received:
+            await asyncio.to_thread(_write_range, session.spool_path, start, data)
+            session.received.add(part_number)
+            session.save()
+            BYTES.inc(len(data), transfer="upload_read")
+            session._wake.set()
+        return session
+
+    def retry(self, session):
+        """
+        Restart forwarding for a session whose storage transfer failed,
+        from the offset storage acknowledged.
+        """
+        if session.status != "failed":
+            return
+        session.status = "receiving"
+        session.error = None
+        session._stored.clear()
+        session.save()
+        log_event("upload_forward_restarted", upload=session.id, forwarded=session.forwarded)
+        self._start_forwarder(session)
+
+    async def wait_stored(self, session):
+        await session._stored.wait()
+        return session.status != "failed"
+
+    def _start_forwarder(self, session):
+        if session._forwarder is None or session._forwarder.done():
+            session._forwarder = asyncio.get_running_loop().create_task(self._forward(session))
+
+    async def _forward(self, session):
+        client = self.client
+        try:
+            if session.storage_url is None:
+                session.storage_url = await client.create_resumable_upload(
+                    STORAGE_BUCKET, session.storage_path, session.size, session.content_type)
+                session.save()
+            resync = session.forwarded > 0
+            failures = 0
+            while session.forwarded < session.size:
+                end = min(session.forwarded + RESUMABLE_CHUNK_BYTES, session.size)
+                if not resync and session.contiguous_bytes() < end:
+                    session._wake.clear()
+                    if session.contiguous_bytes() < end:
+                        await session._wake.wait()
+                    continue
+                try:
+                    if resync:
+                        session.forwarded = await client.resumable_offset(session.storage_url)
+                        resync = False
+                        continue
+                    data = await asyncio.to_thread(_read_range, session.spool_path, session.forwarded,
+                                                   end - session.forwarded)
+                    with time_stage("storage_put_chunk"):
+                        session.forwarded = await client.upload_resumable_chunk(
+                            session.storage_url, session.forwarded, data)
+                    BYTES.inc(len(data), transfer="storage_put")
+                    failures = 0
+                    session.save()
+                except (SupabaseError, httpx.HTTPError) as e:
+                    failures += 1
+                    if failures > FORWARD_RETRIES:
+                        raise
+                    log_event("upload_forward_retry", upload=session.id, attempt=failures, error=repr(str(e)))
+                    await asyncio.sleep(min(2 ** failures, 30))
+                    resync = True
+            if session.status == "receiving":
+                session.status = "stored"
+            session.save()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            session.status = "failed"
+            session.error = str(e)
+            session.save()
+            log_event("upload_forward_failed", upload=session.id, error=repr(str(e)))
+        finally:
+            if session.status != "receiving":
+                session._stored.set()
+
+    def expire(self):
+        """
+        Drop sessions (and their spool files) untouched for longer than the TTL.
+        """
+        now = time.time()
+        for upload_id, session in list(self._sessions.items()):
+            if now - session.updated_at <= self.ttl:
+                continue
+            if session._forwarder is not None:
+                session._forwarder.cancel()
+            # A completed session's spool file belongs to its upload job
+            paths = [os.path.join(self.directory, f"{upload_id}.json")]
+            if session.status != "completed":
+                paths.append(session.spool_path)
+            for path in paths:
+                if os.path.exists(path):
+                    os.unlink(path)
+            del self._sessions[upload_id]
+
+    def info(self):
+        statuses = {}
+        for session in self._sessions.values():
+            statuses[session.status] = statuses.get(session.status, 0) + 1
+        return {"sessions": len(self._sessions), **statuses}
+
+
+upload_sessions = UploadSessionManager()
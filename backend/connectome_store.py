@@ -0,0 +1,168 @@
+import json
+import os
+import threading
+import numpy as np
+
+CONNECTOME_STORE_DIR = os.getenv("CONNECTOME_STORE_DIR", "connectome_store")
+# Correlation rows per chunk file (2016 float32 values per row, ~8 MB per chunk)
+CHUNK_ROWS = 1024
+
+
+class ConnectomeStore:
+    """
+    Per-atlas store of the ROI time series and vectorized correlations of
+    every processed scan, keyed by fmri_id.
+
+    Correlation vectors live in fixed-size chunk files of raw float32 rows
+    (memory-mapped on read), with a parallel int64 file of fmri_ids that is
+    turned into the id -> row index on open. Time series have a different
+    length per scan and are stored as one float32 .npy each, sharded by
+    fmri_id.
+    """
+
+    def __init__(self, atlas: str, dim: int, directory: str = CONNECTOME_STORE_DIR):
+        self.atlas = atlas
+        self.dim = dim
+        self.directory = os.path.join(directory, atlas)
+        os.makedirs(os.path.join(self.directory, "correlations"), exist_ok=True)
+        os.makedirs(os.path.join(self.directory, "timeseries"), exist_ok=True)
+        self._lock = threading.Lock()
+        self._chunks = {}
+
+        self._meta_path = os.path.join(self.directory, "meta.json")
+        self._ids_path = os.path.join(self.directory, "ids.i64")
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                meta = json.load(f)
+            if meta["dim"] != dim:
+                raise ValueError(f"Connectome store {self.directory} has dim {meta['dim']}, expected {dim}")
+            self._count = meta["count"]
+        else:
+            self._count = 0
+            open(self._ids_path, "ab").close()
+            self._write_meta()
+
+        ids = np.fromfile(self._ids_path, dtype=np.int64, count=self._count)
+        self._rows = {int(fmri_id): row for row, fmri_id in enumerate(ids)}
+
+    def _write_meta(self):
+        tmp_path = f"{self._meta_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"atlas": self.atlas, "dim": self.dim, "count": self._count, "chunk_rows": CHUNK_ROWS}, f)
+        os.replace(tmp_path, self._meta_path)
+
+    def _chunk(self, index: int, writable: bool = False):
+        path = os.path.join(self.directory, "correlations", f"chunk_{index:05d}.f32")
+        if writable and not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.truncate(CHUNK_ROWS * self.dim * 4)
+        chunk = self._chunks.get(index)
+        if chunk is None:
+            chunk = np.memmap(path, dtype=np.float32, mode="r+", shape=(CHUNK_ROWS, self.dim))
+            self._chunks[index] = chunk
+        return chunk
+
+    def _timeseries_path(self, fmri_id: int):
+        shard = os.path.join(self.directory, "timeseries", f"{int(fmri_id) // 1000:05d}")
+        return shard, os.path.join(shard, f"{int(fmri_id)}.npy")
+
+    def __contains__(self, fmri_id):
+        return int(fmri_id) in self._rows
+
+    def __len__(self):
+        return self._count
+
+    def put(self, fmri_id: int, time_series, correlations):
+        """
+        Store (or replace) the features of one scan.
+        """
+        fmri_id = int(fmri_id)
+        correlations = np.asarray(correlations, dtype=np.float32).reshape(self.dim)
+
+        shard, ts_path = self._timeseries_path(fmri_id)
+        os.makedirs(shard, exist_ok=True)
+        tmp_path = f"{ts_path}.{os.getpid()}.{threading.get_ident()}.tmp.npy"
+        np.save(tmp_path, np.asarray(time_series, dtype=np.float32))
+        os.replace(tmp_path, ts_path)
+
+        with self._lock:
+            row = self._rows.get(fmri_id)
+            is_new = row is None
+            if is_new:
+                row = self._count
+            chunk = self._chunk(row // CHUNK_ROWS, writable=True)
+            chunk[row % CHUNK_ROWS] = correlations
+            chunk.flush()
+            if is_new:
+                with open(self._ids_path, "r+b") as f:
+                    f.seek(row * 8)
+                    f.write(np.int64(fmri_id).tobytes())
+                self._count += 1
+                self._rows[fmri_id] = row
+                self._write_meta()
+
+    def get_time_series(self, fmri_id: int):
+        _, ts_path = self._timeseries_path(fmri_id)
+        if not os.path.exists(ts_path):
+            return None
+        return np.load(ts_path, mmap_mode="r")
+
+    def get_correlations(self, fmri_id: int):
+        row = self._rows.get(int(fmri_id))
+        if row is None:
+            return None
+        with self._lock:
+            chunk = self._chunk(row // CHUNK_ROWS)
+        return np.array(chunk[row % CHUNK_ROWS])
+
+    def get(self, fmri_id: int):
+        correlations = self.get_correlations(fmri_id)
+        if correlations is None:
+            return None
+        return {
+            "fmri_id": int(fmri_id),
+            "atlas": self.atlas,
+            "time_series": self.get_time_series(fmri_id),
+            "correlations": correlations,
+        }
+
+    def bulk_correlations(self, fmri_ids=None):
+        """
+        (fmri_ids, matrix) for a cohort, one row per stored subject, read
+        chunk by chunk. Defaults to every stored subject; unknown ids are
+        left out.
+        """
+        with self._lock:
+            if fmri_ids is None:
+                pairs = sorted((row, fmri_id) for fmri_id, row in self._rows.items())
+            else:
+                pairs = [(self._rows[int(i)], int(i)) for i in fmri_ids if int(i) in self._rows]
+
+        ids = np.array([fmri_id for _, fmri_id in pairs], dtype=np.int64)
+        rows = np.array([row for row, _ in pairs], dtype=np.int64)
+        matrix = np.empty((len(rows), self.dim), dtype=np.float32)
+        if len(rows) == 0:
+            return ids, matrix
+
+        chunk_ids = rows // CHUNK_ROWS
+        for chunk_index in np.unique(chunk_ids):
+            selected = np.nonzero(chunk_ids == chunk_index)[0]
+            with self._lock:
+                chunk = self._chunk(int(chunk_index))
+            matrix[selected] = chunk[rows[selected] % CHUNK_ROWS]
+        return ids, matrix
+
+    def info(self):
+        return {"atlas": self.atlas, "subjects": self._count}
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_connectome_store(atlas: str, dim: int):
+    with _stores_lock:
+        store = _stores.get(atlas)
+        if store is None:
+            store = _stores[atlas] = ConnectomeStore(atlas, dim)
+        return store
@@ -2,7 +2,7 @@ from typing import List
 from typing import Optional
 from sqlalchemy import ForeignKey
 from sqlalchemy import create_engine, Column, Integer, String, DateTime, Float
-from sqlalchemy import func
+from sqlalchemy import func, Index
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import Mapped, sessionmaker
 from sqlalchemy.orm import mapped_column
@@ -53,6 +53,12 @@ class FMRI_History(Base):
     atlas:        Mapped[str] = mapped_column(String(255))
     model_result: Mapped[int] = mapped_column(Integer)
 
+    # Keyset pagination of a user's history on (date, fmri_id); Postgres scans
+    # it backwards for the newest-first order
+    __table_args__ = (
+        Index("ix_fmri_history_user_date_id", "user_id", "date", "fmri_id"),
+    )
+
 
 # This function is used for direct table creation without migrations
 # For schema changes, use Alembic migrations instead
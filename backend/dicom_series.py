@@ -0,0 +1,227 @@
+import os
+import zipfile
+from itertools import repeat
+import nibabel as nib
+import numpy as np
+import pydicom
+from pydicom.errors import InvalidDicomError
+
+# Files handed to a worker per task; large enough to amortise opening the archive
+DICOM_BATCH_FILES = int(os.getenv("DICOM_BATCH_FILES", "64"))
+DICOM_SUFFIXES = (".zip", ".dcm")
+# Slices closer than this (mm) along the slice normal are the same position
+POSITION_TOLERANCE_MM = 0.01
+
+_NIFTI_VOX_OFFSET = 352
+_HEADER_FIELDS = (
+    "SeriesInstanceUID", "ImagePositionPatient", "ImageOrientationPatient", "PixelSpacing",
+    "SliceThickness", "Rows", "Columns", "AcquisitionTime", "ContentTime", "InstanceNumber",
+    "TemporalPositionIdentifier", "RepetitionTime", "RescaleSlope", "RescaleIntercept", "NumberOfFrames",
+)
+
+
+def is_dicom_upload(filename: str):
+    return filename.lower().endswith(DICOM_SUFFIXES)
+
+
+def dicom_suffix(filename: str):
+    return ".zip" if filename.lower().endswith(".zip") else ".dcm"
+
+
+def _members(source: str):
+    if zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            return [info.filename for info in archive.infolist() if not info.is_dir()]
+    return [None]
+
+
+def _open_member(archive, source: str, name: str):
+    return archive.open(name) if archive is not None else open(source, "rb")
+
+
+def _seconds(dicom_time):
+    """
+    Seconds since midnight of a DICOM TM value (HHMMSS.ffffff), or None.
+    """
+    if not dicom_time:
+        return None
+    text = str(dicom_time)
+    try:
+        return int(text[0:2]) * 3600 + int(text[2:4] or 0) * 60 + float(text[4:] or 0)
+    except ValueError:
+        return None
+
+
+def _read_headers(source: str, names):
+    """
+    Worker task: the geometry and timing fields of each member, skipping
+    files that aren't image slices (DICOMDIR, stray files).
+    """
+    headers = []
+    archive = zipfile.ZipFile(source) if names[0] is not None else None
+    try:
+        for name in names:
+            with _open_member(archive, source, name) as f:
+                try:
+                    ds = pydicom.dcmread(f, stop_before_pixels=True, specific_tags=list(_HEADER_FIELDS))
+                except InvalidDicomError:
+                    continue
+            if "ImagePositionPatient" not in ds or "ImageOrientationPatient" not in ds:
+                continue
+            if int(ds.get("NumberOfFrames", 1) or 1) > 1:
+                raise ValueError("Enhanced multi-frame DICOM is not supported; upload the series as slices")
+            headers.append({
+                "name": name,
+                "series": str(ds.get("SeriesInstanceUID", "")),
+                "position": [float(v) for v in ds.ImagePositionPatient],
+                "orientation": [float(v) for v in ds.ImageOrientationPatient],
+                "spacing": [float(v) for v in ds.get("PixelSpacing", [1.0, 1.0])],
+                "thickness": float(ds.get("SliceThickness", 0) or 0),
+                "shape": (int(ds.Rows), int(ds.Columns)),
+                "time": _seconds(ds.get("AcquisitionTime") or ds.get("ContentTime")),
+                "temporal_position": int(ds.get("TemporalPositionIdentifier", 0) or 0),
+                "instance": int(ds.get("InstanceNumber", 0) or 0),
+                "repetition_time": float(ds.get("RepetitionTime", 0) or 0),
+                "slope": float(ds.get("RescaleSlope", 1) or 1),
+                "intercept": float(ds.get("RescaleIntercept", 0) or 0),
+            })
+    finally:
+        if archive is not None:
+            archive.close()
+    return headers
+
+
+def _write_slices(source: str, nifti_path: str, shape, placements):
+    """
+    Worker task: decode each (name, z, t, slope, intercept) slice and write
+    it into its place in the NIfTI file's data block.
+    """
+    volume = np.memmap(nifti_path, dtype=np.float32, mode="r+", offset=_NIFTI_VOX_OFFSET,
+                       shape=shape, order="F")
+    archive = zipfile.ZipFile(source) if placements[0][0] is not None else None
+    try:
+        for name, z, t, slope, intercept in placements:
+            with _open_member(archive, source, name) as f:
+                pixels = pydicom.dcmread(f).pixel_array
+            # DICOM rows run along the second voxel axis
+            volume[:, :, z, t] = pixels.T.astype(np.float32) * slope + intercept
+        volume.flush()
+    finally:
+        if archive is not None:
+            archive.close()
+    del volume
+
+
+def _batches(items, size: int):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _arrange(headers):
+    """
+    Sort slices into a (positions x timepoints) grid. Returns the grid (a
+    list per position, ordered along the slice normal, of headers ordered
+    in time) and the slice normal.
+    """
+    series = {}
+    for header in headers:
+        series.setdefault(header["series"], []).append(header)
+    # An export may carry localisers or other series alongside the run
+    headers = max(series.values(), key=len)
+
+    orientation = np.array(headers[0]["orientation"])
+    normal = np.cross(orientation[:3], orientation[3:])
+    shape = headers[0]["shape"]
+    if any(header["shape"] != shape for header in headers):
+        raise ValueError("Slices in the series have different dimensions")
+
+    for header in headers:
+        header["distance"] = float(np.dot(normal, header["position"]))
+    headers.sort(key=lambda header: header["distance"])
+    positions = []
+    for header in headers:
+        if positions and header["distance"] - positions[-1][0]["distance"] <= POSITION_TOLERANCE_MM:
+            positions[-1].append(header)
+        else:
+            positions.append([header])
+
+    n_timepoints = len(positions[0])
+    if any(len(position) != n_timepoints for position in positions):
+        raise ValueError("Incomplete series: positions have different numbers of timepoints")
+    for position in positions:
+        position.sort(key=lambda header: (header["time"] if header["time"] is not None else 0,
+                                          header["temporal_position"], header["instance"]))
+    return positions, normal
+
+
+def _affine(positions, normal):
+    """
+    Voxel-to-RAS affine of the grid; DICOM patient coordinates are LPS.
+    """
+    first = positions[0][0]
+    orientation = np.array(first["orientation"])
+    row_spacing, column_spacing = first["spacing"]
+    if len(positions) > 1:
+        step = (np.array(positions[-1][0]["position"]) - np.array(first["position"])) / (len(positions) - 1)
+    else:
+        step = normal * (first["thickness"] or 1.0)
+
+    affine = np.eye(4)
+    affine[:3, 0] = orientation[:3] * column_spacing
+    affine[:3, 1] = orientation[3:] * row_spacing
+    affine[:3, 2] = step
+    affine[:3, 3] = first["position"]
+    return np.diag([-1, -1, 1, 1]) @ affine
+
+
+def _repetition_time(positions):
+    repetition_time = positions[0][0]["repetition_time"] / 1000.0
+    if repetition_time:
+        return repetition_time
+    times = [header["time"] for header in positions[0] if header["time"] is not None]
+    if len(times) > 1:
+        return float(np.median(np.diff(times)))
+    return 1.0
+
+
+def dicom_series_to_nifti(source: str, nifti_path: str, pool, max_workers: int):
+    """
+    Convert a DICOM series (a zip of slices, or a single slice file) into a
+    4D float32 NIfTI at `nifti_path`.
+
+    Headers are parsed in `pool`, a process pool of `max_workers` shared
+    with the rest of the app (the job manager's), slices are sorted by
+    position along the slice normal and by acquisition time, and each
+    worker decodes its slices straight into a preallocated memory map of
+    the output file's data block, so the volume is never assembled in one
+    process.
+    """
+    names = _members(source)
+    batch = max(1, min(DICOM_BATCH_FILES, -(-len(names) // max_workers)))
+    headers = [header for part in pool.map(_read_headers, repeat(source), _batches(names, batch))
+               for header in part]
+    if not headers:
+        raise ValueError("No DICOM image slices found in the upload")
+
+    positions, normal = _arrange(headers)
+    rows, columns = positions[0][0]["shape"]
+    shape = (columns, rows, len(positions), len(positions[0]))
+
+    header = nib.Nifti1Header()
+    header.set_data_dtype(np.float32)
+    header.set_data_shape(shape)
+    header.set_qform(_affine(positions, normal), code=1)
+    header.set_sform(_affine(positions, normal), code=1)
+    header.set_xyzt_units("mm", "sec")
+    header["pixdim"][4] = _repetition_time(positions)
+    header["vox_offset"] = _NIFTI_VOX_OFFSET
+    with open(nifti_path, "wb") as f:
+        f.write(header.binaryblock)
+        f.write(b"\0" * (_NIFTI_VOX_OFFSET - len(header.binaryblock)))
+        f.truncate(_NIFTI_VOX_OFFSET + int(np.prod(shape)) * 4)
+
+    placements = [(h["name"], z, t, h["slope"], h["intercept"])
+                  for z, position in enumerate(positions) for t, h in enumerate(position)]
+    # Consume the results so worker errors surface here
+    list(pool.map(_write_slices, repeat(source), repeat(nifti_path), repeat(shape),
+                  _batches(placements, batch)))
+    return shape
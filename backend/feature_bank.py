@@ -0,0 +1,282 @@
+import json
+import os
+import threading
+import numpy as np
+
+FEATURE_DIM = 2016
+FEATURE_BANK_DIR = os.getenv("FEATURE_BANK_DIR", "feature_bank")
+
+# Rows scored per matmul when scanning the bank, keeps the working set small
+SEARCH_CHUNK_ROWS = 8192
+# Below this many subjects the approximate mode just does the exact scan
+MIN_INDEX_ROWS = 4096
+
+
+class FeatureBank:
+    """
+    Append-only, memory-mapped bank of connectome vectors from past subjects.
+
+    Vectors live in a raw float32 file that grows by doubling, with a parallel
+    int64 file of keys (fmri_id) and float32 norms. Search is cosine top-k:
+    exact by scanning the bank in chunks, or approximate through an inverted
+    file index (spherical k-means centroids, only `nprobe` lists are scanned).
+    """
+
+    def __init__(self, directory: str = FEATURE_BANK_DIR, dim: int = FEATURE_DIM,
+                 initial_capacity: int = 1024, nprobe: int = 8):
+        self.directory = directory
+        self.dim = dim
+        self.nprobe = nprobe
+        self._lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+
+        self._meta_path = os.path.join(directory, "meta.json")
+        self._vectors_path = os.path.join(directory, "vectors.f32")
+        self._norms_path = os.path.join(directory, "norms.f32")
+        self._keys_path = os.path.join(directory, "keys.i64")
+        self._centroids_path = os.path.join(directory, "centroids.npy")
+        self._assign_path = os.path.join(directory, "assign.i32")
+
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                meta = json.load(f)
+            if meta["dim"] != dim:
+                raise ValueError(f"Feature bank at {directory} has dim {meta['dim']}, expected {dim}")
+            self._count = meta["count"]
+            self._capacity = meta["capacity"]
+            self._indexed_count = meta.get("indexed_count", 0)
+        else:
+            self._count = 0
+            self._capacity = initial_capacity
+            self._indexed_count = 0
+            for path, itemsize in self._files():
+                with open(path, "wb") as f:
+                    f.truncate(self._capacity * itemsize)
+            self._write_meta()
+
+        self._open_maps()
+        self._load_index()
+
+    def _files(self):
+        return [
+            (self._vectors_path, self.dim * 4),
+            (self._norms_path, 4),
+            (self._keys_path, 8),
+            (self._assign_path, 4),
+        ]
+
+    def _open_maps(self):
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r+", shape=(self._capacity, self.dim))
+        self._norms = np.memmap(self._norms_path, dtype=np.float32, mode="r+", shape=(self._capacity,))
+        self._keys = np.memmap(self._keys_path, dtype=np.int64, mode="r+", shape=(self._capacity,))
+        self._assign = np.memmap(self._assign_path, dtype=np.int32, mode="r+", shape=(self._capacity,))
+
+    def _write_meta(self):
+        tmp_path = self._meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "dim": self.dim,
+                "count": self._count,
+                "capacity": self._capacity,
+                "indexed_count": self._indexed_count,
+            }, f)
+        os.replace(tmp_path, self._meta_path)
+
+    def _grow(self, needed: int):
+        capacity = self._capacity
+        while capacity < needed:
+            capacity *= 2
+        for name in ("_vectors", "_norms", "_keys", "_assign"):
+            getattr(self, name).flush()
+        for path, itemsize in self._files():
+            with open(path, "r+b") as f:
+                f.truncate(capacity * itemsize)
+        self._capacity = capacity
+        self._open_maps()
+
+    def __len__(self):
+        return self._count
+
+    def add(self, vector, key: int):
+        return self.add_many(np.asarray(vector).reshape(1, -1), [key])[0]
+
+    def add_many(self, vectors, keys):
+        """
+        Append vectors (shape [n, dim]) with their keys. Returns the bank rows
+        they were written to. New rows are routed into the existing index so
+        no rebuild is needed.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if len(vectors) != len(keys):
+            raise ValueError("vectors and keys must have the same length")
+
+        with self._lock:
+            start = self._count
+            end = start + len(vectors)
+            if end > self._capacity:
+                self._grow(end)
+
+            norms = np.linalg.norm(vectors, axis=1)
+            self._vectors[start:end] = vectors
+            self._norms[start:end] = norms
+            self._keys[start:end] = np.asarray(keys, dtype=np.int64)
+
+            if self._centroids is not None:
+                assignments = self._nearest_centroids(vectors, norms, 1)[:, 0]
+                self._assign[start:end] = assignments
+                for row, centroid in zip(range(start, end), assignments):
+                    self._lists[int(centroid)].append(row)
+
+            for name in ("_vectors", "_norms", "_keys", "_assign"):
+                getattr(self, name).flush()
+            # Only publish the new count once the rows are on disk
+            self._count = end
+            self._write_meta()
+            return list(range(start, end))
+
+    def keys(self, rows):
+        return np.asarray(self._keys[np.asarray(rows, dtype=np.int64)])
+
+    def vectors(self, rows):
+        return np.asarray(self._vectors[np.asarray(rows, dtype=np.int64)])
+
+    def _score_rows(self, query_unit, rows):
+        vectors = self._vectors[rows]
+        norms = self._norms[rows]
+        norms = np.where(norms == 0, 1.0, norms)
+        return (vectors @ query_unit) / norms
+
+    def _score_range(self, query_unit, start, end):
+        norms = self._norms[start:end]
+        norms = np.where(norms == 0, 1.0, norms)
+        return (self._vectors[start:end] @ query_unit) / norms
+
+    @staticmethod
+    def _merge_top_k(best_rows, best_scores, rows, scores, k):
+        rows = np.concatenate([best_rows, rows])
+        scores = np.concatenate([best_scores, scores])
+        if len(scores) > k:
+            keep = np.argpartition(-scores, k - 1)[:k]
+            rows, scores = rows[keep], scores[keep]
+        return rows, scores
+
+    def search(self, query, k: int = 5, approximate: bool = False, exclude_keys=None):
+        """
+        Return (rows, scores) of the k most cosine-similar vectors, best first.
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        wanted = k
+        if exclude_keys is not None:
+            exclude_keys = np.asarray(list(exclude_keys), dtype=np.int64)
+            k += len(exclude_keys)
+        query_norm = np.linalg.norm(query)
+        query_unit = query / (query_norm if query_norm > 0 else 1.0)
+
+        with self._lock:
+            count = self._count
+            if count == 0 or wanted <= 0:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+            if approximate and count >= MIN_INDEX_ROWS and (
+                    self._centroids is None or count > 4 * self._indexed_count):
+                self.build_index()
+            use_index = approximate and self._centroids is not None
+            if use_index:
+                probes = self._nearest_centroids(query.reshape(1, -1), np.array([query_norm]), self.nprobe)[0]
+                candidates = np.concatenate([np.asarray(self._lists[int(c)], dtype=np.int64) for c in probes])
+
+        best_rows = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        if use_index:
+            candidates.sort()
+            for start in range(0, len(candidates), SEARCH_CHUNK_ROWS):
+                rows = candidates[start:start + SEARCH_CHUNK_ROWS]
+                best_rows, best_scores = self._merge_top_k(
+                    best_rows, best_scores, rows, self._score_rows(query_unit, rows), k)
+        else:
+            for start in range(0, count, SEARCH_CHUNK_ROWS):
+                end = min(start + SEARCH_CHUNK_ROWS, count)
+                best_rows, best_scores = self._merge_top_k(
+                    best_rows, best_scores, np.arange(start, end), self._score_range(query_unit, start, end), k)
+
+        if exclude_keys is not None and len(best_rows):
+            keep = ~np.isin(self.keys(best_rows), exclude_keys)
+            best_rows, best_scores = best_rows[keep], best_scores[keep]
+
+        order = np.argsort(-best_scores, kind="stable")[:wanted]
+        return best_rows[order], best_scores[order]
+
+    def _nearest_centroids(self, vectors, norms, n):
+        norms = np.where(norms == 0, 1.0, norms)
+        sims = (vectors / norms[:, None]) @ self._centroids.T
+        n = min(n, sims.shape[1])
+        top = np.argpartition(-sims, n - 1, axis=1)[:, :n]
+        return top.astype(np.int32)
+
+    def _load_index(self):
+        self._centroids = None
+        self._lists = None
+        if self._indexed_count and os.path.exists(self._centroids_path):
+            self._centroids = np.load(self._centroids_path)
+            self._rebuild_lists()
+
+    def _rebuild_lists(self):
+        assignments = np.asarray(self._assign[:self._count])
+        order = np.argsort(assignments, kind="stable")
+        bounds = np.searchsorted(assignments[order], np.arange(len(self._centroids) + 1))
+        self._lists = [order[bounds[c]:bounds[c + 1]].tolist() for c in range(len(self._centroids))]
+
+    def build_index(self, nlist: int = None, iterations: int = 10, sample_size: int = 20000, seed: int = 0):
+        """
+        Train the approximate index with spherical k-means on a sample of the
+        bank and assign every row to its nearest centroid.
+        """
+        with self._lock:
+            count = self._count
+            if count == 0:
+                return
+            nlist = nlist or max(1, int(np.sqrt(count)))
+            rng = np.random.default_rng(seed)
+            sample_rows = np.sort(rng.choice(count, size=min(sample_size, count), replace=False))
+            sample = np.asarray(self._vectors[sample_rows])
+            sample /= np.maximum(np.linalg.norm(sample, axis=1, keepdims=True), 1e-12)
+
+            centroids = sample[rng.choice(len(sample), size=min(nlist, len(sample)), replace=False)]
+            for _ in range(iterations):
+                labels = np.argmax(sample @ centroids.T, axis=1)
+                for c in range(len(centroids)):
+                    members = sample[labels == c]
+                    if len(members):
+                        centroid = members.sum(axis=0)
+                        centroids[c] = centroid / max(np.linalg.norm(centroid), 1e-12)
+
+            self._centroids = centroids.astype(np.float32)
+            for start in range(0, count, SEARCH_CHUNK_ROWS):
+                end = min(start + SEARCH_CHUNK_ROWS, count)
+                self._assign[start:end] = self._nearest_centroids(
+                    np.asarray(self._vectors[start:end]), np.asarray(self._norms[start:end]), 1)[:, 0]
+            self._assign.flush()
+            np.save(self._centroids_path, self._centroids)
+            self._indexed_count = count
+            self._write_meta()
+            self._rebuild_lists()
+
+    def info(self):
+        return {
+            "size": self._count,
+            "capacity": self._capacity,
+            "indexed": self._centroids is not None,
+            "nlist": 0 if self._centroids is None else len(self._centroids),
+        }
+
+
+_bank = None
+_bank_lock = threading.Lock()
+
+
+def get_feature_bank():
+    global _bank
+    if _bank is None:
+        with _bank_lock:
+            if _bank is None:
+                _bank = FeatureBank()
+    return _bank
@@ -0,0 +1,160 @@
+import base64
+import hashlib
+import json
+from datetime import datetime
+
+# Columns of fmri_history a history page may ask for
+HISTORY_COLUMNS = {
+    "fmri_id", "user_id", "date", "file_link", "description", "title",
+    "gender", "age", "diagnosis", "atlas", "model_result",
+}
+# What the history table shows when no `fields` are given
+DEFAULT_HISTORY_COLUMNS = ("fmri_id", "date", "title", "gender", "age", "diagnosis", "atlas", "model_result")
+# Orders a page can be sorted by; each ends in (date, fmri_id) so it is a total order for keyset paging
+HISTORY_SORTS = {
+    "newest": (("date", "desc"), ("fmri_id", "desc")),
+    "prediction_asc": (("model_result", "asc"), ("date", "desc"), ("fmri_id", "desc")),
+    "prediction_desc": (("model_result", "desc"), ("date", "desc"), ("fmri_id", "desc")),
+}
+DEFAULT_HISTORY_SORT = "newest"
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def parse_fields(fields: str = None):
+    """
+    Requested columns, validated, always including the keyset columns.
+    Raises ValueError for unknown columns.
+    """
+    if not fields:
+        columns = list(DEFAULT_HISTORY_COLUMNS)
+    else:
+        columns = [column.strip() for column in fields.split(",") if column.strip()]
+        unknown = [column for column in columns if column not in HISTORY_COLUMNS]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    for column in ("fmri_id", "date", "model_result"):
+        if column not in columns:
+            columns.append(column)
+    return columns
+
+
+def parse_sort(sort: str = None):
+    """
+    The sort keys for `sort`. Raises ValueError for an unknown sort.
+    """
+    sort = sort or DEFAULT_HISTORY_SORT
+    if sort not in HISTORY_SORTS:
+        raise ValueError(f"Unknown sort {sort}, expected one of {', '.join(HISTORY_SORTS)}")
+    return HISTORY_SORTS[sort]
+
+
+def history_order(keys):
+    return ",".join(f"{column}.{direction}" for column, direction in keys)
+
+
+def parse_date(value: str, name: str):
+    """
+    `value` if it is an ISO 8601 date or timestamp. Raises ValueError
+    otherwise, before it can reach the database as a malformed filter.
+    """
+    try:
+        datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid {name}: expected an ISO 8601 date")
+    return value
+
+
+def encode_cursor(row: dict, keys=HISTORY_SORTS[DEFAULT_HISTORY_SORT]):
+    raw = json.dumps([row[column] for column, _ in keys]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, keys=HISTORY_SORTS[DEFAULT_HISTORY_SORT]):
+    """
+    Values of the sort keys on the last row of the previous page. Raises
+    ValueError for a malformed cursor or one from a different sort.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+        if len(values) != len(keys):
+            raise ValueError
+        return [parse_date(value, "cursor") if column == "date" else int(value)
+                for (column, _), value in zip(keys, values)]
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def _quote(value: str):
+    # PostgREST logic trees need values with reserved characters double-quoted
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _after(keys, values):
+    """
+    PostgREST condition for rows after `values` in the order of `keys`:
+    for some key, all earlier keys are equal and this one is past its value.
+    """
+    branches = []
+    for i, (column, direction) in enumerate(keys):
+        operator = "lt" if direction == "desc" else "gt"
+        terms = [f"{c}.eq.{_quote(v)}" for (c, _), v in zip(keys[:i], values[:i])]
+        terms.append(f"{column}.{operator}.{_quote(values[i])}")
+        branches.append(terms[0] if len(terms) == 1 else f"and({','.join(terms)})")
+    return ",".join(branches)
+
+
+def _search(query: str):
+    # Same fields the history page searched client-side: title, diagnosis and ID
+    pattern = _quote(f"*{query}*")
+    branches = [f"title.ilike.{pattern}", f"diagnosis.ilike.{pattern}"]
+    if query.isdigit():
+        branches.append(f"fmri_id.eq.{int(query)}")
+    return ",".join(branches)
+
+
+def history_query(user_id: str, cursor: str = None, diagnosis: str = None, atlas: str = None,
+                  date_from: str = None, date_to: str = None, search: str = None,
+                  keys=HISTORY_SORTS[DEFAULT_HISTORY_SORT]):
+    """
+    (filters, extra params) for one page of a user's history in the order
+    of `keys`. Rows after the cursor are selected by comparing the sort
+    keys, so for the default (date, fmri_id) order the (user_id, date,
+    fmri_id) index serves a page directly however deep it is. Raises
+    ValueError for a malformed date or cursor.
+    """
+    filters = [("user_id", "eq", user_id)]
+    if diagnosis:
+        filters.append(("diagnosis", "eq", diagnosis))
+    if atlas:
+        filters.append(("atlas", "eq", atlas))
+    if date_from:
+        filters.append(("date", "gte", parse_date(date_from, "date_from")))
+    if date_to:
+        filters.append(("date", "lte", parse_date(date_to, "date_to")))
+
+    conditions = []
+    if cursor:
+        conditions.append(_after(keys, decode_cursor(cursor, keys)))
+    if search and search.strip():
+        conditions.append(_search(search.strip()))
+
+    params = []
+    if len(conditions) == 1:
+        params.append(("or", f"({conditions[0]})"))
+    elif conditions:
+        params.append(("and", f"({','.join(f'or({condition})' for condition in conditions)})"))
+    return filters, params
+
+
+def history_etag(body: dict):
+    digest = hashlib.sha1(json.dumps(body, sort_keys=True, default=str).encode()).hexdigest()
+    return f'"{digest}"'
+
+
+def etag_matches(if_none_match: str, etag: str):
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or any(tag.removeprefix("W/") == etag for tag in candidates)
@@ -0,0 +1,204 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import log_event
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+MAX_QUEUED_JOBS = int(os.getenv("MAX_QUEUED_JOBS", "64"))
+# Finished jobs kept around for /api/jobs/{id} lookups
+MAX_FINISHED_JOBS = int(os.getenv("MAX_FINISHED_JOBS", "1000"))
+
+UPLOAD_STAGES = ["stored", "masked", "connectome", "predicted", "inserted"]
+DICOM_UPLOAD_STAGES = ["stored", "converted", "masked", "connectome", "predicted", "inserted"]
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, job_id: str, stages):
+        self.id = job_id
+        self.status = "queued"
+        self.stages = list(stages)
+        self.completed_stages = []
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self._subscribers = []
+        # Held so the running task isn't garbage-collected mid-run
+        self._task = None
+
+    @property
+    def finished(self):
+        return self.status in ("succeeded", "failed")
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "stage": self.completed_stages[-1]["stage"] if self.completed_stages else None,
+            "stages": self.completed_stages,
+            "progress": len(self.completed_stages) / len(self.stages) if self.stages else 0,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+
+class JobManager:
+    """
+    Runs upload pipelines as background asyncio tasks. CPU-heavy steps are
+    sent to a bounded process pool through `run_cpu`; the number of pipelines
+    in flight is capped at the pool size and the rest wait in the queue.
+    """
+
+    def __init__(self, max_workers: int = JOB_WORKERS, max_queued: int = MAX_QUEUED_JOBS):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self._executor = None
+        self._slots = None
+        self._jobs = OrderedDict()
+        self._queued = 0
+        self._running = 0
+        self._busy_workers = 0
+
+    def start(self):
+        # spawn, not fork: forking a process that already holds torch/BLAS
+        # thread pools can deadlock the children
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        self._slots = asyncio.Semaphore(self.max_workers)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    @property
+    def executor(self):
+        """
+        The shared worker pool, for CPU-heavy code that drives it from a
+        thread rather than through `run_cpu`.
+        """
+        return self._executor
+
+    def get(self, job_id: str):
+        return self._jobs.get(job_id)
+
+    def submit(self, pipeline, *args, stages=UPLOAD_STAGES, ready=None):
+        """
+        Create a job and schedule `pipeline(job, *args)` on the event loop.
+        `ready(job)`, if given, is awaited first without holding a pipeline
+        slot (e.g. storage still receiving the upload); if it raises, the
+        job fails. Raises QueueFullError if too many jobs are already waiting.
+        """
+        if self._queued >= self.max_queued:
+            raise QueueFullError("Too many jobs waiting, try again later")
+
+        job = Job(str(uuid.uuid4()), stages)
+        self._jobs[job.id] = job
+        self._queued += 1
+        job._task = asyncio.create_task(self._run(job, pipeline, *args, ready=ready))
+        return job
+
+    async def _run(self, job, pipeline, *args, ready=None):
+        queued = True
+        try:
+            if ready is not None:
+                await ready(job)
+            async with self._slots:
+                self._queued -= 1
+                queued = False
+                self._running += 1
+                self._set(job, status="running")
+                try:
+                    job.result = await pipeline(job, *args)
+                    self._set(job, status="succeeded")
+                finally:
+                    self._running -= 1
+        except Exception as e:
+            job.error = str(e)
+            self._set(job, status="failed")
+            log_event("job_failed", job=job.id, error=repr(job.error))
+        finally:
+            if queued:
+                self._queued -= 1
+            self._evict_finished()
+
+    async def run_cpu(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        self._busy_workers += 1
+        try:
+            return await loop.run_in_executor(self._executor, fn, *args)
+        finally:
+            self._busy_workers -= 1
+
+    def stage(self, job, stage: str, **details):
+        job.completed_stages.append({"stage": stage, "at": time.time(), **details})
+        self._set(job)
+
+    def _set(self, job, status: str = None):
+        if status:
+            job.status = status
+        job.updated_at = time.time()
+        event = job.to_dict()
+        for queue in list(job._subscribers):
+            queue.put_nowait(event)
+
+    def _evict_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    async def events(self, job):
+        """
+        Server-sent events for one job: the current state first, then one
+        event per change until the job finishes.
+        """
+        queue = asyncio.Queue()
+        job._subscribers.append(queue)
+        try:
+            yield self._format_event(job.to_dict())
+            if job.finished:
+                return
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    # Keep-alive comment so proxies don't close the stream
+                    yield ": keep-alive\n\n"
+                    continue
+                yield self._format_event(event)
+                if event["status"] in ("succeeded", "failed"):
+                    return
+        finally:
+            job._subscribers.remove(queue)
+
+    @staticmethod
+    def _format_event(event):
+        name = "done" if event["status"] in ("succeeded", "failed") else "progress"
+        return f"event: {name}\ndata: {json.dumps(event)}\n\n"
+
+    def stats(self):
+        return {
+            "queue_depth": self._queued,
+            "running": self._running,
+            "max_workers": self.max_workers,
+            "busy_workers": self._busy_workers,
+            "worker_utilization": self._busy_workers / self.max_workers if self.max_workers else 0,
+            "tracked_jobs": len(self._jobs),
+        }
+
+
+job_manager = JobManager()
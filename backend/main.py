@@ -1,3 +1,7 @@
+import asyncio
+import json
+import logging
+import time
 import httpx
 import joblib
 import nilearn
@@ -7,26 +11,54 @@ import numpy as np
 import nibabel as nib
 from scipy.ndimage import zoom
 from scipy.ndimage import gaussian_filter
-from nilearn.image import resample_to_img
 import uuid
+import shutil
 import os
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Depends
-from auth.auth import router as auth_router
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Depends, Request, WebSocket, WebSocketDisconnect, BackgroundTasks
+from auth.auth import router as auth_router, email_index, token_verifier, verify_access_token
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
-from src.plotlyViz.controller import get_slices
-from supabase import create_client, Client
+from src.plotlyViz.controller import extract_slices, slices_to_lists
+from src.plotlyViz.binary import SLICE_MEDIA_TYPE, INTENSITY_ENCODINGS, wants_binary, encode_slices
+from src.plotlyViz.session import SliceSession, AXES
+from supabase_async import AsyncSupabase, SupabaseError
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import StreamingResponse, Response, JSONResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.concurrency import run_in_threadpool
 import tempfile
-from typing import Optional
-from model import predict_from_nifti
-from nilearn.plotting import plot_anat, plot_stat_map
-import matplotlib.pyplot as plt
+from typing import List, Optional
+from model import (
+    predict_batch, load_model, model_status, model_retry_due, masker_cache_info, _nifti_suffix,
+    extract_time_series_in_worker, record_worker_stats, connectome_from_time_series, predict_in_neighbourhood,
+    get_stored_connectomes, repredict_stored,
+)
+from jobs import job_manager, QueueFullError, UPLOAD_STAGES, DICOM_UPLOAD_STAGES
+from feature_bank import get_feature_bank
+from volume_cache import volume_cache
+from nifti_store import nifti_store, ContentAddressedStaticFiles
+from overlay_cache import get_resampled_overlay, render_debug_overlay, DEFAULT_OVERLAY
+from zscore import get_patient_zscores
+from metadata_cache import fmri_metadata
+from chunked_upload import upload_sessions, MAX_UPLOAD_BYTES
+from upload_cache import upload_cache, file_sha256
+from dicom_series import dicom_series_to_nifti, is_dicom_upload, dicom_suffix
+import hashlib
+from pydantic import BaseModel
+from history import (
+    parse_fields, parse_sort, history_order, history_query, encode_cursor, history_etag, etag_matches,
+    DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE,
+)
+from metrics import (
+    registry, time_stage, log_event, Gauge,
+    BYTES, CACHE_REQUESTS, HTTP_IN_FLIGHT, HTTP_SECONDS,
+)
 
 load_dotenv()
 
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s %(message)s")
+
 # Supabase configuration
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY")
@@ -34,8 +66,8 @@ SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY")
 if not SUPABASE_URL or not SUPABASE_ANON_KEY:
     raise ValueError("Missing Supabase credentials")
 
-# Initialize Supabase client
-supabase = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
+# Shared async Supabase client (one keep-alive connection pool for the process)
+supabase = AsyncSupabase(SUPABASE_URL, SUPABASE_ANON_KEY)
 
 app = FastAPI()
 
@@ -49,40 +81,115 @@ app.add_middleware(
     expose_headers=["*"],
 )
 
+@app.middleware("http")
+async def track_requests(request: Request, call_next):
+    HTTP_IN_FLIGHT.inc()
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        HTTP_IN_FLIGHT.dec()
+        # Label by route template, not raw path, to keep the series count bounded
+        route = request.scope.get("route")
+        HTTP_SECONDS.observe(time.perf_counter() - started, method=request.method,
+                             route=getattr(route, "path", "unmatched"), status=status)
+
+
 # Include the auth router
 app.include_router(auth_router, prefix="/api", tags=["authentication"])
 
-app.mount("/api/nifti_files", StaticFiles(directory="nifti_files"), name="nifti_files")
+app.mount("/api/nifti_files", ContentAddressedStaticFiles(directory=nifti_store.directory), name="nifti_files")
 app.mount("/api/overlay_file", StaticFiles(directory="overlay_file"), name="overlay_file")
 
 # Auth dependency
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 
 # Get supabase client with user token for authenticated requests
 
 
-def get_supabase_client(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Client:
-    supabase.auth.set_auth(credentials.credentials)
-    return supabase
+async def get_supabase_client(credentials: HTTPAuthorizationCredentials = Depends(security)) -> AsyncSupabase:
+    # Reject bad tokens here (verified locally) rather than on the first query
+    await verify_access_token(credentials.credentials)
+    # Per-request view carrying the user's token; the shared client is not modified
+    return supabase.with_auth(credentials.credentials)
 
 # For non-authenticated endpoints
 
 
-def get_public_client():
+def get_public_client() -> AsyncSupabase:
     return supabase
 
 
+async def download_scan(client: AsyncSupabase, file_name: str):
+    """
+    Bytes of an uploaded scan from Supabase storage.
+    """
+    with time_stage("storage_download"):
+        file_bytes = await client.download("fmri-uploads", file_name)
+    BYTES.inc(len(file_bytes), transfer="storage_download")
+    return file_bytes
+
+
+def scan_downloader(client: AsyncSupabase, file_name: str):
+    """
+    Loader for the volume cache, which calls it from a worker thread: the
+    download itself runs on the event loop (and its connection pool) while
+    the worker waits.
+    """
+    loop = asyncio.get_running_loop()
+
+    def download(dest_path: str):
+        file_bytes = asyncio.run_coroutine_threadsafe(download_scan(client, file_name), loop).result()
+        with open(dest_path, "wb") as f:
+            f.write(file_bytes)
+    return download
+
+
+# Render debug_overlay.png for every 3D view (also available per request with ?debug=true)
+DEBUG_OVERLAY = os.getenv("DEBUG_OVERLAY", "0") == "1"
+
 # File upload constants
-ALLOWED_EXTENSIONS = {"nii", "nii.gz", "DCM"}
+ALLOWED_EXTENSIONS = {"nii", "nii.gz", "DCM", "dcm", "zip"}
 ALLOWED_MIME_TYPES = {
     "application/gzip",
     "application/octet-stream",
     "application/dicom",
     "image/dicom",
-    "application/x-gzip"
+    "application/x-gzip",
+    "application/zip",
+    "application/x-zip-compressed"
 }
 
 
+def _log_model_load(future):
+    if not future.cancelled() and future.exception() is not None:
+        # model_status() keeps the error for /api/ready; this retrieves it so it's logged once
+        log_event("model_load_failed", error=repr(str(future.exception())))
+
+
+@app.on_event("startup")
+async def start_background_work():
+    # Load the GNN weights in the background so /api/health answers immediately;
+    # /api/ready reports once the model is usable.
+    loop = asyncio.get_running_loop()
+    app.state.model_loading = loop.run_in_executor(None, load_model)
+    app.state.model_loading.add_done_callback(_log_model_load)
+    job_manager.start()
+    token_verifier.start()
+    upload_sessions.start(supabase)
+
+
+@app.on_event("shutdown")
+async def stop_workers():
+    job_manager.shutdown()
+    token_verifier.stop()
+    await supabase.aclose()
+
+
 @app.get("/api/hello")
 async def hello():
     return {"message": "Hello from FastAPI!"}
@@ -92,7 +199,202 @@ async def hello():
 async def health_check():
     return {"status": "healthy"}
 
-@app.post("/api/upload")
+
+@app.get("/api/ready")
+async def readiness_check():
+    status = model_status()
+    if not status["ready"]:
+        if model_retry_due() and app.state.model_loading.done():
+            # Readiness probes keep retrying a failed load, with backoff
+            app.state.model_loading = asyncio.get_running_loop().run_in_executor(None, load_model)
+            app.state.model_loading.add_done_callback(_log_model_load)
+        raise HTTPException(status_code=503, detail={"model": status})
+    return {"status": "ready", "model": status}
+
+
+def _cache_stats():
+    return {
+        "masker": masker_cache_info(),
+        "feature_bank": get_feature_bank().info(),
+        "volumes": volume_cache.info(),
+        "nifti_store": nifti_store.info(),
+        "connectomes": get_stored_connectomes().info(),
+        "fmri_metadata": fmri_metadata.info(),
+        "email_index": email_index.info(),
+        "tokens": token_verifier.info(),
+        "uploads": upload_sessions.info(),
+        "upload_cache": upload_cache.info(),
+    }
+
+
+@app.get("/api/cache-stats")
+async def cache_stats():
+    return _cache_stats()
+
+
+def _state_gauges():
+    """
+    Scrape-time gauges from the caches' and job manager's own counters.
+    """
+    caches = Gauge("cnh_cache_stat", "Cache statistics as reported by each cache", ["cache", "field"])
+    for cache, info in _cache_stats().items():
+        for field, value in info.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                caches.set(value, cache=cache, field=field)
+    jobs = Gauge("cnh_jobs", "Upload job manager state", ["field"])
+    for field, value in job_manager.stats().items():
+        jobs.set(value, field=field)
+    return [caches, jobs]
+
+
+registry.add_collector(_state_gauges)
+
+
+@app.get("/api/metrics")
+async def metrics():
+    return Response(content=registry.render(), media_type="text/plain; version=0.0.4")
+
+async def _predict_upload(job, temp_file_path: str):
+    """
+    Mask, connectome and predict a freshly uploaded scan. Returns
+    (model_result, time_series, connectome); model_result is -1 and the
+    features None if any step fails.
+    """
+    try:
+        # Masking runs in a worker process; its inner stages are replayed
+        # below, and the whole hand-off (queueing included) is timed here
+        with time_stage("upload_mask"):
+            time_series, worker_stats = await job_manager.run_cpu(extract_time_series_in_worker, temp_file_path)
+        # The worker's masker cache and stage metrics live in its own process
+        record_worker_stats(worker_stats)
+        job_manager.stage(job, "masked")
+
+        connectome = connectome_from_time_series(time_series)
+        job_manager.stage(job, "connectome")
+
+        return await run_in_threadpool(predict_in_neighbourhood, connectome), time_series, connectome
+    except Exception as pred_error:
+        log_event("upload_predict_failed", job=job.id, error=repr(str(pred_error)))
+        return -1, None, None  # Default value if prediction fails
+
+
+async def _convert_dicom_upload(job, source_path: str, fmri_data: dict):
+    """
+    Turn an uploaded DICOM series into the NIfTI that masking and the
+    viewers read, and store it. Returns the NIfTI's path and fmri_data
+    pointing at the stored NIfTI; the DICOM upload itself is removed.
+    """
+    nifti_path = f"{os.path.splitext(source_path)[0]}.nii"
+    try:
+        with time_stage("dicom_convert"):
+            # Shares the job manager's process pool rather than starting one per upload
+            shape = await run_in_threadpool(dicom_series_to_nifti, source_path, nifti_path,
+                                            job_manager.executor, job_manager.max_workers)
+        file_link = f"{uuid.uuid4()}.nii"
+        with time_stage("storage_put"):
+            await supabase.upload_file("fmri-uploads", file_link, nifti_path)
+        BYTES.inc(os.path.getsize(nifti_path), transfer="storage_put")
+    except Exception:
+        if os.path.exists(nifti_path):
+            os.unlink(nifti_path)
+        raise
+    finally:
+        os.unlink(source_path)
+    job_manager.stage(job, "converted", file_path=file_link, shape=list(shape))
+    return nifti_path, {**fmri_data, "file_link": file_link}
+
+
+async def run_upload_pipeline(job, temp_file_path: str, fmri_data: dict, content_hash: str = None,
+                              cached: dict = None):
+    """
+    Background part of an upload: mask, connectome, predict, insert. A scan
+    whose content hash already has a recorded result (`cached`) skips
+    straight to the insert. The temporary copy of the scan is removed when
+    the job ends.
+    """
+    client = supabase
+    try:
+        reused = cached is not None and cached.get("model_result") is not None
+        if reused:
+            model_result, time_series, connectome = cached["model_result"], None, None
+            fmri_data = {**fmri_data, "file_link": cached["file_link"]}
+            log_event("upload_result_reused", job=job.id, source_fmri_id=cached["fmri_id"])
+        else:
+            if is_dicom_upload(temp_file_path):
+                temp_file_path, fmri_data = await _convert_dicom_upload(job, temp_file_path, fmri_data)
+            model_result, time_series, connectome = await _predict_upload(job, temp_file_path)
+        job_manager.stage(job, "predicted", model_result=model_result)
+
+        fmri_data = {**fmri_data, "model_result": model_result}
+
+        with time_stage("db_insert"):
+            rows = await client.insert("fmri_history", fmri_data)
+
+        if not rows:
+            raise RuntimeError("Failed to retrieve inserted record ID")
+
+        fmri_id = rows[0]['fmri_id']
+        fmri_metadata.prime(rows[0])
+        if connectome is not None:
+            # Grow the population graph used for future predictions
+            await run_in_threadpool(get_feature_bank().add, connectome, fmri_id)
+            # Keep the features so the scan can be re-scored or analysed without re-masking
+            with time_stage("feature_store_put"):
+                await run_in_threadpool(get_stored_connectomes().put, fmri_id, time_series, connectome)
+            if content_hash:
+                await asyncio.to_thread(upload_cache.put_result, content_hash, model_result, fmri_id,
+                                        fmri_data["file_link"])
+        elif reused:
+            # Same features as the original scan; it is already in the feature
+            # bank, where a second copy would only be its own nearest neighbour
+            with time_stage("feature_store_put"):
+                await run_in_threadpool(_copy_stored_connectome, cached["fmri_id"], fmri_id)
+        job_manager.stage(job, "inserted", fmri_id=fmri_id)
+        log_event("upload_done", job=job.id, fmri_id=fmri_id, model_result=model_result,
+                  file=fmri_data["file_link"], reused=reused)
+
+        return {
+            "fmri_id": fmri_id,
+            "file_path": fmri_data["file_link"],
+            "model_result": model_result
+        }
+    finally:
+        if os.path.exists(temp_file_path):
+            os.unlink(temp_file_path)
+
+
+def _upload_stages(filename: str, cached: dict):
+    if is_dicom_upload(filename) and (cached is None or cached.get("model_result") is None):
+        return DICOM_UPLOAD_STAGES
+    return UPLOAD_STAGES
+
+
+def _scan_suffix(filename: str):
+    return dicom_suffix(filename) if is_dicom_upload(filename) else _nifti_suffix(filename)
+
+
+def _copy_stored_connectome(source_fmri_id: int, fmri_id: int):
+    store = get_stored_connectomes()
+    features = store.get(source_fmri_id)
+    if features is not None and features["time_series"] is not None:
+        store.put(fmri_id, features["time_series"], features["correlations"])
+
+
+def _upload_extension(filename: str, mime_type: str):
+    """
+    The extension of an allowed scan upload; 400 otherwise.
+    """
+    file_extension = filename.split('.', 1)[1] if "." in filename else ""
+    if str(file_extension) not in ALLOWED_EXTENSIONS or mime_type not in ALLOWED_MIME_TYPES:
+        log_event("upload_rejected", filename=repr(filename), mime_type=mime_type)
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid file type. Allowed: {', '.join(ALLOWED_EXTENSIONS)}"
+        )
+    return file_extension
+
+
+@app.post("/api/upload", status_code=202)
 async def upload_fmri(
     user_id: str = Form(...),
     title: str = Form(...),
@@ -103,77 +405,39 @@ async def upload_fmri(
     atlas: str = Form(None),
     file: UploadFile = File(...),
 ):
-    print(f"[UPLOAD] Starting upload process for file: {file.filename}")
-    print(f"[UPLOAD] File size: {file.size if hasattr(file, 'size') else 'unknown'} bytes")
-    print(f"[UPLOAD] Content type: {file.content_type}")
-
     client = supabase
-    if "." in file.filename:
-        file_extension = file.filename.split('.', 1)[1]
-    else:
-        file_extension = ""
-
-    mime_type = file.content_type
-    print(f"[UPLOAD] File extension: {file_extension}, MIME type: {mime_type}")
-    if str(file_extension) not in ALLOWED_EXTENSIONS or mime_type not in ALLOWED_MIME_TYPES:
-        print(f"[UPLOAD] Invalid file type: {mime_type}, extension: {file_extension}")
-        raise HTTPException(
-            status_code=400,
-            detail=f"Invalid file type. Allowed: {', '.join(ALLOWED_EXTENSIONS)}"
-        )
+    file_extension = _upload_extension(file.filename, file.content_type)
 
     try:
-        unique_filename = f"{uuid.uuid4()}.{file_extension}"
-        print(f"[UPLOAD] Generated unique filename: {unique_filename}")
-
-        # Create a temporary file to stream the upload
-        print(f"[UPLOAD] Creating temporary file for streaming")
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        # Create a temporary file to stream the upload, hashing it in the same
+        # pass; the predictor later reads this same file in place
+        with time_stage("upload_read"), \
+                tempfile.NamedTemporaryFile(delete=False, suffix=_scan_suffix(file.filename)) as temp_file:
+            temp_file_path = temp_file.name
             # Stream the file content in chunks to avoid memory issues
             chunk_size = 1024 * 1024  # 1MB chunks
             total_bytes = 0
-            print(f"[UPLOAD] Starting to read file in {chunk_size/1024/1024}MB chunks")
+            digest = hashlib.sha256()
             while content := await file.read(chunk_size):
                 temp_file.write(content)
+                digest.update(content)
                 total_bytes += len(content)
-                print(f"[UPLOAD] Read {total_bytes/1024/1024:.2f}MB so far")
-            
-            temp_file.flush()
-            temp_file_path = temp_file.name
-            print(f"[UPLOAD] Completed reading file, total size: {total_bytes/1024/1024:.2f}MB")
-            print(f"[UPLOAD] Temporary file created at: {temp_file_path}")
-        
-        # Upload using the temporary file
-        print(f"[UPLOAD] Starting upload to Supabase storage")
-        with open(temp_file_path, "rb") as file_stream:
-            print(f"[UPLOAD] File opened for reading, uploading to bucket: fmri-uploads")
-            storage_response = client.storage.from_("fmri-uploads").upload(
-                path=unique_filename,
-                file=file_stream,
-                file_options={"content-type": file.content_type}
-            )
-            print(f"[UPLOAD] Supabase storage response: {storage_response}")
-        
-        # Run model prediction on the file
-        print(f"[UPLOAD] Running model prediction on the file")
-        try:
-            # Read file content for prediction
-            with open(temp_file_path, "rb") as file_content:
-                file_bytes = file_content.read()
-                
-            # Run prediction
-            model_result = predict_from_nifti(file_bytes, file.filename)
-            print(f"[UPLOAD] Model prediction result: {model_result}")
-        except Exception as pred_error:
-            print(f"[UPLOAD] Error during model prediction: {str(pred_error)}")
-            model_result = -1  # Default value if prediction fails
-            print(f"[UPLOAD] Using default model result: {model_result}")
-        
-        # Clean up the temporary file
-        if os.path.exists(temp_file_path):
-            print(f"[UPLOAD] Cleaning up temporary file: {temp_file_path}")
-            os.unlink(temp_file_path)
-            print(f"[UPLOAD] Temporary file deleted")
+        BYTES.inc(total_bytes, transfer="upload_read")
+        content_hash = digest.hexdigest()
+
+        cached = upload_cache.get(content_hash)
+        if cached is not None:
+            # Identical bytes are already in storage
+            unique_filename = cached["file_link"]
+            CACHE_REQUESTS.inc(cache="upload_object", result="hit")
+        else:
+            CACHE_REQUESTS.inc(cache="upload_object", result="miss")
+            unique_filename = f"{uuid.uuid4()}.{file_extension}"
+            # Upload using the temporary file
+            with time_stage("storage_put"):
+                await client.upload_file("fmri-uploads", unique_filename, temp_file_path, file.content_type)
+            BYTES.inc(total_bytes, transfer="storage_put")
+            await asyncio.to_thread(upload_cache.put_object, content_hash, unique_filename, total_bytes)
 
         fmri_data = {
             "user_id": user_id,
@@ -183,164 +447,512 @@ async def upload_fmri(
             "age": age,
             "diagnosis": diagnosis,
             "atlas": atlas,
-            "model_result": model_result,
             "file_link": unique_filename
         }
 
-        print(f"[UPLOAD] Inserting data into fmri_history table: {fmri_data}")
-        result = client.table("fmri_history").insert(fmri_data).execute()
-        print(f"[UPLOAD] Database insert result: {result}")
-
-        if result.data and len(result.data) > 0:
-            fmri_id = result.data[0]['fmri_id']
-            print(f"[UPLOAD] Upload successful, fmri_id: {fmri_id}")
-            return {
-                "message": "File uploaded successfully",
-                "fmri_id": fmri_id,
-                "file_path": unique_filename,
-                "model_result": model_result
-            }
-        else:
-            print("[UPLOAD] Failed to retrieve inserted record ID")
-            raise HTTPException(
-                status_code=500, detail="Failed to retrieve inserted record ID")
+        # The bytes are durably stored; the rest runs as a background job
+        job = job_manager.submit(run_upload_pipeline, temp_file_path, fmri_data, content_hash, cached,
+                                 stages=_upload_stages(file.filename, cached))
+        job_manager.stage(job, "stored", file_path=unique_filename)
+        log_event("upload_stored", job=job.id, file=unique_filename, bytes=total_bytes,
+                  deduplicated=cached is not None)
+
+        return {
+            "message": "File uploaded successfully",
+            "job_id": job.id,
+            "file_path": unique_filename,
+            "status_url": f"/api/jobs/{job.id}",
+            "events_url": f"/api/jobs/{job.id}/events"
+        }
 
     except Exception as e:
         # Clean up the temporary file if it exists
         if 'temp_file_path' in locals() and os.path.exists(temp_file_path):
             try:
-                print(f"[UPLOAD] Error occurred, cleaning up temporary file: {temp_file_path}")
                 os.unlink(temp_file_path)
             except Exception as cleanup_error:
-                print(f"[UPLOAD] Failed to delete temporary file: {cleanup_error}")
-        print(f"[UPLOAD] Error during upload: {str(e)}")
-        print(f"[UPLOAD] Error type: {type(e).__name__}")
-        import traceback
-        print(f"[UPLOAD] Error traceback: {traceback.format_exc()}")
+                log_event("upload_cleanup_failed", path=temp_file_path, error=repr(str(cleanup_error)))
+        logging.getLogger("cnh").exception("upload_failed filename=%r", file.filename)
+        if isinstance(e, QueueFullError):
+            raise HTTPException(status_code=503, detail=str(e))
         raise HTTPException(status_code=500, detail=str(e))
 
 
+class UploadInit(BaseModel):
+    user_id: str
+    title: str
+    description: str
+    gender: str
+    age: int
+    diagnosis: str
+    atlas: Optional[str] = None
+    filename: str
+    content_type: str
+    size: int
+
+
+def _upload_session(upload_id: str):
+    session = upload_sessions.get(upload_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return session
+
+
+@app.post("/api/uploads", status_code=201)
+async def create_upload(init: UploadInit):
+    """
+    Start a resumable upload. The client then PUTs `parts` parts of
+    `part_size` bytes (in any order, in parallel, retrying as needed) and
+    calls /complete; GET on the upload reports which parts are missing.
+    """
+    file_extension = _upload_extension(init.filename, init.content_type)
+    if init.size <= 0:
+        raise HTTPException(status_code=400, detail="File is empty")
+    if init.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"File is larger than {MAX_UPLOAD_BYTES} bytes")
+    fields = init.model_dump(exclude={"filename", "content_type", "size"})
+    session = upload_sessions.create(
+        init.filename, init.size, init.content_type, fields,
+        storage_path=f"{uuid.uuid4()}.{file_extension}",
+        suffix=_scan_suffix(init.filename),
+    )
+    log_event("upload_session_created", upload=session.id, bytes=init.size, parts=session.n_parts)
+    return session.to_dict()
+
+
+@app.get("/api/uploads/{upload_id}")
+async def get_upload(upload_id: str):
+    return _upload_session(upload_id).to_dict()
+
+
+@app.put("/api/uploads/{upload_id}/parts/{part_number}")
+async def put_upload_part(upload_id: str, part_number: int, request: Request):
+    session = _upload_session(upload_id)
+    if 0 <= part_number < session.n_parts:
+        start, end = session.part_range(part_number)
+        limit = end - start
+    else:
+        limit = session.part_size
+    # Read the body incrementally so an oversized part is refused before it is buffered
+    data = bytearray()
+    async for chunk in request.stream():
+        data += chunk
+        if len(data) > limit:
+            raise HTTPException(status_code=413, detail=f"Part {part_number} must be at most {limit} bytes")
+    try:
+        await upload_sessions.write_part(session, part_number, data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"part": part_number, "received_parts": len(session.received), "parts": session.n_parts}
+
+
+async def _wait_session_stored(job, session):
+    # Storage has every byte once the forwarder finishes the last chunk
+    if not await upload_sessions.wait_stored(session):
+        raise RuntimeError(f"Storing the upload failed: {session.error}")
+
+
+async def run_session_upload_pipeline(job, session):
+    """
+    Background part of a chunked upload, once storage holds every byte:
+    hash the spool file, then continue as run_upload_pipeline.
+    """
+    # Parts arrive out of order, so the hash needs one sequential read of the spool file
+    with time_stage("upload_hash"):
+        content_hash = await asyncio.to_thread(file_sha256, session.spool_path)
+    cached = upload_cache.get(content_hash)
+    await asyncio.to_thread(upload_cache.put_object, content_hash, session.storage_path, session.size)
+    # A reused DICOM result skips conversion
+    job.stages = list(_upload_stages(session.filename, cached))
+    job_manager.stage(job, "stored", file_path=session.storage_path)
+    # From here the spool file belongs to the pipeline
+    session.status = "completed"
+    session.save()
+    log_event("upload_stored", job=job.id, file=session.storage_path, bytes=session.size)
+
+    fmri_data = {**session.fields, "file_link": session.storage_path}
+    return await run_upload_pipeline(job, session.spool_path, fmri_data, content_hash, cached)
+
+
+@app.post("/api/uploads/{upload_id}/complete", status_code=202)
+async def complete_upload(upload_id: str):
+    """
+    Queue the upload's pipeline once every part has arrived. Returns the
+    job straight away; the job waits for the storage transfer to drain.
+    Completing a session whose storage transfer failed restarts it.
+    """
+    session = _upload_session(upload_id)
+    async with session.lock:
+        if session.status == "failed":
+            upload_sessions.retry(session)
+            session.job_id = None
+        # A job lost to a restart before storage finished is queued again
+        if session.job_id is None or (session.status != "completed" and job_manager.get(session.job_id) is None):
+            missing = session.missing_parts()
+            if missing:
+                raise HTTPException(status_code=409, detail={"missing_parts": missing})
+            try:
+                job = job_manager.submit(run_session_upload_pipeline, session,
+                                         stages=_upload_stages(session.filename, None),
+                                         ready=lambda job: _wait_session_stored(job, session))
+            except QueueFullError as e:
+                raise HTTPException(status_code=503, detail=str(e))
+            session.job_id = job.id
+            session.save()
+
+    return {
+        "message": "File uploaded successfully",
+        "job_id": session.job_id,
+        "file_path": session.storage_path,
+        "status_url": f"/api/jobs/{session.job_id}",
+        "events_url": f"/api/jobs/{session.job_id}/events"
+    }
+
+
+@app.get("/api/jobs/stats")
+async def job_stats():
+    return job_manager.stats()
+
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
+@app.get("/api/jobs/{job_id}/events")
+async def stream_job_events(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return StreamingResponse(
+        job_manager.events(job),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.post("/api/batch-predict")
+async def batch_predict(files: List[UploadFile] = File(...)):
+    """
+    Score many NIfTI scans in a single GCN pass over their population graph.
+    Nothing is stored; this is meant for cohort backfills.
+    """
+    temp_paths = []
+    try:
+        for upload in files:
+            with tempfile.NamedTemporaryFile(delete=False, suffix=_nifti_suffix(upload.filename)) as temp_file:
+                temp_paths.append(temp_file.name)
+                while content := await upload.read(1024 * 1024):
+                    temp_file.write(content)
+
+        results = await run_in_threadpool(predict_batch, temp_paths)
+
+        return {
+            "results": [
+                {
+                    "filename": upload.filename,
+                    "model_result": result["model_result"],
+                    "error": result["error"],
+                }
+                for upload, result in zip(files, results)
+            ]
+        }
+    except Exception as e:
+        log_event("batch_predict_failed", files=len(files), error=repr(str(e)))
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        for path in temp_paths:
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+@app.get("/api/connectome/{fmri_id}")
+async def get_connectome(fmri_id: int, include_time_series: bool = False):
+    """
+    Stored connectivity features of a processed scan.
+    """
+    features = await run_in_threadpool(get_stored_connectomes().get, fmri_id)
+    if features is None:
+        raise HTTPException(status_code=404, detail="No stored connectome for this scan")
+
+    response = {
+        "fmri_id": fmri_id,
+        "atlas": features["atlas"],
+        "correlations": features["correlations"].tolist(),
+    }
+    time_series = features["time_series"]
+    if time_series is not None:
+        response["time_series_shape"] = list(time_series.shape)
+        if include_time_series:
+            response["time_series"] = np.asarray(time_series).tolist()
+    return response
+
+
+@app.post("/api/model-prediction/{fmri_id}/rescore")
+async def rescore_model_prediction(
+    fmri_id: int,
+    save: bool = False,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security),
+):
+    """
+    Re-run the model on the stored connectome of a scan (e.g. after the
+    weights or the feature bank changed). With `save`, the new result is
+    written to the scan's history row (as its owner).
+    """
+    if save and credentials is None:
+        raise HTTPException(status_code=401, detail="Saving a rescore requires authentication")
+    model_result = await run_in_threadpool(repredict_stored, fmri_id)
+    if model_result is None:
+        raise HTTPException(status_code=404, detail="No stored connectome for this scan")
+    if save:
+        client = await get_supabase_client(credentials)
+        with time_stage("db_update"):
+            rows = await client.update("fmri_history", {"model_result": model_result}, [("fmri_id", "eq", fmri_id)])
+        if rows:
+            fmri_metadata.prime(rows[0])
+        else:
+            fmri_metadata.invalidate(fmri_id)
+    return {"fmri_id": fmri_id, "model_result": model_result, "saved": save}
+
+
 @app.get("/api/2d-fmri-data/{fmri_id}/{slice_index}")
 async def get_2d_fmri_data(
     fmri_id: int,
     slice_index: int,
-    supabase: Client = Depends(get_public_client),
+    request: Request,
+    encoding: str = "float32",
+    timepoint: Optional[int] = None,
+    supabase: AsyncSupabase = Depends(get_public_client),
 ):
+    """
+    Slices as JSON, or in the compact binary format (see src/plotlyViz/binary.py)
+    when the client sends `Accept: application/vnd.cnh.slices`. `encoding`
+    picks float32 or quantized uint16/uint8 intensities for the binary form.
+    4D scans show the temporal mean unless a `timepoint` is given.
+    """
+    if encoding not in INTENSITY_ENCODINGS:
+        raise HTTPException(status_code=400,
+                            detail=f"Unknown encoding {encoding}, expected one of {', '.join(INTENSITY_ENCODINGS)}")
+
     # Fetch FMRI data record from database
-    response = supabase.table("fmri_history").select(
-        "*").eq("fmri_id", fmri_id).execute()
+    fmri_data = await fmri_metadata.get(supabase, fmri_id, ("file_link", "atlas"))
 
-    if not response.data or len(response.data) == 0:
+    if not fmri_data:
         raise HTTPException(status_code=404, detail="FMRI data not found")
 
-    fmri_data = response.data[0]
     file_name = fmri_data["file_link"]
     atlas_name = fmri_data.get("atlas", "Harvard-Oxford") 
-    print(f"File name: {file_name}")
-
-    try:
-        # Download file from Supabase storage
-        file_bytes = supabase.storage.from_("fmri-uploads").download(file_name)
+    logging.getLogger("cnh").debug("scan fmri_id=%s file=%s", fmri_id, file_name)
 
-        # Create temporary file with appropriate extension
-        temp_file_name = None
-        try:
-            # Create a temporary file with the correct extension
-            suffix = '.nii.gz' if file_name.lower().endswith('.gz') else '.nii'
-            with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as temp_file:
-                temp_file_name = temp_file.name
+    download = scan_downloader(supabase, file_name)
 
-                # Write the file contents
-                temp_file.write(file_bytes)
-                temp_file.flush()
+    try:
+        # Only the first request for a scan pays for the download; the displayed
+        # volume (temporal mean or one timepoint) is then decoded once and kept in memory
+        volume = await run_in_threadpool(volume_cache.get_volume, file_name, download, timepoint)
 
-            print(f"Processing file: {temp_file_name}")
+        with time_stage("slice_extract"):
+            slices = await run_in_threadpool(extract_slices, volume, slice_index, atlas_name)
 
-            # Process the file
-            slices = get_slices(temp_file_name, slice_index, atlas_name)
-            print("Slices processed successfully")
-            return slices
+        if wants_binary(request.headers.get("accept")):
+            with time_stage("slice_serialize_binary"):
+                payload = await run_in_threadpool(encode_slices, slices, encoding)
+            BYTES.inc(len(payload), transfer="slice_response")
+            return Response(content=payload, media_type=SLICE_MEDIA_TYPE, headers={"Vary": "Accept"})
 
-        finally:
-            # Clean up the temporary file
-            if temp_file_name and os.path.exists(temp_file_name):
-                try:
-                    os.unlink(temp_file_name)
-                except Exception as e:
-                    print(
-                        f"Warning: Could not delete temporary file {temp_file_name}: {str(e)}")
+        with time_stage("slice_serialize_json"):
+            content = await run_in_threadpool(lambda: jsonable_encoder(slices_to_lists(slices)))
+        return JSONResponse(content=content, headers={"Vary": "Accept"})
 
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Error processing fMRI data: {str(e)}")
 
+@app.websocket("/api/ws/slices/{fmri_id}")
+async def slice_session(
+    websocket: WebSocket,
+    fmri_id: int,
+    encoding: str = "uint16",
+    timepoint: Optional[int] = None,
+):
+    """
+    Slice-scrubbing session. The server sends one JSON "ready" message, then
+    a binary frame (see src/plotlyViz/binary.py) per requested plane. Clients
+    send JSON like {"axial": 40} or {"coronal": 12, "sagittal": 30}; when
+    requests arrive faster than frames go out, only the latest index per axis
+    is answered.
+    """
+    await websocket.accept()
+
+    if encoding not in INTENSITY_ENCODINGS:
+        await websocket.send_json({"type": "error", "detail": f"Unknown encoding {encoding}"})
+        await websocket.close(code=1008)
+        return
+
+    fmri_data = await fmri_metadata.get(supabase, fmri_id, ("file_link", "atlas"))
+    if not fmri_data:
+        await websocket.send_json({"type": "error", "detail": "FMRI data not found"})
+        await websocket.close(code=1008)
+        return
+
+    file_name = fmri_data["file_link"]
+    atlas_name = fmri_data.get("atlas", "Harvard-Oxford")
+
+    download = scan_downloader(supabase, file_name)
+
+    try:
+        volume = await run_in_threadpool(volume_cache.get_volume, file_name, download, timepoint)
+        session = await run_in_threadpool(SliceSession.open, volume, atlas_name, None, encoding)
+    except Exception as e:
+        await websocket.send_json({"type": "error", "detail": f"Error processing fMRI data: {str(e)}"})
+        await websocket.close(code=1011)
+        return
+
+    await websocket.send_json(session.describe())
+
+    pending = {}
+    errors = []
+    wake = asyncio.Event()
+
+    async def receive_requests():
+        while True:
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            try:
+                message = json.loads(frame.get("text") or frame.get("bytes") or "")
+            except ValueError:
+                message = None
+            if not isinstance(message, dict):
+                # Answered from the send loop so frames are never sent concurrently
+                errors.append('Expected a JSON object like {"axial": 40}')
+                wake.set()
+                continue
+            for axis in AXES:
+                if axis in message:
+                    try:
+                        pending[axis] = int(message[axis])
+                    except (TypeError, ValueError):
+                        continue
+            wake.set()
+
+    receiver = asyncio.create_task(receive_requests())
+    prefetches = set()
+    try:
+        while True:
+            waiter = asyncio.create_task(wake.wait())
+            done, _ = await asyncio.wait({waiter, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if receiver in done:
+                waiter.cancel()
+                receiver.result()  # re-raises the disconnect
+            wake.clear()
+
+            while errors:
+                await websocket.send_json({"type": "error", "detail": errors.pop(0)})
+            requests, pending = pending, {}
+            for axis, index in requests.items():
+                try:
+                    frame = await run_in_threadpool(session.frame, axis, index)
+                except ValueError as e:
+                    await websocket.send_json({"type": "error", "axis": axis, "detail": str(e)})
+                    continue
+                await websocket.send_bytes(frame)
+
+                task = asyncio.create_task(run_in_threadpool(session.prefetch, axis, index))
+                prefetches.add(task)
+                task.add_done_callback(prefetches.discard)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        for task in prefetches:
+            task.cancel()
+
+
 @app.get("/api/3d-fmri-file/{fmri_id}/")
 async def get_3d_fmri_file(
     fmri_id: int,
-    supabase: Client = Depends(get_public_client)
+    background_tasks: BackgroundTasks,
+    debug: bool = False,
+    session_id: Optional[str] = None,
+    supabase: AsyncSupabase = Depends(get_public_client)
 ):
+    """
+    URLs of the scan, its per-patient z-score overlay and thresholded
+    heatmap in the content-addressed NIfTI store. The files stay pinned for `session_id` (generated if not given)
+    until the viewer releases it through /api/delete-temp-files/.
+    """
     # Fetch FMRI data record from database
-    response = supabase.table("fmri_history").select(
-        "*").eq("fmri_id", fmri_id).execute()
+    fmri_data = await fmri_metadata.get(supabase, fmri_id, ("file_link",))
 
-    if not response.data or len(response.data) == 0:
+    if not fmri_data:
         raise HTTPException(status_code=404, detail="FMRI data not found")
 
-    file_name = response.data[0]["file_link"]
-    print(f"File name: {file_name}")
+    file_name = fmri_data["file_link"]
+    logging.getLogger("cnh").debug("scan fmri_id=%s file=%s", fmri_id, file_name)
     
     try:
-        file_bytes = supabase.storage.from_("fmri-uploads").download(file_name)
-        
+        session_id = session_id or str(uuid.uuid4())
         suffix = '.nii.gz' if file_name.lower().endswith('.gz') else '.nii'
-        unique_name = f"{uuid.uuid4()}{suffix}"
-        save_path = os.path.join("nifti_files", unique_name)
-        
-        print(f"Saving file to: {save_path}")
 
-        with open(save_path, "wb") as f:
-            f.write(file_bytes)
-            
+        scan_name = nifti_store.lookup(f"scan:{file_name}")
+        if scan_name is None:
+            CACHE_REQUESTS.inc(cache="nifti_store_scan", result="miss")
+            file_bytes = await download_scan(supabase, file_name)
+            scan_name = await run_in_threadpool(nifti_store.put_bytes, file_bytes, suffix, f"scan:{file_name}")
+        else:
+            CACHE_REQUESTS.inc(cache="nifti_store_scan", result="hit")
+        nifti_store.acquire(scan_name, session_id)
+        scan_path = nifti_store.path(scan_name)
+
+        # Per-patient z-scores against the healthy baseline, computed once per
+        # fmri_id from the memory-mappable local copy of the scan
+        def local_scan_path():
+            return volume_cache.get_path(file_name, lambda dest: shutil.copyfile(scan_path, dest))
+
+        heatmap_url = None
+        try:
+            with time_stage("zscore"):
+                zscores = await run_in_threadpool(get_patient_zscores, fmri_id, local_scan_path)
+            z_path = nifti_store.path(zscores["z_scores"])
+            nifti_store.acquire(zscores["z_scores"], session_id)
+            nifti_store.acquire(zscores["heatmap"], session_id)
+            heatmap_url = f"/nifti_files/{zscores['heatmap']}"
+        except Exception as z_error:
+            log_event("zscore_fallback", fmri_id=fmri_id, error=repr(str(z_error)))
+            zscores = None
+            z_path = DEFAULT_OVERLAY
+
         # Resample the z-score volume to match the reference dimension space
-        reference_img = nib.load(save_path)
-        overlay_img = nib.load("overlay_file/patient_z_scores.nii")
-        
-        if not np.allclose(reference_img.affine, overlay_img.affine):         
-            resampled_img = resample_to_img(
-                source_img=overlay_img,
-                target_img=reference_img,
-                interpolation="continuous",
-                fill_value=0,
-                force_resample=True
-            )
-            
-            print("Reference shape:", reference_img.shape)
-            print("Reference affine:\n", reference_img.affine)
-
-            print("Overlay shape:", resampled_img.shape)
-            print("Overlay affine:\n", resampled_img.affine)
-            
-            plot_stat_map(resampled_img, bg_img=reference_img, display_mode='ortho', threshold=1.96)
-            plt.savefig("debug_overlay.png")
-            
-            # Create a new name for this temp file
-            overlay_filename = f"{uuid.uuid4()}_resampled_overlay{suffix}"
-            overlay_path = os.path.join("nifti_files", overlay_filename)
-            print(f"Overlay file: {overlay_filename}")
-            
-            nib.save(resampled_img, overlay_path)
-
-            # Return URL for frontend viewer (like Niivue)
-            return {
-                "url": f"/nifti_files/{unique_name}",
-                "filename": unique_name,
-                "overlay": f"/nifti_files/{overlay_filename}"
-            }
-        
+        reference_img = nib.load(scan_path)
+        with time_stage("overlay_resample"):
+            overlay_name = await run_in_threadpool(get_resampled_overlay, reference_img, z_path)
+
+        if overlay_name is not None:
+            nifti_store.acquire(overlay_name, session_id)
+            overlay_url = f"/nifti_files/{overlay_name}"
+            overlay_path = nifti_store.path(overlay_name)
+        elif zscores is not None:
+            overlay_url = f"/nifti_files/{zscores['z_scores']}"
+            overlay_path = z_path
+        else:
+            overlay_url = "/overlay_file/patient_z_scores.nii"
+            overlay_path = DEFAULT_OVERLAY
+
+        background_tasks.add_task(nifti_store.evict)
+        if debug or DEBUG_OVERLAY:
+            background_tasks.add_task(render_debug_overlay, scan_path, overlay_path)
+
+        # Return URL for frontend viewer (like Niivue)
         return {
-            "url": f"/nifti_files/{unique_name}",
-            "filename": unique_name,
-            "overlay": "/overlay_file/patient_z_scores.nii"
+            "url": f"/nifti_files/{scan_name}",
+            "filename": scan_name,
+            "overlay": overlay_url,
+            "heatmap": heatmap_url,
+            "session_id": session_id
         }
 
     except Exception as e:
@@ -348,50 +960,80 @@ async def get_3d_fmri_file(
         raise HTTPException(status_code=500, detail=f"Error processing fMRI data: {str(e)}")
 
 @app.delete("/api/delete-temp-files/")
-def delete_temp_files():
-    directory = "nifti_files"
-    deleted_files = []
+def delete_temp_files(session_id: Optional[str] = None):
+    """
+    Release the files pinned by a viewer session and evict whatever is no
+    longer needed. Files other sessions are viewing are left alone.
+    """
+    released = nifti_store.release(session_id) if session_id else 0
+    deleted_files = nifti_store.evict()
 
-    if not os.path.exists(directory):
-        raise HTTPException(404, "Directory not found")
-
-    for filename in os.listdir(directory):
-        file_path = os.path.join(directory, filename)
-        try:
-            if os.path.isfile(file_path):
-                os.remove(file_path)
-                deleted_files.append(filename)
-        except Exception as e:
-            print(f"Failed to delete {file_path}: {e}")
-
-    return {"detail": f"Deleted {len(deleted_files)} files", "files": deleted_files}
+    return {
+        "detail": f"Released {released} files, deleted {len(deleted_files)} files",
+        "files": deleted_files
+    }
     
 
 @app.get("/api/user-fmri-history/{user_id}")
 async def get_user_fmri_history(
     user_id: str,
-    supabase: Client = Depends(get_public_client),
+    request: Request,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    diagnosis: Optional[str] = None,
+    atlas: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    search: Optional[str] = None,
+    sort: Optional[str] = None,
+    supabase: AsyncSupabase = Depends(get_public_client),
 ):
-    response = supabase.table("fmri_history").select(
-        "*").eq("user_id", user_id).execute()
+    """
+    One page of a user's scans, newest first unless `sort` says otherwise
+    (prediction_asc / prediction_desc). Pass the returned `next_cursor`
+    back as `cursor`, with the same sort, for the following page; it is
+    null on the last page. `search` matches title, diagnosis or ID.
+    `fields` is a comma-separated column list (the sort columns are always
+    included). Unchanged pages answer If-None-Match with 304.
+    """
+    try:
+        columns = parse_fields(fields)
+        keys = parse_sort(sort)
+        filters, params = history_query(user_id, cursor, diagnosis, atlas, date_from, date_to, search, keys)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
 
-    if not response.data:
-        return {"history": []}
+    # One extra row tells us whether another page exists
+    try:
+        rows = await supabase.select("fmri_history", ",".join(columns), filters,
+                                     order=history_order(keys), limit=limit + 1, params=params)
+    except SupabaseError as e:
+        if e.status_code == 400:
+            # A filter value PostgREST couldn't parse
+            raise HTTPException(status_code=400, detail=str(e))
+        raise
+    next_cursor = encode_cursor(rows[limit - 1], keys) if len(rows) > limit else None
+    body = {"history": rows[:limit], "next_cursor": next_cursor}
 
-    return {"history": response.data}
+    etag = history_etag(body)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(content=body, headers=headers)
 
 @app.get("/api/model-prediction/{fmri_id}")
-def get_model_result(
+async def get_model_result(
     fmri_id: int, 
-    supabase: Client = Depends(get_public_client),
+    supabase: AsyncSupabase = Depends(get_public_client),
 ):
-    response = supabase.table("fmri_history").select(
-        "model_result").eq("fmri_id", fmri_id).single().execute()
+    row = await fmri_metadata.get(supabase, fmri_id, ("model_result",))
     
-    if not response.data:
+    if not row:
         raise HTTPException(status_code=404, detail="Model result not found")
 
-    return {"model_result": response.data["model_result"]}
+    return {"model_result": row["model_result"]}
 
 # Run the application if the script is executed directly
 if __name__ == "__main__":
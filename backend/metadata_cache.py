@@ -0,0 +1,122 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+FMRI_METADATA_TTL_SECONDS = float(os.getenv("FMRI_METADATA_TTL_SECONDS", "30"))
+FMRI_METADATA_CACHE_SIZE = int(os.getenv("FMRI_METADATA_CACHE_SIZE", "4096"))
+
+
+class FmriMetadataCache:
+    """
+    Short-TTL cache of fmri_history rows keyed by fmri_id, for the endpoints
+    that only need a few columns of one scan (file_link, atlas, model_result).
+
+    Each lookup names the columns it needs; only missing columns are
+    queried and merged into the cached row, so no endpoint pays for
+    select("*"). Concurrent misses for the same row and columns share one
+    query. Rows written by this process are primed or invalidated directly;
+    the TTL bounds staleness for writes made elsewhere. Lives on the event
+    loop, so no locking.
+    """
+
+    def __init__(self, table: str = "fmri_history", key: str = "fmri_id",
+                 ttl: float = FMRI_METADATA_TTL_SECONDS, maxsize: int = FMRI_METADATA_CACHE_SIZE):
+        self.table = table
+        self.key = key
+        self.ttl = ttl
+        self.maxsize = maxsize
+        # fmri_id -> (expires_at, row)
+        self._rows = OrderedDict()
+        # (fmri_id, columns) -> Task of an in-flight query
+        self._inflight = {}
+        # Bumped on invalidation so a query that started earlier can't store a
+        # stale row; only kept for fmri_ids with a query in flight
+        self._generations = {}
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "invalidations": 0}
+
+    def _fresh_row(self, fmri_id):
+        entry = self._rows.get(fmri_id)
+        if entry is None:
+            return None
+        expires_at, row = entry
+        if expires_at < time.monotonic():
+            del self._rows[fmri_id]
+            return None
+        self._rows.move_to_end(fmri_id)
+        return row
+
+    def _store(self, fmri_id, values: dict):
+        row = dict(self._fresh_row(fmri_id) or {})
+        row.update(values)
+        self._rows[fmri_id] = (time.monotonic() + self.ttl, row)
+        self._rows.move_to_end(fmri_id)
+        while len(self._rows) > self.maxsize:
+            self._rows.popitem(last=False)
+
+    async def _fetch(self, client, fmri_id, columns, generation):
+        row = await client.select_one(self.table, ",".join(columns), [(self.key, "eq", fmri_id)])
+        if row is not None and self._generations.get(fmri_id, 0) == generation:
+            self._store(fmri_id, row)
+        return row
+
+    async def get(self, client, fmri_id, columns):
+        """
+        Dict of `columns` for the row, or None if it doesn't exist.
+        """
+        columns = tuple(columns)
+        row = self._fresh_row(fmri_id)
+        missing = tuple(column for column in columns if row is None or column not in row)
+        if not missing:
+            self.stats["hits"] += 1
+            return {column: row[column] for column in columns}
+
+        flight_key = (fmri_id, missing)
+        task = self._inflight.get(flight_key)
+        if task is None:
+            self.stats["misses"] += 1
+            task = asyncio.ensure_future(self._fetch(client, fmri_id, missing, self._generations.get(fmri_id, 0)))
+            self._inflight[flight_key] = task
+            task.add_done_callback(lambda _: self._landed(flight_key))
+        else:
+            self.stats["coalesced"] += 1
+
+        fetched = await asyncio.shield(task)
+        if fetched is None:
+            return None
+        merged = {**(row or {}), **fetched}
+        return {column: merged.get(column) for column in columns}
+
+    def _in_flight(self, fmri_id):
+        return any(key[0] == fmri_id for key in self._inflight)
+
+    def _landed(self, flight_key):
+        self._inflight.pop(flight_key, None)
+        fmri_id = flight_key[0]
+        if not self._in_flight(fmri_id):
+            self._generations.pop(fmri_id, None)
+
+    def invalidate(self, fmri_id):
+        """
+        Forget a row this process changed; queries already in flight for it
+        won't store their (older) result.
+        """
+        if self._in_flight(fmri_id):
+            self._generations[fmri_id] = self._generations.get(fmri_id, 0) + 1
+        if self._rows.pop(fmri_id, None) is not None:
+            self.stats["invalidations"] += 1
+
+    def prime(self, row: dict):
+        """
+        Cache a row this process just inserted or updated.
+        """
+        fmri_id = row[self.key]
+        self.invalidate(fmri_id)
+        self._store(fmri_id, row)
+
+    def info(self):
+        return {**self.stats, "size": len(self._rows), "maxsize": self.maxsize, "ttl": self.ttl,
+                "in_flight": len(self._inflight)}
+
+
+fmri_metadata = FmriMetadataCache()
@@ -0,0 +1,215 @@
+import bisect
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds; covers everything from a cached slice read to a full masking run
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+logger = logging.getLogger("cnh")
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (non-cumulative) counts, then sum and count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _render_sample(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames, key, [("le", _format_value(float(bound)))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    """
+    Metrics exported on /api/metrics in the Prometheus text format.
+    Collectors are callables run at scrape time that return extra metrics
+    (e.g. gauges built from a cache's own stats).
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            try:
+                for metric in collector():
+                    lines.extend(metric.render())
+            except Exception as e:
+                logger.warning("metrics collector %s failed: %s", getattr(collector, "__name__", collector), e)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.register(Histogram(
+    "cnh_stage_seconds", "Time spent in each pipeline stage", ["stage"]))
+STAGE_ERRORS = registry.register(Counter(
+    "cnh_stage_errors_total", "Pipeline stages that raised", ["stage"]))
+CACHE_REQUESTS = registry.register(Counter(
+    "cnh_cache_requests_total", "Cache lookups by cache and result (hit/miss)", ["cache", "result"]))
+BYTES = registry.register(Counter(
+    "cnh_bytes_total", "Bytes moved, by transfer", ["transfer"]))
+HTTP_IN_FLIGHT = registry.register(Gauge(
+    "cnh_http_requests_in_flight", "HTTP requests currently being handled"))
+HTTP_SECONDS = registry.register(Histogram(
+    "cnh_http_request_seconds", "HTTP request latency by route", ["method", "route", "status"]))
+
+
+# Set by collect_stages; time_stage also appends to it
+_collected_stages = contextvars.ContextVar("collected_stages", default=None)
+
+
+@contextmanager
+def time_stage(stage: str):
+    """
+    Record the duration of the block in cnh_stage_seconds{stage=...}; a
+    block that raises also counts in cnh_stage_errors_total.
+    """
+    started = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        STAGE_SECONDS.observe(seconds, stage=stage)
+        collected = _collected_stages.get()
+        if collected is not None:
+            collected.append((stage, seconds, failed))
+
+
+@contextmanager
+def collect_stages():
+    """
+    Also collect the (stage, seconds, failed) of every time_stage inside the
+    block into the yielded list. Metrics recorded in a worker process stay
+    there; the parent replays the list with record_stages.
+    """
+    stages = []
+    token = _collected_stages.set(stages)
+    try:
+        yield stages
+    finally:
+        _collected_stages.reset(token)
+
+
+def record_stages(stages):
+    for stage, seconds, failed in stages:
+        if failed:
+            STAGE_ERRORS.inc(stage=stage)
+        STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+def log_event(event: str, **fields):
+    """
+    One structured `event key=value ...` log line. Formatting is skipped
+    entirely when INFO is disabled for the "cnh" logger.
+    """
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("%s %s", event, " ".join(f"{key}={value}" for key, value in fields.items()))
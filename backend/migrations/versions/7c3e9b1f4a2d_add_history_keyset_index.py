@@ -0,0 +1,26 @@
+"""Add (user_id, date, fmri_id) index to FMRI_History
+
+Revision ID: 7c3e9b1f4a2d
+Revises: a2ef831e12d8
+Create Date: 2026-10-17 10:12:41.208133
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7c3e9b1f4a2d'
+down_revision: Union[str, None] = 'a2ef831e12d8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_fmri_history_user_date_id', 'fmri_history', ['user_id', 'date', 'fmri_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_fmri_history_user_date_id', table_name='fmri_history')
@@ -2,92 +2,356 @@ import torch
 import numpy as np
 from nilearn.input_data import NiftiLabelsMasker
 from nilearn.connectome import ConnectivityMeasure
+from nilearn.image import resample_img
 import nibabel as nib
 from nibabel import FileHolder, Nifti1Image
 from torch_geometric.data import Data
 from sklearn.metrics.pairwise import cosine_similarity
 from GNN import SpectralGCN
+from feature_bank import get_feature_bank
+from connectome_store import get_connectome_store
+from metrics import time_stage, log_event, collect_stages, record_stages
 import os
 from io import BytesIO
-import tempfile
 import pathlib as Path
 import gzip
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def predict_from_nifti(file_content: bytes, original_filename: str):
-     # Determine suffix from original filename
+MODEL_PATH = os.path.join("gnn_model_weights.pt")
+ATLAS_PATH = os.path.join("template_cambridge_basc_multiscale_sym_scale064.nii.gz")
+IN_CHANNELS = 2016
+# Name the masking atlas is stored under in the connectome store
+ATLAS_KEY = "basc064"
+MASKER_CACHE_SIZE = int(os.getenv("MASKER_CACHE_SIZE", "8"))
+# Size of the neighbourhood pulled from the feature bank for each new subject
+BANK_NEIGHBOURS = int(os.getenv("BANK_NEIGHBOURS", "20"))
+BANK_APPROXIMATE = os.getenv("BANK_APPROXIMATE", "0") == "1"
+# After a failed load, wait this long before the next attempt, doubling per failure
+MODEL_RETRY_SECONDS = float(os.getenv("MODEL_RETRY_SECONDS", "5"))
+MODEL_RETRY_MAX_SECONDS = 300
+
+# Process-wide model holder. The weights are deserialized once (at app startup
+# via load_model) and the same eval-mode module is shared by every request.
+_model = None
+_model_error = None
+_model_failures = 0
+_model_failed_at = 0.0
+_model_lock = threading.Lock()
+_model_ready = threading.Event()
+
+
+# Atlas images and fitted maskers, keyed by scan geometry. Uploads come from a
+# handful of protocols, so the atlas is resampled once per (atlas, affine, shape)
+# instead of once per upload.
+_atlas_imgs = {}
+_masker_cache = OrderedDict()
+_masker_cache_lock = threading.Lock()
+_masker_cache_stats = {"hits": 0, "misses": 0}
+
+
+def _load_atlas(atlas_path: str):
+    atlas_img = _atlas_imgs.get(atlas_path)
+    if atlas_img is None:
+        atlas_img = nib.load(atlas_path)
+        _atlas_imgs[atlas_path] = atlas_img
+    return atlas_img
+
+
+def _geometry_key(atlas_path: str, img):
+    affine = tuple(np.round(np.asarray(img.affine, dtype=np.float64), 6).ravel())
+    return (atlas_path, affine, tuple(img.shape[:3]))
+
+
+def get_fitted_masker(fmri, atlas_path: str = ATLAS_PATH):
+    """
+    Return a fitted NiftiLabelsMasker whose labels image is already on the
+    subject's voxel grid, so nilearn skips its per-call resample.
+    """
+    key = _geometry_key(atlas_path, fmri)
+    with _masker_cache_lock:
+        masker = _masker_cache.get(key)
+        if masker is not None:
+            _masker_cache.move_to_end(key)
+            _masker_cache_stats["hits"] += 1
+            return masker
+        _masker_cache_stats["misses"] += 1
+
+    with time_stage("masker_fit"):
+        resampled_labels = resample_img(
+            _load_atlas(atlas_path),
+            target_affine=fmri.affine,
+            target_shape=fmri.shape[:3],
+            interpolation="nearest",
+        )
+        masker = NiftiLabelsMasker(
+            labels_img=resampled_labels,
+            standardize=True,
+            verbose=0
+        )
+        masker.fit()
+
+    with _masker_cache_lock:
+        _masker_cache[key] = masker
+        _masker_cache.move_to_end(key)
+        while len(_masker_cache) > MASKER_CACHE_SIZE:
+            _masker_cache.popitem(last=False)
+    return masker
+
+
+def masker_cache_info():
+    with _masker_cache_lock:
+        return {
+            "hits": _masker_cache_stats["hits"],
+            "misses": _masker_cache_stats["misses"],
+            "size": len(_masker_cache),
+            "maxsize": MASKER_CACHE_SIZE,
+        }
+
+
+def _build_knn_edge_index(features, k=5):
+    """
+    Cosine-kNN population graph over the rows of `features`. Each node gets an
+    edge to its k most similar neighbours (the diagonal is zeroed, matching the
+    training-time graph construction).
+    """
+    sim_matrix = cosine_similarity(features)
+    np.fill_diagonal(sim_matrix, 0)
+    N = sim_matrix.shape[0]
+    k = min(k, N)
+    neighbours = np.argsort(-sim_matrix, axis=1, kind="stable")[:, :k]
+    rows = np.repeat(np.arange(N), k)
+    edge_index = np.stack([rows, neighbours.ravel()])
+    return torch.as_tensor(edge_index, dtype=torch.long).contiguous()
+
+
+def load_model(model_path: str = MODEL_PATH):
+    """
+    Load the SpectralGCN weights once, pin the module in eval mode and run a
+    warm-up forward pass. Safe to call from several threads; only the first
+    caller does the work.
+    """
+    global _model, _model_error, _model_failures, _model_failed_at
+    if _model_ready.is_set():
+        return _model
+
+    with _model_lock:
+        if _model is not None:
+            return _model
+        try:
+            model = SpectralGCN(in_channels=IN_CHANNELS, hidden_channels=128, out_channels=1, K=3)
+            model.load_state_dict(torch.load(model_path, map_location="cpu"))
+            model.eval()
+            for param in model.parameters():
+                param.requires_grad_(False)
+
+            # Warm-up pass so the first real request doesn't pay for lazy init
+            warmup_x = torch.zeros((2, IN_CHANNELS))
+            warmup_edges = torch.tensor([[0, 1], [1, 0]])
+            with torch.inference_mode():
+                model(Data(x=warmup_x, edge_index=warmup_edges))
+        except Exception as e:
+            # Logged by whoever triggered the load
+            _model_error = str(e)
+            _model_failures += 1
+            _model_failed_at = time.time()
+            raise
+
+        _model = model
+        _model_error = None
+        _model_failures = 0
+        _model_ready.set()
+        log_event("model_loaded", path=model_path)
+        return _model
+
+
+def model_retry_due():
+    """
+    Whether a failed load has waited out its backoff and may be tried again.
+    """
+    if _model_error is None:
+        return False
+    backoff = min(MODEL_RETRY_SECONDS * 2 ** (_model_failures - 1), MODEL_RETRY_MAX_SECONDS)
+    return time.time() - _model_failed_at >= backoff
+
+
+def get_model():
+    if _model_ready.is_set():
+        return _model
+    if _model_error is not None and not model_retry_due():
+        # Don't retry a failed load on every request; retries back off
+        raise RuntimeError(f"Model failed to load: {_model_error}")
+    return load_model()
+
+
+def model_status():
+    return {
+        "ready": _model_ready.is_set(),
+        "error": _model_error,
+    }
+
+
+def _nifti_suffix(original_filename: str):
+    # Determine suffix from original filename
     _, ext = os.path.splitext(original_filename)
     suffix = ext if ext in ['.nii', '.gz', '.nii.gz'] else '.nii'
 
     # Handle double extensions like .nii.gz
     if original_filename.endswith(".nii.gz"):
         suffix = ".nii.gz"
+    return suffix
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-        tmp.write(file_content)
-        tmp_path = tmp.name
 
+def extract_time_series(nifti_path: str):
+    """
+    Mask a NIfTI file with the BASC-064 atlas and return the ROI time series
+    (timepoints x regions).
+    """
     try:
-        fmri = nib.load(tmp_path)
+        with time_stage("nifti_load"):
+            fmri = nib.load(nifti_path)
     except Exception as e:
-        os.remove(tmp_path)
         raise ValueError(f"Unable to load file as NIFTI or NIFTI.gz: {str(e)}")
 
-    atlas_path = os.path.join("template_cambridge_basc_multiscale_sym_scale064.nii.gz")
-    atlas_filename = nib.load(atlas_path)
+    masker = get_fitted_masker(fmri)
 
-    masker = NiftiLabelsMasker(
-        labels_img=atlas_filename,
-        standardize=True,
-        memory='nilearn_cache',
-        verbose=1
-    )
+    with time_stage("masker_transform"):
+        time_series = masker.transform(fmri)
 
-    time_series = masker.fit_transform(fmri)
-    
     if np.isnan(time_series).all():
-        os.remove(tmp_path)
         raise ValueError("The time series contains only NaN values.")
-    
-    correlation_measure = ConnectivityMeasure(kind='correlation', vectorize=True, discard_diagonal=True)
-    correlation_matrix = correlation_measure.fit_transform([time_series])[0]
-    correlation_matrix = correlation_matrix.reshape(1, -1)
-    
-    if np.isnan(correlation_matrix).all():
-        os.remove(tmp_path)
+
+    return time_series
+
+
+def extract_time_series_in_worker(nifti_path: str):
+    """
+    extract_time_series for a job worker process. Also returns what it
+    recorded there (stage timings, masker cache hits and misses), which
+    the parent adds to its own metrics with record_worker_stats.
+    """
+    with _masker_cache_lock:
+        before = dict(_masker_cache_stats)
+    with collect_stages() as stages:
+        time_series = extract_time_series(nifti_path)
+    with _masker_cache_lock:
+        masker_cache = {key: _masker_cache_stats[key] - before[key] for key in before}
+    return time_series, {"stages": stages, "masker_cache": masker_cache}
+
+
+def record_worker_stats(stats: dict):
+    record_stages(stats["stages"])
+    with _masker_cache_lock:
+        for key, count in stats["masker_cache"].items():
+            _masker_cache_stats[key] += count
+
+
+def connectome_from_time_series(time_series):
+    """
+    Vectorized correlation matrix (2016 values, diagonal discarded) as float32.
+    """
+    with time_stage("connectivity"):
+        correlation_measure = ConnectivityMeasure(kind='correlation', vectorize=True, discard_diagonal=True)
+        correlation_vector = correlation_measure.fit_transform([time_series])[0]
+
+    if np.isnan(correlation_vector).all():
         raise ValueError("The correlation matrix contains only NaN values.")
 
-    
-    features = torch.tensor(correlation_matrix).float()
-    
+    return correlation_vector.astype(np.float32)
+
+
+def extract_connectome(nifti_path: str):
+    return connectome_from_time_series(extract_time_series(nifti_path))
+
+
+def predict_from_features(correlation_matrix):
+    """
+    Run the GCN once over a population graph built from the rows of
+    `correlation_matrix` (shape [N, 2016]) and return N binary predictions.
+    """
+    features = torch.as_tensor(np.asarray(correlation_matrix, dtype=np.float32).reshape(-1, IN_CHANNELS))
+
     if torch.isnan(features).all():
-        os.remove(tmp_path)
         raise ValueError("The feature tensor contains only NaN values.")
 
-    N = features.size(0)
-    sim_matrix = cosine_similarity(features)
-    np.fill_diagonal(sim_matrix, 0)
-    edge_index = []
-    for i in range(N):
-        for j in np.argsort(-sim_matrix[i])[:5]:
-            edge_index.append([i, j])
-    edge_index = torch.tensor(edge_index).t().contiguous()
+    with time_stage("graph_build"):
+        edge_index = _build_knn_edge_index(features)
 
     data = Data(x=features, edge_index=edge_index)
 
-    model = SpectralGCN(in_channels=2016, hidden_channels=128, out_channels=1, K=3)
-    model_path = os.path.join("gnn_model_weights.pt")
+    model = get_model()
 
-    model.load_state_dict(torch.load(model_path))
-    model.eval()
-    
-    # Perform inference with the GNN model
-    with torch.no_grad():
+    # Perform inference with the shared GNN model
+    with time_stage("gcn_forward"), torch.inference_mode():
         output = model(data)
-    
+
     probability = torch.sigmoid(output)
 
-    prediction = (probability > 0.5).int().item()
-    print(f"Prediction: {prediction}")
-    os.remove(tmp_path)
-    
-    return prediction
\ No newline at end of file
+    return (probability > 0.5).int().tolist()
+
+
+def predict_in_neighbourhood(correlation_vector, bank=None, k: int = BANK_NEIGHBOURS,
+                             approximate: bool = BANK_APPROXIMATE, exclude_keys=None):
+    """
+    Predict one subject inside the subgraph formed by its k nearest past
+    subjects from the feature bank, so the graph size (and latency) stays
+    constant however large the bank gets. Falls back to a single-node graph
+    while the bank is empty.
+    """
+    bank = bank if bank is not None else get_feature_bank()
+    with time_stage("bank_search"):
+        rows, _ = bank.search(correlation_vector, k=k, approximate=approximate, exclude_keys=exclude_keys)
+    if len(rows) == 0:
+        return predict_from_features(correlation_vector)[0]
+
+    subgraph = np.vstack([np.asarray(correlation_vector, dtype=np.float32).reshape(1, -1), bank.vectors(rows)])
+    return predict_from_features(subgraph)[0]
+
+
+def get_stored_connectomes(atlas: str = ATLAS_KEY):
+    return get_connectome_store(atlas, IN_CHANNELS)
+
+
+def repredict_stored(fmri_id: int, atlas: str = ATLAS_KEY, **kwargs):
+    """
+    Re-run the model for an already processed scan from its stored
+    connectome, skipping the NIfTI load, masking and correlation steps.
+    Returns None if the scan has no stored features.
+    """
+    correlations = get_stored_connectomes(atlas).get_correlations(fmri_id)
+    if correlations is None:
+        return None
+    return predict_in_neighbourhood(correlations, exclude_keys=[fmri_id], **kwargs)
+
+
+def predict_batch(nifti_paths, max_workers: int = None):
+    """
+    Predict many scans in one GCN pass.
+
+    Connectomes are extracted in parallel, stacked into a single cosine-kNN
+    population graph and scored together. Returns one dict per input path, in
+    order, with either `model_result` or `error` set.
+    """
+    max_workers = max_workers or min(len(nifti_paths), os.cpu_count() or 1) or 1
+
+    results = [{"path": path, "model_result": None, "error": None} for path in nifti_paths]
+    vectors = [None] * len(nifti_paths)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(extract_connectome, path): i for i, path in enumerate(nifti_paths)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                vectors[i] = future.result()
+            except Exception as e:
+                results[i]["error"] = str(e)
+
+    ok = [i for i, vector in enumerate(vectors) if vector is not None]
+    if ok:
+        predictions = predict_from_features(np.stack([vectors[i] for i in ok]))
+        for i, prediction in zip(ok, predictions):
+            results[i]["model_result"] = prediction
+
+    log_event("batch_predicted", predicted=len(ok), scans=len(nifti_paths))
+    return results
@@ -0,0 +1,213 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+import nibabel as nib
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+NIFTI_STORE_DIR = "nifti_files"
+NIFTI_STORE_MB = int(os.getenv("NIFTI_STORE_MB", "5120"))
+NIFTI_STORE_TTL_SECONDS = int(os.getenv("NIFTI_STORE_TTL_SECONDS", "86400"))
+# A viewer session that hasn't been renewed or released for this long stops pinning its files
+NIFTI_SESSION_TTL_SECONDS = int(os.getenv("NIFTI_SESSION_TTL_SECONDS", "7200"))
+
+_INDEX_FILE = ".index.json"
+
+
+class NiftiStore:
+    """
+    Content-addressed store for the NIfTI files served to the 3D viewer.
+
+    Files are named by the SHA-256 of their bytes, so an identical scan or
+    overlay is written once and always served from the same URL. Aliases
+    (e.g. "scan:<file_link>") map lookups to stored names without
+    re-downloading. Viewer sessions pin the files they use; unpinned files
+    are evicted once older than the TTL, or oldest first when the store is
+    over its disk budget. Eviction runs in `evict`, which callers trigger
+    after pinning what they are about to serve.
+    """
+
+    def __init__(self, directory: str = NIFTI_STORE_DIR, disk_budget: int = NIFTI_STORE_MB * 1024 * 1024,
+                 ttl: float = NIFTI_STORE_TTL_SECONDS, session_ttl: float = NIFTI_SESSION_TTL_SECONDS):
+        self.directory = directory
+        self.disk_budget = disk_budget
+        self.ttl = ttl
+        self.session_ttl = session_ttl
+        self._lock = threading.Lock()
+        # name -> {session_id: last renewed}
+        self._refs = {}
+        os.makedirs(directory, exist_ok=True)
+        self._index_path = os.path.join(directory, _INDEX_FILE)
+        try:
+            with open(self._index_path) as f:
+                self._index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self._index = {}
+
+    def path(self, name: str):
+        return os.path.join(self.directory, name)
+
+    def _save_index(self):
+        tmp_path = f"{self._index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self._index_path)
+
+    def lookup(self, alias: str):
+        with self._lock:
+            name = self._index.get(alias)
+        if name and os.path.exists(self.path(name)):
+            return name
+        return None
+
+    def _commit(self, tmp_path: str, digest: str, suffix: str, alias: str = None):
+        name = f"{digest}{suffix}"
+        final_path = self.path(name)
+        if os.path.exists(final_path):
+            os.unlink(tmp_path)
+            os.utime(final_path)
+        else:
+            os.replace(tmp_path, final_path)
+        if alias:
+            with self._lock:
+                self._index[alias] = name
+                self._save_index()
+        return name
+
+    def _tmp_path(self):
+        return self.path(f".{uuid.uuid4()}.part")
+
+    def put_bytes(self, data: bytes, suffix: str, alias: str = None):
+        tmp_path = self._tmp_path()
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        return self._commit(tmp_path, hashlib.sha256(data).hexdigest(), suffix, alias)
+
+    def put_file(self, source_path: str, suffix: str, alias: str = None):
+        """
+        Copy a file into the store, hashing it in the same pass.
+        """
+        digest = hashlib.sha256()
+        tmp_path = self._tmp_path()
+        with open(source_path, "rb") as src, open(tmp_path, "wb") as dst:
+            while chunk := src.read(1024 * 1024):
+                digest.update(chunk)
+                dst.write(chunk)
+        return self._commit(tmp_path, digest.hexdigest(), suffix, alias)
+
+    def put_image(self, img, suffix: str = ".nii.gz", alias: str = None):
+        tmp_path = self._tmp_path() + suffix
+        nib.save(img, tmp_path)
+        try:
+            return self.put_file(tmp_path, suffix, alias)
+        finally:
+            os.unlink(tmp_path)
+
+    def acquire(self, name: str, session_id: str):
+        now = time.time()
+        with self._lock:
+            self._refs.setdefault(name, {})[session_id] = now
+        try:
+            os.utime(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def release(self, session_id: str):
+        with self._lock:
+            released = 0
+            for name in list(self._refs):
+                if self._refs[name].pop(session_id, None) is not None:
+                    released += 1
+                if not self._refs[name]:
+                    del self._refs[name]
+        return released
+
+    def _pinned(self, now: float):
+        with self._lock:
+            for name in list(self._refs):
+                sessions = self._refs[name]
+                for session_id, renewed in list(sessions.items()):
+                    if now - renewed > self.session_ttl:
+                        del sessions[session_id]
+                if not sessions:
+                    del self._refs[name]
+            return set(self._refs)
+
+    def evict(self):
+        """
+        Remove unpinned files past the TTL, then the least recently used
+        unpinned files until the store fits its disk budget.
+        """
+        now = time.time()
+        pinned = self._pinned(now)
+        entries = []
+        total = 0
+        removed = []
+        for name in os.listdir(self.directory):
+            if name.startswith("."):
+                continue
+            path = self.path(name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if not os.path.isfile(path):
+                continue
+            total += stat.st_size
+            if name in pinned:
+                continue
+            if now - stat.st_mtime > self.ttl:
+                removed.append(name)
+                total -= stat.st_size
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        entries.sort()
+        while total > self.disk_budget and entries:
+            _, size, name = entries.pop(0)
+            removed.append(name)
+            total -= size
+
+        for name in removed:
+            try:
+                os.unlink(self.path(name))
+            except FileNotFoundError:
+                pass
+        if removed:
+            with self._lock:
+                self._index = {alias: name for alias, name in self._index.items() if name not in removed}
+                self._save_index()
+        return removed
+
+    def info(self):
+        with self._lock:
+            return {
+                "pinned_files": len(self._refs),
+                "aliases": len(self._index),
+                "disk_budget": self.disk_budget,
+                "ttl": self.ttl,
+            }
+
+
+class ContentAddressedStaticFiles(StaticFiles):
+    """
+    StaticFiles for content-addressed names: the ETag is the content hash
+    and responses may be cached forever.
+    """
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200):
+        request_headers = Headers(scope=scope)
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result)
+        digest = os.path.basename(full_path).split(".", 1)[0]
+        response.headers["etag"] = f'"{digest}"'
+        response.headers["cache-control"] = "public, max-age=31536000, immutable"
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+nifti_store = NiftiStore()
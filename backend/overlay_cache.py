@@ -0,0 +1,118 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import nibabel as nib
+from nilearn.image import resample_to_img, index_img
+from metrics import log_event
+from nifti_store import nifti_store
+
+DEFAULT_OVERLAY = os.path.join("overlay_file", "patient_z_scores.nii")
+# Decoded overlays kept in memory; every patient's z-map is its own overlay
+OVERLAY_CACHE_ENTRIES = int(os.getenv("OVERLAY_CACHE_ENTRIES", "8"))
+RESAMPLED_CACHE_ENTRIES = 1024
+
+_overlays = OrderedDict()
+_resampled = OrderedDict()
+_lock = threading.Lock()
+
+
+def _overlay_version(overlay_path: str, store):
+    """
+    What identifies the overlay's contents. Files in the NIfTI store are
+    named by their hash, and pinning them touches their mtime, so the name
+    is used; anything else (the default overlay) goes by its mtime.
+    """
+    if os.path.dirname(os.path.abspath(overlay_path)) == os.path.abspath(store.directory):
+        return os.path.basename(overlay_path)
+    return os.path.getmtime(overlay_path)
+
+
+def _load_overlay(overlay_path: str, version):
+    """
+    Overlay image cached per process (the most recently used
+    OVERLAY_CACHE_ENTRIES); reloaded if `version` changes.
+    """
+    with _lock:
+        cached = _overlays.get(overlay_path)
+        if cached is not None and cached[0] == version:
+            _overlays.move_to_end(overlay_path)
+            return cached[1]
+    overlay_img = nib.load(overlay_path)
+    overlay_img = nib.Nifti1Image(np.asarray(overlay_img.dataobj, dtype=np.float32), overlay_img.affine)
+    with _lock:
+        _overlays[overlay_path] = (version, overlay_img)
+        _overlays.move_to_end(overlay_path)
+        while len(_overlays) > OVERLAY_CACHE_ENTRIES:
+            _overlays.popitem(last=False)
+    return overlay_img
+
+
+def get_resampled_overlay(reference_img, overlay_path: str = DEFAULT_OVERLAY, store=None):
+    """
+    Return the name (inside the NIfTI store) of `overlay_path` resampled to
+    the grid of `reference_img`, or None when the grids already match.
+
+    Results are keyed by (overlay contents, target affine, target shape);
+    the first request resamples and stores the image, later
+    requests in any worker find it through the store alias.
+    """
+    store = store or nifti_store
+    version = _overlay_version(overlay_path, store)
+    overlay_img = _load_overlay(overlay_path, version)
+    if np.allclose(reference_img.affine, overlay_img.affine):
+        return None
+
+    affine = np.round(np.asarray(reference_img.affine, dtype=np.float64), 6)
+    shape = tuple(int(n) for n in reference_img.shape[:3])
+    # A store name is its content hash, so the same z-map always gets the same key
+    source = version if isinstance(version, str) else (overlay_path, version)
+    digest = hashlib.sha1(repr((source, affine.tolist(), shape)).encode()).hexdigest()
+    alias = f"overlay:{digest}"
+
+    with _lock:
+        name = _resampled.get(digest)
+    if name is None or not os.path.exists(store.path(name)):
+        name = store.lookup(alias)
+    if name is None:
+        resampled_img = resample_to_img(
+            source_img=overlay_img,
+            target_img=reference_img,
+            interpolation="continuous",
+            fill_value=0,
+            force_resample=True
+        )
+        log_event("overlay_resampled", overlay=overlay_path, shape=list(resampled_img.shape))
+        name = store.put_image(resampled_img, ".nii.gz", alias)
+
+    with _lock:
+        _resampled[digest] = name
+        _resampled.move_to_end(digest)
+        while len(_resampled) > RESAMPLED_CACHE_ENTRIES:
+            _resampled.popitem(last=False)
+    return name
+
+
+def render_debug_overlay(reference_path: str, overlay_path: str, output_path: str = "debug_overlay.png"):
+    """
+    Save a plot_stat_map of the overlay on top of the reference scan. Slow;
+    meant to be run as a background task when debugging is switched on.
+    """
+    # Imported here so matplotlib stays off the request path unless needed
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from nilearn.plotting import plot_stat_map
+
+    try:
+        reference_img = nib.load(reference_path)
+        if len(reference_img.shape) > 3:
+            reference_img = index_img(reference_img, 0)
+        display = plot_stat_map(overlay_path, bg_img=reference_img, display_mode='ortho', threshold=1.96)
+        display.savefig(output_path)
+        display.close()
+        plt.close("all")
+        log_event("debug_overlay_written", path=output_path)
+    except Exception as e:
+        log_event("debug_overlay_failed", error=repr(str(e)))
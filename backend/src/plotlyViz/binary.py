@@ -0,0 +1,105 @@
+import json
+import struct
+import numpy as np
+
+SLICE_MEDIA_TYPE = "application/vnd.cnh.slices"
+SLICE_MAGIC = b"CNHS"
+SLICE_FORMAT_VERSION = 1
+INTENSITY_ENCODINGS = ("float32", "uint16", "uint8")
+
+# Offsets of every array are padded to this so the browser can build typed
+# array views straight onto the response buffer
+_ALIGNMENT = 8
+
+
+def wants_binary(accept_header: str):
+    return SLICE_MEDIA_TYPE in (accept_header or "")
+
+
+def _label_text(label):
+    if isinstance(label, bytes):
+        return label.decode("utf-8", errors="replace")
+    return str(label)
+
+
+def _quantize(data, encoding: str):
+    """
+    Returns (array, scale, offset) with data ~= array * scale + offset.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    if encoding == "float32":
+        return data, 1.0, 0.0
+
+    levels = np.iinfo(encoding).max
+    finite = data[np.isfinite(data)]
+    low = float(finite.min()) if finite.size else 0.0
+    high = float(finite.max()) if finite.size else 0.0
+    scale = (high - low) / levels if high > low else 1.0
+    quantized = np.rint((np.nan_to_num(data, nan=low) - low) / scale)
+    return np.clip(quantized, 0, levels).astype(encoding), scale, low
+
+
+def _label_array(data):
+    data = np.asarray(data)
+    if data.size == 0 or (data.min() >= 0 and data.max() <= np.iinfo(np.uint16).max):
+        return data.astype(np.uint16)
+    return data.astype(np.int32)
+
+
+def encode_slices(slices: dict, encoding: str = "float32", extra: dict = None):
+    """
+    Pack the output of extract_slices into the binary slice format:
+
+        4 bytes   magic "CNHS"
+        1 byte    format version
+        3 bytes   padding
+        4 bytes   header length (uint32, little-endian)
+        n bytes   UTF-8 JSON header, space-padded so the data starts 8-byte aligned
+        ...       raw little-endian arrays, each starting on an 8 byte boundary
+
+    The JSON header carries labels, max_index and one entry per array with
+    its name, dtype, shape, byte offset (relative to the start of the data
+    section) and the scale/offset that map stored values back to intensities.
+    `extra` is merged into the JSON header.
+    """
+    if encoding not in INTENSITY_ENCODINGS:
+        raise ValueError(f"Unknown encoding {encoding}, expected one of {', '.join(INTENSITY_ENCODINGS)}")
+
+    arrays = []
+    entries = []
+    position = 0
+    for group in ("brain", "atlas"):
+        for plane, data in slices[group].items():
+            if group == "brain":
+                array, scale, offset = _quantize(data, encoding)
+            else:
+                array, scale, offset = _label_array(data), 1.0, 0.0
+            array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<"))
+            entries.append({
+                "name": f"{group}.{plane}",
+                "dtype": array.dtype.name,
+                "shape": list(array.shape),
+                "offset": position,
+                "scale": scale,
+                "value_offset": offset,
+            })
+            arrays.append(array)
+            position += array.nbytes
+            position += -position % _ALIGNMENT
+
+    header = json.dumps({
+        "version": SLICE_FORMAT_VERSION,
+        "labels": [_label_text(label) for label in slices["labels"]],
+        "max_index": int(slices["max_index"]),
+        "arrays": entries,
+        **(extra or {}),
+    }, separators=(",", ":")).encode("utf-8")
+    prefix_length = len(SLICE_MAGIC) + struct.calcsize("<B3xI")
+    header += b" " * (-(prefix_length + len(header)) % _ALIGNMENT)
+
+    parts = [SLICE_MAGIC, struct.pack("<B3xI", SLICE_FORMAT_VERSION, len(header)), header]
+    for array in arrays:
+        raw = array.tobytes()
+        parts.append(raw)
+        parts.append(b"\0" * (-len(raw) % _ALIGNMENT))
+    return b"".join(parts)
@@ -1,33 +1,30 @@
+import hashlib
 import nibabel as nib
 import numpy as np
 from nilearn import datasets, image
 import os
+import threading
+from metrics import time_stage, CACHE_REQUESTS
 
+# Resampled atlases are stored here as .npy files and memory-mapped, so every
+# worker process shares one copy per (atlas, target geometry)
+ATLAS_CACHE_DIR = os.getenv("ATLAS_CACHE_DIR", "atlas_cache")
 
-def get_slices(fmri_path: str, slice_index: int, atlas_name: str = "Harvard-Oxford"):
-    """
-    Load an fMRI NIfTI file, resample the chosen atlas to its space, and extract 2D slices.
+# Volumes read per step when averaging a 4D scan over time
+MEAN_CHUNK_VOLUMES = int(os.getenv("MEAN_CHUNK_VOLUMES", "16"))
 
-    Parameters:
-    - fmri_path: path to the NIfTI file on disk
-    - slice_index: index of the axial slice to extract
-    - atlas_name: one of 'Harvard-Oxford', 'Craddock2012', or 'Destrieux'
+_atlases = {}
+_resampled_atlases = {}
+_atlas_lock = threading.Lock()
 
-    Returns a dict with:
-    - brain: dict of 2D brain data arrays (axial, coronal, sagittal)
-    - atlas: dict of 2D atlas label arrays (axial, coronal, sagittal)
-    - labels: list of atlas region names
-    - max_index: maximum valid slice index (axial depth - 1)
-    """
-    try:
-        # Check file exists
-        if not os.path.exists(fmri_path):
-            raise FileNotFoundError(f"File not found: {fmri_path}")
 
-        # Load NIfTI image
-        brain_img = nib.load(fmri_path)
-        if not isinstance(brain_img, nib.Nifti1Image):
-            raise ValueError("File is not a valid NIfTI image")
+def _fetch_atlas(atlas_name: str):
+    """
+    Return (maps_img, labels) for the chosen atlas, fetched once per process.
+    """
+    with _atlas_lock:
+        if atlas_name in _atlases:
+            return _atlases[atlas_name]
 
         # Select atlas based on user choice
         if atlas_name == "Craddock2012":
@@ -45,45 +42,171 @@ def get_slices(fmri_path: str, slice_index: int, atlas_name: str = "Harvard-Oxfo
             maps_img = atl.maps
             labels = atl.labels
 
+        _atlases[atlas_name] = (image.load_img(maps_img), labels)
+        return _atlases[atlas_name]
+
+
+def register_atlas(atlas_name: str, maps_img, labels):
+    """
+    Make a local atlas available under `atlas_name` without fetching it
+    (offline use, e.g. the benchmarks).
+    """
+    with _atlas_lock:
+        _atlases[atlas_name] = (image.load_img(maps_img), list(labels))
+
+
+def _smallest_label_dtype(data):
+    if data.size == 0:
+        return np.uint8
+    low, high = int(data.min()), int(data.max())
+    if low >= 0:
+        return np.min_scalar_type(high)
+    return np.result_type(np.min_scalar_type(low), np.min_scalar_type(high))
+
+
+def get_resampled_atlas(atlas_name: str, brain_img):
+    """
+    Integer label volume of `atlas_name` on the voxel grid of `brain_img`.
+
+    Keyed by atlas name plus target affine and shape; the first request for
+    a geometry resamples and writes a .npy in the smallest integer dtype that
+    fits, later requests (in any worker) memory-map it.
+    """
+    affine = np.round(np.asarray(brain_img.affine, dtype=np.float64), 6)
+    shape = tuple(int(n) for n in brain_img.shape[:3])
+    digest = hashlib.sha1(repr((atlas_name, affine.tolist(), shape)).encode()).hexdigest()
+
+    atlas_data = _resampled_atlases.get(digest)
+    if atlas_data is not None:
+        CACHE_REQUESTS.inc(cache="atlas", result="hit")
+        return atlas_data
+
+    safe_name = "".join(c if c.isalnum() else "_" for c in atlas_name or "default")
+    path = os.path.join(ATLAS_CACHE_DIR, f"{safe_name}_{digest}.npy")
+    if not os.path.exists(path):
+        CACHE_REQUESTS.inc(cache="atlas", result="miss")
+        maps_img, _ = _fetch_atlas(atlas_name)
+
         # Resample atlas to match the fMRI image space
-        resampled_atlas = image.resample_to_img(
-            maps_img,
-            brain_img,
-            interpolation='nearest',
-            copy_header=True
-        )
+        with time_stage("atlas_resample"):
+            resampled_atlas = image.resample_img(
+                maps_img,
+                target_affine=brain_img.affine,
+                target_shape=shape,
+                interpolation='nearest'
+            )
+        labels_data = np.rint(resampled_atlas.get_fdata())
+        labels_data = labels_data.astype(_smallest_label_dtype(labels_data))
+
+        os.makedirs(ATLAS_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp.npy"
+        np.save(tmp_path, labels_data)
+        os.replace(tmp_path, path)
 
-        # Convert to numpy arrays
-        brain_data = brain_img.get_fdata()
-        atlas_data = resampled_atlas.get_fdata().astype(int)
+    else:
+        CACHE_REQUESTS.inc(cache="atlas", result="disk_hit")
+
+    atlas_data = np.load(path, mmap_mode="r")
+    _resampled_atlases[digest] = atlas_data
+    return atlas_data
+
+
+def temporal_mean(img, chunk_volumes: int = MEAN_CHUNK_VOLUMES):
+    """
+    Mean over time of a 4D image as a float32 volume, reading `chunk_volumes`
+    timepoints at a time through the array proxy.
+    """
+    n_volumes = img.shape[3]
+    total = np.zeros(img.shape[:3], dtype=np.float64)
+    for start in range(0, n_volumes, chunk_volumes):
+        chunk = np.asarray(img.dataobj[..., start:start + chunk_volumes], dtype=np.float32)
+        total += chunk.sum(axis=3, dtype=np.float64)
+    return (total / max(n_volumes, 1)).astype(np.float32)
+
+
+def _read_plane(img, axis: int, index: int, timepoint=None):
+    """
+    Read one 2D plane through the image's array proxy, so only that plane
+    (not the whole volume) is pulled from disk.
+    """
+    indexer = [slice(None)] * 3
+    indexer[axis] = index
+    if len(img.shape) > 3:
+        indexer.append(timepoint)
+    return np.asarray(img.dataobj[tuple(indexer)], dtype=np.float32)
+
+
+def extract_slices(fmri_path, slice_index: int, atlas_name: str = "Harvard-Oxford", timepoint: int = None):
+    """
+    Load an fMRI NIfTI file, resample the chosen atlas to its space, and extract 2D slices
+    as numpy arrays. See get_slices for the JSON-ready version.
+
+    Parameters:
+    - fmri_path: path to the NIfTI file on disk, or an already loaded NIfTI image
+    - slice_index: index of the axial slice to extract
+    - atlas_name: one of 'Harvard-Oxford', 'Craddock2012', or 'Destrieux'
+    - timepoint: volume to show for 4D scans; defaults to the temporal mean.
+      Pass a precomputed mean image (VolumeCache.get_mean_path) to avoid
+      averaging on every call.
+
+    Returns a dict with:
+    - brain: dict of 2D brain data arrays (axial, coronal, sagittal)
+    - atlas: dict of 2D atlas label arrays (axial, coronal, sagittal)
+    - labels: list of atlas region names
+    - max_index: maximum valid slice index (axial depth - 1)
+    """
+    try:
+        if isinstance(fmri_path, nib.spatialimages.SpatialImage):
+            brain_img = fmri_path
+        else:
+            # Check file exists
+            if not os.path.exists(fmri_path):
+                raise FileNotFoundError(f"File not found: {fmri_path}")
+
+            # Load NIfTI image (memory-mapped when uncompressed)
+            brain_img = nib.load(fmri_path, mmap=True)
+        if not isinstance(brain_img, nib.Nifti1Image):
+            raise ValueError("File is not a valid NIfTI image")
+
+        shape = brain_img.shape
+        if len(shape) > 3:
+            if timepoint is None:
+                brain_img = nib.Nifti1Image(temporal_mean(brain_img), brain_img.affine)
+            elif timepoint < 0 or timepoint >= shape[3]:
+                raise ValueError(
+                    f"Timepoint must be between 0 and {shape[3] - 1}, got {timepoint}"
+                )
+
+        _, labels = _fetch_atlas(atlas_name)
+        atlas_data = get_resampled_atlas(atlas_name, brain_img)
 
         # Validate slice index
-        if slice_index < 0 or slice_index >= brain_data.shape[2]:
+        if slice_index < 0 or slice_index >= shape[2]:
             raise ValueError(
-                f"Slice index must be between 0 and {brain_data.shape[2] - 1}, got {slice_index}"
+                f"Slice index must be between 0 and {shape[2] - 1}, got {slice_index}"
             )
 
         # Extract 2D slices
-        axial_slice    = brain_data[:, :, slice_index]
-        coronal_slice  = brain_data[:, slice_index, :]
-        sagittal_slice = brain_data[slice_index, :, :]
+        axial_slice    = _read_plane(brain_img, 2, slice_index, timepoint)
+        coronal_slice  = _read_plane(brain_img, 1, slice_index, timepoint)
+        sagittal_slice = _read_plane(brain_img, 0, slice_index, timepoint)
 
-        axial_atlas    = atlas_data[:, :, slice_index]
-        coronal_atlas  = atlas_data[:, slice_index, :]
-        sagittal_atlas = atlas_data[slice_index, :, :]
+        axial_atlas    = np.array(atlas_data[:, :, slice_index])
+        coronal_atlas  = np.array(atlas_data[:, slice_index, :])
+        sagittal_atlas = np.array(atlas_data[slice_index, :, :])
 
-        max_index = brain_data.shape[2] - 1
+        max_index = shape[2] - 1
 
         return {
             "brain": {
-                "axial":    axial_slice.tolist(),
-                "coronal":  coronal_slice.tolist(),
-                "sagittal": sagittal_slice.tolist(),
+                "axial":    axial_slice,
+                "coronal":  coronal_slice,
+                "sagittal": sagittal_slice,
             },
             "atlas": {
-                "axial":    axial_atlas.tolist(),
-                "coronal":  coronal_atlas.tolist(),
-                "sagittal": sagittal_atlas.tolist(),
+                "axial":    axial_atlas,
+                "coronal":  coronal_atlas,
+                "sagittal": sagittal_atlas,
             },
             "labels":    labels,
             "max_index": max_index
@@ -91,3 +214,22 @@ def get_slices(fmri_path: str, slice_index: int, atlas_name: str = "Harvard-Oxfo
 
     except Exception as e:
         raise ValueError(f"Error processing fMRI data: {str(e)}")
+
+
+def get_slices(fmri_path, slice_index: int, atlas_name: str = "Harvard-Oxford", timepoint: int = None):
+    """
+    Same as extract_slices, with the arrays converted to nested lists for JSON.
+    """
+    return slices_to_lists(extract_slices(fmri_path, slice_index, atlas_name, timepoint))
+
+
+def slices_to_lists(slices):
+    """
+    Nested-list (JSON-ready) form of an extract_slices result.
+    """
+    return {
+        "brain": {plane: data.tolist() for plane, data in slices["brain"].items()},
+        "atlas": {plane: data.tolist() for plane, data in slices["atlas"].items()},
+        "labels": slices["labels"],
+        "max_index": slices["max_index"],
+    }
@@ -0,0 +1,109 @@
+import threading
+from collections import OrderedDict
+import nibabel as nib
+import numpy as np
+
+from src.plotlyViz.binary import encode_slices
+from src.plotlyViz.controller import _fetch_atlas, get_resampled_atlas
+
+AXES = {"sagittal": 0, "coronal": 1, "axial": 2}
+PREFETCH_DEPTH = 4
+FRAME_CACHE_SIZE = 64
+
+
+class SliceSession:
+    """
+    Server-side state for one slice-scrubbing connection: the decoded 3D
+    volume, the resampled atlas and a small cache of encoded plane frames.
+    Each axis is indexed independently, and frames ahead of the last
+    request (in the direction of travel) are encoded speculatively.
+    """
+
+    def __init__(self, volume, atlas_data, labels, encoding: str = "uint16"):
+        self.volume = volume
+        self.atlas_data = atlas_data
+        self.labels = labels
+        self.encoding = encoding
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_index = {}
+
+    @classmethod
+    def open(cls, volume, atlas_name: str, timepoint: int = None, encoding: str = "uint16"):
+        # `volume` is a NIfTI path or an already loaded image
+        img = volume if isinstance(volume, nib.spatialimages.SpatialImage) else nib.load(volume, mmap=True)
+        if len(img.shape) > 3:
+            t = 0 if timepoint is None else timepoint
+            volume = np.asarray(img.dataobj[..., t], dtype=np.float32)
+            img = nib.Nifti1Image(volume, img.affine)
+        else:
+            volume = np.asarray(img.dataobj, dtype=np.float32)
+        _, labels = _fetch_atlas(atlas_name)
+        atlas_data = get_resampled_atlas(atlas_name, img)
+        return cls(volume, atlas_data, labels, encoding)
+
+    def describe(self):
+        return {
+            "type": "ready",
+            "shape": list(self.volume.shape),
+            "max_index": {axis: self.volume.shape[dim] - 1 for axis, dim in AXES.items()},
+            "labels": [label.decode() if isinstance(label, bytes) else str(label) for label in self.labels],
+            "encoding": self.encoding,
+        }
+
+    def _encode(self, axis: str, index: int):
+        dim = AXES[axis]
+        indexer = [slice(None)] * 3
+        indexer[dim] = index
+        indexer = tuple(indexer)
+        slices = {
+            "brain": {axis: self.volume[indexer]},
+            "atlas": {axis: np.asarray(self.atlas_data[indexer])},
+            "labels": [],
+            "max_index": self.volume.shape[dim] - 1,
+        }
+        return encode_slices(slices, self.encoding, extra={"axis": axis, "index": index})
+
+    def frame(self, axis: str, index: int):
+        if axis not in AXES:
+            raise ValueError(f"Unknown axis {axis}, expected one of {', '.join(AXES)}")
+        if index < 0 or index >= self.volume.shape[AXES[axis]]:
+            raise ValueError(f"{axis} index must be between 0 and {self.volume.shape[AXES[axis]] - 1}, got {index}")
+
+        key = (axis, index)
+        with self._lock:
+            frame = self._frames.get(key)
+            if frame is not None:
+                self._frames.move_to_end(key)
+                return frame
+
+        frame = self._encode(axis, index)
+        self._store(key, frame)
+        return frame
+
+    def _store(self, key, frame):
+        with self._lock:
+            self._frames[key] = frame
+            self._frames.move_to_end(key)
+            while len(self._frames) > FRAME_CACHE_SIZE:
+                self._frames.popitem(last=False)
+
+    def prefetch(self, axis: str, index: int, depth: int = PREFETCH_DEPTH):
+        """
+        Encode the next `depth` frames after `index` in the direction the
+        client has been moving along this axis.
+        """
+        previous = self._last_index.get(axis, index)
+        self._last_index[axis] = index
+        direction = -1 if index < previous else 1
+
+        size = self.volume.shape[AXES[axis]]
+        for step in range(1, depth + 1):
+            neighbour = index + direction * step
+            if neighbour < 0 or neighbour >= size:
+                break
+            key = (axis, neighbour)
+            with self._lock:
+                if key in self._frames:
+                    continue
+            self._store(key, self._encode(axis, neighbour))
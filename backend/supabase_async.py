@@ -0,0 +1,175 @@
+import asyncio
+import base64
+import os
+from urllib.parse import quote
+import httpx
+
+SUPABASE_TIMEOUT_SECONDS = float(os.getenv("SUPABASE_TIMEOUT_SECONDS", "60"))
+SUPABASE_MAX_CONNECTIONS = int(os.getenv("SUPABASE_MAX_CONNECTIONS", "50"))
+SUPABASE_KEEPALIVE_CONNECTIONS = int(os.getenv("SUPABASE_KEEPALIVE_CONNECTIONS", "20"))
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+# Chunk size Supabase Storage's resumable endpoint expects
+RESUMABLE_CHUNK_BYTES = 6 * 1024 * 1024
+TUS_VERSION = "1.0.0"
+
+
+class SupabaseError(Exception):
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class AsyncSupabase:
+    """
+    Async access to the Supabase REST (PostgREST) and Storage APIs over one
+    pooled keep-alive httpx.AsyncClient.
+
+    Requests are authenticated with the anon key unless the instance comes
+    from `with_auth(token)`, which returns a view that sends the user's JWT
+    on its own requests while sharing the same connection pool. Nothing
+    global is mutated, so concurrent requests for different users are safe.
+    """
+
+    def __init__(self, url: str, key: str, http: httpx.AsyncClient = None, token: str = None):
+        self.url = url.rstrip("/")
+        self.key = key
+        self.token = token
+        self._http = http or httpx.AsyncClient(
+            timeout=SUPABASE_TIMEOUT_SECONDS,
+            limits=httpx.Limits(max_connections=SUPABASE_MAX_CONNECTIONS,
+                                max_keepalive_connections=SUPABASE_KEEPALIVE_CONNECTIONS),
+        )
+
+    def with_auth(self, token: str):
+        return AsyncSupabase(self.url, self.key, http=self._http, token=token)
+
+    async def aclose(self):
+        await self._http.aclose()
+
+    def _headers(self, extra=None):
+        headers = {"apikey": self.key, "Authorization": f"Bearer {self.token or self.key}"}
+        if extra:
+            headers.update(extra)
+        return headers
+
+    async def _request(self, method: str, path: str, **kwargs):
+        headers = self._headers(kwargs.pop("headers", None))
+        url = path if path.startswith("http") else f"{self.url}{path}"
+        response = await self._http.request(method, url, headers=headers, **kwargs)
+        if response.status_code >= 400:
+            try:
+                body = response.json()
+                message = body.get("message") or body.get("error") or response.text
+            except ValueError:
+                message = response.text
+            raise SupabaseError(response.status_code, f"{method} {path} failed: {message}")
+        return response
+
+    # Database (PostgREST)
+
+    async def select(self, table: str, columns: str = "*", filters=None, order: str = None,
+                     limit: int = None, params=None):
+        """
+        Rows of `table`. `filters` is a list of (column, operator, value)
+        tuples, e.g. [("fmri_id", "eq", 5)]; `order` uses PostgREST syntax
+        ("date.desc,fmri_id.desc"); `params` adds raw query parameters.
+        """
+        query = [("select", columns)]
+        for column, operator, value in filters or []:
+            query.append((column, f"{operator}.{value}"))
+        if order:
+            query.append(("order", order))
+        if limit is not None:
+            query.append(("limit", str(limit)))
+        query.extend(params or [])
+        response = await self._request("GET", f"/rest/v1/{table}", params=query)
+        return response.json()
+
+    async def select_one(self, table: str, columns: str = "*", filters=None):
+        rows = await self.select(table, columns, filters, limit=1)
+        return rows[0] if rows else None
+
+    async def insert(self, table: str, values):
+        response = await self._request("POST", f"/rest/v1/{table}", json=values,
+                                       headers={"Prefer": "return=representation"})
+        return response.json()
+
+    async def update(self, table: str, values: dict, filters):
+        query = [(column, f"{operator}.{value}") for column, operator, value in filters]
+        response = await self._request("PATCH", f"/rest/v1/{table}", json=values, params=query,
+                                       headers={"Prefer": "return=representation"})
+        return response.json()
+
+    # Storage
+
+    def _object_path(self, bucket: str, path: str):
+        return f"/storage/v1/object/{quote(bucket)}/{quote(path)}"
+
+    async def download(self, bucket: str, path: str):
+        response = await self._request("GET", self._object_path(bucket, path))
+        return response.content
+
+    async def upload_file(self, bucket: str, path: str, file_path: str, content_type: str = None):
+        """
+        Stream a local file into storage without reading it all into memory.
+        """
+        size = os.path.getsize(file_path)
+
+        async def chunks():
+            with open(file_path, "rb") as f:
+                while chunk := await asyncio.to_thread(f.read, UPLOAD_CHUNK_BYTES):
+                    yield chunk
+
+        headers = {
+            "Content-Type": content_type or "application/octet-stream",
+            "Content-Length": str(size),
+            "x-upsert": "false",
+        }
+        response = await self._request("POST", self._object_path(bucket, path), content=chunks(), headers=headers)
+        return response.json()
+
+    # Resumable (TUS) uploads. Storage requires PATCHes in order, each a
+    # multiple of RESUMABLE_CHUNK_BYTES except the last.
+
+    async def create_resumable_upload(self, bucket: str, path: str, length: int, content_type: str = None):
+        """
+        Start a resumable upload of `length` bytes; returns its upload URL.
+        """
+        def encode(value: str):
+            return base64.b64encode(value.encode()).decode()
+
+        metadata = {
+            "bucketName": bucket,
+            "objectName": path,
+            "contentType": content_type or "application/octet-stream",
+        }
+        headers = {
+            "Tus-Resumable": TUS_VERSION,
+            "Upload-Length": str(length),
+            "Upload-Metadata": ",".join(f"{key} {encode(value)}" for key, value in metadata.items()),
+            "x-upsert": "false",
+        }
+        response = await self._request("POST", "/storage/v1/upload/resumable", headers=headers)
+        location = response.headers["location"]
+        return location if location.startswith("http") else f"{self.url}{location}"
+
+    async def resumable_offset(self, upload_url: str):
+        response = await self._request("HEAD", upload_url, headers={"Tus-Resumable": TUS_VERSION})
+        return int(response.headers["upload-offset"])
+
+    async def upload_resumable_chunk(self, upload_url: str, offset: int, data: bytes):
+        """
+        Append `data` at `offset`; returns the new offset.
+        """
+        headers = {
+            "Tus-Resumable": TUS_VERSION,
+            "Upload-Offset": str(offset),
+            "Content-Type": "application/offset+octet-stream",
+        }
+        response = await self._request("PATCH", upload_url, content=data, headers=headers)
+        return int(response.headers.get("upload-offset", offset + len(data)))
+
+    async def upload_bytes(self, bucket: str, path: str, data: bytes, content_type: str = None):
+        headers = {"Content-Type": content_type or "application/octet-stream", "x-upsert": "false"}
+        response = await self._request("POST", self._object_path(bucket, path), content=data, headers=headers)
+        return response.json()
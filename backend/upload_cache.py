@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+UPLOAD_CACHE_DIR = os.getenv("UPLOAD_CACHE_DIR", "upload_cache")
+UPLOAD_CACHE_ENTRIES = int(os.getenv("UPLOAD_CACHE_ENTRIES", "100000"))
+HASH_CHUNK_BYTES = 1024 * 1024
+
+_LOG_FILE = "log.jsonl"
+# Written by earlier versions; read once as the starting state
+_INDEX_FILE = "index.json"
+
+
+def file_sha256(path: str):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_BYTES):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class UploadCache:
+    """
+    Scans seen before, keyed by the SHA-256 of their bytes: where the bytes
+    already live in storage and what the model said about them, so an
+    identical re-upload skips the storage write and inference and only
+    needs its own history row.
+
+    Entries are small and kept in memory in LRU order. Each change appends
+    one line to a log, so a write costs the size of one entry rather than
+    the whole cache; the log is replayed and compacted on startup. Writes
+    do file I/O, so async callers should run them in a thread. A result is
+    only recorded for a scan whose prediction succeeded.
+    """
+
+    def __init__(self, directory: str = UPLOAD_CACHE_DIR, max_entries: int = UPLOAD_CACHE_ENTRIES):
+        self.directory = directory
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "result_hits": 0, "misses": 0}
+        os.makedirs(directory, exist_ok=True)
+        self._log_path = os.path.join(directory, _LOG_FILE)
+        entries, n_records = self._replay()
+        ordered = sorted(entries.items(), key=lambda item: item[1].get("used_at", 0))
+        self._entries = OrderedDict(ordered[-max_entries:] if max_entries else [])
+        self._records = n_records
+        if n_records > len(self._entries):
+            self._compact()
+
+    def _replay(self):
+        """
+        (digest -> entry, number of log records); the last record for a digest wins.
+        """
+        entries = {}
+        try:
+            with open(os.path.join(self.directory, _INDEX_FILE)) as f:
+                entries.update(json.load(f))
+        except (FileNotFoundError, ValueError):
+            pass
+        n_records = len(entries)
+        try:
+            with open(self._log_path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash mid-append
+                        continue
+                    entries[record.pop("digest")] = record
+                    n_records += 1
+        except FileNotFoundError:
+            pass
+        return entries, n_records
+
+    def _compact(self):
+        tmp_path = f"{self._log_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            for digest, entry in self._entries.items():
+                f.write(json.dumps({"digest": digest, **entry}) + "\n")
+        os.replace(tmp_path, self._log_path)
+        self._records = len(self._entries)
+        old_index = os.path.join(self.directory, _INDEX_FILE)
+        if os.path.exists(old_index):
+            os.unlink(old_index)
+
+    def _append(self, digest: str, entry: dict):
+        # Caller holds the lock, so lines from different threads don't interleave
+        with open(self._log_path, "a") as f:
+            f.write(json.dumps({"digest": digest, **entry}) + "\n")
+        self._records += 1
+        # Evicted and superseded records pile up; rewrite once they dominate
+        if self._records > 2 * self.max_entries:
+            self._compact()
+
+    def get(self, digest: str):
+        """
+        The entry for `digest` ({"file_link", "size", "model_result",
+        "fmri_id"}; the last two are None until a prediction is recorded),
+        or None for an unseen scan.
+        """
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(digest)
+            entry["used_at"] = time.time()
+            self.stats["hits"] += 1
+            if entry.get("model_result") is not None:
+                self.stats["result_hits"] += 1
+            return dict(entry)
+
+    def put_object(self, digest: str, file_link: str, size: int):
+        """
+        Record that the scan is in storage under `file_link`. The first
+        object stored for a hash wins.
+        """
+        with self._lock:
+            if digest in self._entries:
+                return
+            self._entries[digest] = {
+                "file_link": file_link, "size": size, "model_result": None, "fmri_id": None,
+                "used_at": time.time(),
+            }
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._append(digest, self._entries[digest])
+
+    def put_result(self, digest: str, model_result, fmri_id: int, file_link: str = None):
+        """
+        Record the prediction for a stored scan. `file_link` replaces the
+        stored object when the pipeline stored a converted copy (a DICOM
+        series becomes a NIfTI) that re-uploads should point at instead.
+        """
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None or entry.get("model_result") is not None:
+                return
+            entry["model_result"] = model_result
+            entry["fmri_id"] = fmri_id
+            if file_link:
+                entry["file_link"] = file_link
+            self._append(digest, entry)
+
+    def info(self):
+        with self._lock:
+            return {**self.stats, "entries": len(self._entries)}
+
+
+upload_cache = UploadCache()
@@ -0,0 +1,249 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+import nibabel as nib
+from src.plotlyViz.controller import temporal_mean
+
+VOLUME_CACHE_DIR = os.getenv("VOLUME_CACHE_DIR", "volume_cache")
+VOLUME_CACHE_MEMORY_MB = int(os.getenv("VOLUME_CACHE_MEMORY_MB", "1024"))
+VOLUME_CACHE_DISK_MB = int(os.getenv("VOLUME_CACHE_DISK_MB", "10240"))
+VOLUME_CACHE_TTL_SECONDS = int(os.getenv("VOLUME_CACHE_TTL_SECONDS", "3600"))
+
+
+class _Entry:
+    def __init__(self, img, nbytes):
+        self.img = img
+        self.nbytes = nbytes
+        self.loaded_at = time.time()
+
+
+class VolumeCache:
+    """
+    Read-through cache of decoded NIfTI volumes keyed by storage file_link.
+
+    Two tiers: decoded 3D display volumes (a scan's temporal mean or one
+    timepoint) in memory within a byte budget, and an on-disk store of
+    uncompressed .nii copies (plus temporal means of 4D scans) that nibabel
+    can memory-map. A miss on both tiers calls the loader (the storage
+    download) once, even when several requests for the same key arrive
+    together. Entries are evicted by LRU within each budget and expire
+    after the TTL.
+    """
+
+    def __init__(self, directory: str = VOLUME_CACHE_DIR,
+                 memory_budget: int = VOLUME_CACHE_MEMORY_MB * 1024 * 1024,
+                 disk_budget: int = VOLUME_CACHE_DISK_MB * 1024 * 1024,
+                 ttl: float = VOLUME_CACHE_TTL_SECONDS):
+        self.directory = directory
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        # key -> [lock, number of threads using it]; dropped when unused
+        self._key_locks = {}
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+    def disk_path(self, key: str):
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.directory, f"{digest}.nii")
+
+    @contextmanager
+    def _key_lock(self, key):
+        with self._lock:
+            entry = self._key_locks.get(key)
+            if entry is None:
+                entry = self._key_locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._key_locks[key]
+
+    def _memory_get(self, key: str):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry.loaded_at > self.ttl:
+                self._drop(key)
+                return None
+            self._memory.move_to_end(key)
+            self.stats["memory_hits"] += 1
+            return entry.img
+
+    def _drop(self, key: str):
+        entry = self._memory.pop(key)
+        self._memory_bytes -= entry.nbytes
+
+    def _memory_put(self, key: str, img, nbytes: int):
+        with self._lock:
+            if key in self._memory:
+                self._drop(key)
+            if nbytes > self.memory_budget:
+                # Too big for the memory tier, it is served from disk only
+                return
+            self._memory[key] = _Entry(img, nbytes)
+            self._memory_bytes += nbytes
+            while self._memory_bytes > self.memory_budget:
+                oldest = next(iter(self._memory))
+                self._drop(oldest)
+                self.stats["evictions"] += 1
+
+    def _disk_fresh(self, path: str):
+        try:
+            return time.time() - os.path.getmtime(path) <= self.ttl
+        except FileNotFoundError:
+            return False
+
+    def _decode(self, disk_img, timepoint: int = None):
+        if len(disk_img.shape) > 3:
+            if timepoint is None or timepoint < 0 or timepoint >= disk_img.shape[3]:
+                raise ValueError(f"Timepoint must be between 0 and {disk_img.shape[3] - 1}, got {timepoint}")
+            data = np.asarray(disk_img.dataobj[..., timepoint], dtype=np.float32)
+        else:
+            data = np.asarray(disk_img.dataobj, dtype=np.float32)
+        return nib.Nifti1Image(data, disk_img.affine), data.nbytes
+
+    def get_path(self, key: str, loader):
+        """
+        Path of the uncompressed on-disk copy of `key`, suitable for
+        nib.load(..., mmap=True). `loader(dest_path)` is only called when the
+        disk tier misses and must write the source NIfTI (.nii or .nii.gz) to
+        `dest_path`.
+        """
+        path = self.disk_path(key)
+        with self._key_lock(key):
+            if self._disk_fresh(path):
+                with self._lock:
+                    self.stats["disk_hits"] += 1
+                os.utime(path)
+            else:
+                with self._lock:
+                    self.stats["misses"] += 1
+                self._fill_disk(key, path, loader)
+        return path
+
+    def get_mean_path(self, key: str, loader):
+        """
+        Like get_path, but for 4D scans returns a cached 3D temporal mean,
+        computed once by streaming the time series in chunks.
+        """
+        path = self.get_path(key, loader)
+        img = nib.load(path, mmap=True)
+        if len(img.shape) < 4:
+            return path
+
+        mean_path = path[:-len(".nii")] + "_mean.nii"
+        with self._key_lock(key):
+            if not self._disk_fresh(mean_path):
+                mean_img = nib.Nifti1Image(temporal_mean(img), img.affine)
+                tmp_path = f"{mean_path}.{os.getpid()}.{threading.get_ident()}.tmp.nii"
+                nib.save(mean_img, tmp_path)
+                os.replace(tmp_path, mean_path)
+            else:
+                os.utime(mean_path)
+        return mean_path
+
+    def get_volume(self, key: str, loader, timepoint: int = None):
+        """
+        The decoded 3D volume to display for `key`: the temporal mean of a
+        4D scan, or its `timepoint`. Served from memory when possible.
+        """
+        memory_key = (key, timepoint)
+        img = self._memory_get(memory_key)
+        if img is not None:
+            return img
+
+        path = self.get_mean_path(key, loader) if timepoint is None else self.get_path(key, loader)
+        with self._key_lock(memory_key):
+            # Another request may have filled the cache while we waited
+            img = self._memory_get(memory_key)
+            if img is not None:
+                return img
+
+            img, nbytes = self._decode(nib.load(path, mmap=True), timepoint)
+            self._memory_put(memory_key, img, nbytes)
+            return img
+
+    def _fill_disk(self, key: str, path: str, loader):
+        suffix = ".nii.gz" if key.lower().endswith(".gz") else ".nii"
+        download_path = f"{path}.{os.getpid()}.{threading.get_ident()}{suffix}"
+        try:
+            loader(download_path)
+            if suffix == ".nii":
+                os.replace(download_path, path)
+            else:
+                # Store uncompressed so later reads can be memory-mapped
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp.nii"
+                nib.save(nib.load(download_path), tmp_path)
+                os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(download_path):
+                os.unlink(download_path)
+        self._evict_disk()
+
+    def _evict_disk(self):
+        entries = []
+        total = 0
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if not name.endswith(".nii") or name.count(".") > 1:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime > self.ttl:
+                self._unlink(path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        entries.sort()
+        while total > self.disk_budget and entries:
+            _, size, path = entries.pop(0)
+            self._unlink(path)
+            total -= size
+
+    def _unlink(self, path: str):
+        try:
+            os.unlink(path)
+            with self._lock:
+                self.stats["evictions"] += 1
+        except FileNotFoundError:
+            pass
+
+    def invalidate(self, key: str):
+        with self._lock:
+            for memory_key in [k for k in self._memory if k[0] == key]:
+                self._drop(memory_key)
+        path = self.disk_path(key)
+        self._unlink(path)
+        self._unlink(path[:-len(".nii")] + "_mean.nii")
+
+    def info(self):
+        with self._lock:
+            return {
+                **self.stats,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "memory_budget": self.memory_budget,
+                "disk_budget": self.disk_budget,
+                "ttl": self.ttl,
+            }
+
+
+volume_cache = VolumeCache()
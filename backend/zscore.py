@@ -0,0 +1,146 @@
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+import numpy as np
+import nibabel as nib
+from nilearn.image import resample_img
+
+from metrics import log_event
+from nifti_store import nifti_store
+from src.plotlyViz.controller import temporal_mean
+
+BASELINE_DIR = os.getenv("BASELINE_DIR", "brain_analysis_results")
+ZSCORE_CACHE_DIR = os.getenv("ZSCORE_CACHE_DIR", "zscore_cache")
+# Same cut-off as the heatmap in fMRI_Intensity_Draft.ipynb
+HEATMAP_THRESHOLD = float(os.getenv("HEATMAP_THRESHOLD", "0.01"))
+STD_FLOOR = 1e-6
+
+_baseline = None
+_baseline_lock = threading.Lock()
+# fmri_id -> [lock, number of requests using it]; dropped when unused
+_patient_locks = {}
+
+
+def _uncompressed_copy(name: str):
+    """
+    Path of an uncompressed float32 copy of brain_analysis_results/<name>.nii.gz,
+    written on first use so it can be memory-mapped afterwards.
+    """
+    source = os.path.join(BASELINE_DIR, f"{name}.nii.gz")
+    target = os.path.join(ZSCORE_CACHE_DIR, f"{name}_f32.nii")
+    if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source):
+        return target
+
+    os.makedirs(ZSCORE_CACHE_DIR, exist_ok=True)
+    img = nib.load(source)
+    data = np.asarray(img.dataobj, dtype=np.float32)
+    converted = nib.Nifti1Image(data, img.affine)
+    converted.header.set_data_dtype(np.float32)
+    tmp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp.nii"
+    nib.save(converted, tmp_path)
+    os.replace(tmp_path, target)
+    return target
+
+
+def baseline_version():
+    """
+    Short tag that changes whenever the baseline files are rewritten
+    (e.g. by build_baseline.py --update).
+    """
+    mtimes = [os.stat(os.path.join(BASELINE_DIR, f"{name}.nii.gz")).st_mtime_ns
+              for name in ("baseline_mean", "baseline_std")]
+    return hashlib.sha1(repr(mtimes).encode()).hexdigest()[:12]
+
+
+def load_baseline():
+    """
+    (mean, std, affine) of the healthy baseline. mean and std are read-only
+    float32 memory maps shared by every request in the process, reloaded
+    when the baseline changes on disk.
+    """
+    global _baseline
+    version = baseline_version()
+    with _baseline_lock:
+        if _baseline is None or _baseline[0] != version:
+            mean_img = nib.load(_uncompressed_copy("baseline_mean"), mmap=True)
+            std_img = nib.load(_uncompressed_copy("baseline_std"), mmap=True)
+            mean = np.asarray(mean_img.dataobj)
+            std = np.asarray(std_img.dataobj)
+            _baseline = (version, (mean, std, mean_img.affine))
+        return _baseline[1]
+
+
+def compute_zscore(nifti_path: str):
+    """
+    Voxelwise z-score of a patient scan against the healthy baseline.
+
+    The patient's 4D series is averaged over time in chunks (peak memory is a
+    few volumes), moved onto the baseline grid if needed, then compared with
+    (patient - mean) / std. Returns (z_img, heatmap_img) on the baseline grid.
+    """
+    baseline_mean, baseline_std, baseline_affine = load_baseline()
+
+    patient_img = nib.load(nifti_path, mmap=True)
+    if len(patient_img.shape) > 3:
+        patient_mean = temporal_mean(patient_img)
+    else:
+        patient_mean = np.asarray(patient_img.dataobj, dtype=np.float32)
+
+    if patient_mean.shape != baseline_mean.shape or not np.allclose(patient_img.affine, baseline_affine):
+        resampled = resample_img(
+            nib.Nifti1Image(patient_mean, patient_img.affine),
+            target_affine=baseline_affine,
+            target_shape=baseline_mean.shape,
+            interpolation="continuous",
+            fill_value=0,
+        )
+        patient_mean = np.asarray(resampled.dataobj, dtype=np.float32)
+
+    z_data = (patient_mean - baseline_mean) / np.maximum(baseline_std, STD_FLOOR)
+    z_data = z_data.astype(np.float32)
+    heatmap_data = np.where(np.abs(z_data) > HEATMAP_THRESHOLD, z_data, 0).astype(np.float32)
+
+    log_event("zscore_computed", min=round(float(z_data.min()), 3), max=round(float(z_data.max()), 3))
+    return nib.Nifti1Image(z_data, baseline_affine), nib.Nifti1Image(heatmap_data, baseline_affine)
+
+
+@contextmanager
+def _patient_lock(fmri_id: int):
+    with _baseline_lock:
+        entry = _patient_locks.setdefault(fmri_id, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _baseline_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _patient_locks[fmri_id]
+
+
+def get_patient_zscores(fmri_id: int, nifti_path_getter, store=None):
+    """
+    Names (in the NIfTI store) of the z-map and thresholded heatmap for
+    `fmri_id`, computing them on the first request against the current
+    baseline. `nifti_path_getter()` returns a local path to the scan and is
+    only called on a miss.
+    """
+    store = store or nifti_store
+    # Maps computed against an older baseline are not reused
+    version = baseline_version()
+    z_alias = f"zscore:{fmri_id}:{version}"
+    heatmap_alias = f"heatmap:{fmri_id}:{version}"
+
+    with _patient_lock(fmri_id):
+        z_name = store.lookup(z_alias)
+        heatmap_name = store.lookup(heatmap_alias)
+        if z_name and heatmap_name:
+            return {"z_scores": z_name, "heatmap": heatmap_name}
+
+        z_img, heatmap_img = compute_zscore(nifti_path_getter())
+        return {
+            "z_scores": store.put_image(z_img, ".nii.gz", z_alias),
+            "heatmap": store.put_image(heatmap_img, ".nii.gz", heatmap_alias),
+        }
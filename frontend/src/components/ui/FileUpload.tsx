@@ -18,7 +18,9 @@ export default function FileUpload({ onFileSelect, error: externalError }: FileU
     const displayError = externalError || internalError;
 
     const isValidFile = (file: File) => {
-        return file.name.endsWith('.nii') || file.name.endsWith('.nii.gz');
+        const name = file.name.toLowerCase();
+        // A DICOM series is uploaded as a zip of its slice files
+        return ['.nii', '.nii.gz', '.zip', '.dcm'].some((extension) => name.endsWith(extension));
     };
 
     const onDrop = useCallback(
@@ -29,7 +31,7 @@ export default function FileUpload({ onFileSelect, error: externalError }: FileU
                 onFileSelect(acceptedFiles[0]);
             } else {
                 setFiles([]);
-                setInternalError('Only .nii and .nii.gz files are allowed.');
+                setInternalError('Only .nii and .nii.gz files, or a zipped DICOM series, are allowed.');
             }
         },
         [onFileSelect]
@@ -10,15 +10,17 @@ interface HeaderProps {
   showButton: boolean;
   page: "upload" | "history" | "landing" | "results";
   fileName?:string;
+  sessionId?: string;
 }
 
-export default function Header({ redirect, showButton, page, fileName }: HeaderProps) {
+export default function Header({ redirect, showButton, page, fileName, sessionId }: HeaderProps) {
   const { user, signOut } = useAuth();
   const navigate = useNavigate();
   
   const deleteFile = async() => {
     try {
-      const res = await fetch(`${API_URL}/delete-temp-files/`, {
+      const query = sessionId ? `?session_id=${encodeURIComponent(sessionId)}` : "";
+      const res = await fetch(`${API_URL}/delete-temp-files/${query}`, {
         method: "DELETE",
       });
 
@@ -2,8 +2,7 @@ import Plane from "@/assets/plane.png";
 import Filter from "@/assets/filter.png";
 import Search from "@/assets/search.png";
 import useUser from "@/hooks/useUser";
-import React, { useEffect, useState, useRef } from "react";
-import { useMemo } from 'react';
+import React, { useCallback, useEffect, useState, useRef } from "react";
 import { API_URL } from "../constants";
 import { useNavigate } from "react-router-dom";
 
@@ -22,6 +21,11 @@ interface HistoryItem {
   atlas: string;
 }
 
+type HistoryPage = { history: HistoryItem[]; next_cursor: string | null };
+
+// Rows fetched per request; later pages are only fetched when the user pages past the loaded rows
+const FETCH_SIZE = 50;
+
 export default function History() {
   const [data, setData] = useState<HistoryItem[]>([]);
   const [selectedItem, setSelectedItem] = useState<HistoryItem | null>(null);
@@ -33,34 +37,65 @@ export default function History() {
   const navigate = useNavigate();
   const [currentPage, setCurrentPage] = useState(1);
   const [searchQuery, setSearchQuery] = useState("");
+  // Search and sort run on the server, so the search box applies on submit
+  const [appliedSearch, setAppliedSearch] = useState("");
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [loadingMore, setLoadingMore] = useState(false);
   const itemsPerPage = 10;
 
+  const fetchPage = useCallback(async (cursor: string | null): Promise<HistoryPage> => {
+    const params = new URLSearchParams({ limit: String(FETCH_SIZE) });
+    if (cursor) params.set("cursor", cursor);
+    if (appliedSearch.trim()) params.set("search", appliedSearch.trim());
+    if (sortOrder) params.set("sort", sortOrder === "asc" ? "prediction_asc" : "prediction_desc");
+    const res = await fetch(`${API_URL}/user-fmri-history/${user?.id}?${params}`);
+    if (!res.ok) throw new Error("Failed to fetch data from server");
+
+    const json = await res.json();
+    if (!json.history || !Array.isArray(json.history)) {
+      throw new Error("API response is not in the expected format");
+    }
+    return json;
+  }, [user?.id, appliedSearch, sortOrder]);
+
   useEffect(() => {
-    const fetchData = async () => {
-      if (!user?.id) return;
-      try {
-        const res = await fetch(`${API_URL}/user-fmri-history/${user.id}`);
-        if (!res.ok) throw new Error("Failed to fetch data from server");
-        
-        const json = await res.json();
-        console.log("History data:", json);
-        
-        // Ensure we're setting an array to the state
-        if (Array.isArray(json)) {
-          setData(json);
-        } else if (json.history && Array.isArray(json.history)) {
-          setData(json.history);
-        } else {
-          console.error("API response is not in the expected format:", json);
+    let cancelled = false;
+    if (!user?.id) return;
+    fetchPage(null)
+      .then((page) => {
+        if (cancelled) return;
+        setData(page.history);
+        setNextCursor(page.next_cursor);
+        setCurrentPage(1);
+      })
+      .catch((error) => {
+        console.error("Error fetching data", error);
+        if (!cancelled) {
           setData([]);
+          setNextCursor(null);
         }
-      } catch (error) {
-        console.error("Error fetching data", error);
-        setData([]);
-      }
+      });
+    return () => {
+      cancelled = true;
     };
-    fetchData();
-  }, [user?.id]);
+  }, [user?.id, fetchPage]);
+
+  // Appends the next server page; resolves to the number of rows added
+  const loadMore = async () => {
+    if (!nextCursor || loadingMore) return 0;
+    setLoadingMore(true);
+    try {
+      const page = await fetchPage(nextCursor);
+      setData((rows) => [...rows, ...page.history]);
+      setNextCursor(page.next_cursor);
+      return page.history.length;
+    } catch (error) {
+      console.error("Error fetching data", error);
+      return 0;
+    } finally {
+      setLoadingMore(false);
+    }
+  };
 
   const handleView = (item: HistoryItem) => {
     if (item.fmri_id) {
@@ -77,35 +112,8 @@ export default function History() {
     setSelectedItem(null);
   };
 
-  // Filter data based on search query and sort order
-  const filteredData = useMemo(() => {
-    // Ensure data is an array
-    const dataArray = Array.isArray(data) ? data : [];
-    
-    // First filter by search query
-    let filtered = dataArray;
-    if (searchQuery.trim()) {
-      const query = searchQuery.toLowerCase();
-      filtered = dataArray.filter(item => 
-        item.fmri_id.toString().includes(query) ||
-        (item.title && item.title.toLowerCase().includes(query)) ||
-        (item.diagnosis && item.diagnosis.toLowerCase().includes(query))
-      );
-    }
-    
-    // Then apply sorting
-    if (sortOrder === null) return filtered;
-
-    return [...filtered].sort((a, b) => {
-      if (sortOrder === "asc") {
-        // Sort by model_result: 0 (Healthy) first
-        return a.model_result - b.model_result;
-      } else {
-        // Sort by model_result: 1 (Unhealthy) first
-        return b.model_result - a.model_result;
-      }
-    });
-  }, [data, searchQuery, sortOrder]);
+  // Rows arrive already searched and sorted by the server
+  const filteredData = Array.isArray(data) ? data : [];
 
   const handleClickOutside = (event: MouseEvent) => {
     if (
@@ -129,12 +137,15 @@ export default function History() {
   const currentItems = Array.isArray(filteredData) ? filteredData.slice(indexOfFirstItem, indexOfLastItem) : [];
   const totalPages = Math.ceil((Array.isArray(filteredData) ? filteredData.length : 0) / itemsPerPage);
 
-  const handlePageChange = (pageNumber: number) => {
+  const handlePageChange = async (pageNumber: number) => {
+    // Paging past the loaded rows fetches the next server page
+    if (pageNumber > totalPages && (await loadMore()) === 0) return;
     setCurrentPage(pageNumber);
   };
 
   const handleSearch = (e: React.FormEvent) => {
     e.preventDefault();
+    setAppliedSearch(searchQuery);
     setCurrentPage(1); // Reset to first page when searching
   };
 
@@ -223,7 +234,7 @@ export default function History() {
         <div className="divide-y divide-gray-200">
           {!Array.isArray(filteredData) || filteredData.length === 0 ? (
             <div className="py-12 text-center text-gray-500">
-              {searchQuery ? "No results found. Try a different search term." : "No history available yet. Upload an fMRI scan to get started!"}
+              {appliedSearch ? "No results found. Try a different search term." : "No history available yet. Upload an fMRI scan to get started!"}
             </div>
           ) : (
             currentItems.map((item) => (
@@ -297,7 +308,7 @@ export default function History() {
 
               <button
                 onClick={() => handlePageChange(currentPage + 1)}
-                disabled={currentPage === totalPages}
+                disabled={(currentPage === totalPages && !nextCursor) || loadingMore}
                 className="px-3 py-1 rounded border bg-white disabled:opacity-50 disabled:cursor-not-allowed"
               >
                 Next
@@ -41,6 +41,7 @@ const ResultsPage: React.FC = () => {
   const [sliceIndex, setSliceIndex] = useState<number>(50);
   const [fileUrl, setFileUrl] = useState<string>("");
   const [fileName, setFileName] = useState<string>("");
+  const [viewerSessionId, setViewerSessionId] = useState<string>("");
   const [overlayUrl, setOverlayUrl] = useState<string>("");
   const [displaySliceIndex, setDisplaySliceIndex] = useState<number>(50);
   const [maxSliceIndex, setMaxSliceIndex] = useState<number>(100);
@@ -52,7 +53,8 @@ const ResultsPage: React.FC = () => {
 
   const deleteNiftiTemp = async () => {
     try {
-      const res = await fetch(`${API_URL}/delete-temp-files/`, {
+      const query = viewerSessionId ? `?session_id=${encodeURIComponent(viewerSessionId)}` : "";
+      const res = await fetch(`${API_URL}/delete-temp-files/${query}`, {
         method: "DELETE",
       });
 
@@ -110,6 +112,7 @@ const ResultsPage: React.FC = () => {
 
     setFileUrl(`${API_URL}${data.url}`);
     setFileName(data.filename)
+    setViewerSessionId(data.session_id)
     setOverlayUrl(`${API_URL}${data.overlay}`);
   };
 
@@ -213,6 +216,7 @@ const ResultsPage: React.FC = () => {
         showButton={true}
         page="results"
         fileName={fileName}
+        sessionId={viewerSessionId}
       />
       <div className="p-6 overflow-y-auto">
         <div className="mb-6">
@@ -8,6 +8,112 @@ import { API_URL } from "@/components/constants";
 import { useToast } from "@/components/ui/toast";
 import { BeatLoader } from "react-spinners";
 
+type UploadJob = {
+  status: string;
+  stage: string | null;
+  progress: number;
+  result: { fmri_id: number } | null;
+  error: string | null;
+};
+
+// Follow the server-sent progress events of a background upload job until it finishes
+const waitForJob = (jobId: string, onProgress: (job: UploadJob) => void) =>
+  new Promise<UploadJob>((resolve, reject) => {
+    const source = new EventSource(`${API_URL}/jobs/${jobId}/events`);
+    source.addEventListener("progress", (event) => {
+      onProgress(JSON.parse((event as MessageEvent).data));
+    });
+    source.addEventListener("done", (event) => {
+      source.close();
+      const job: UploadJob = JSON.parse((event as MessageEvent).data);
+      if (job.status === "succeeded") {
+        resolve(job);
+      } else {
+        reject(new Error(job.error || "Processing failed"));
+      }
+    });
+    source.onerror = () => {
+      source.close();
+      reject(new Error("Lost connection while processing the scan"));
+    };
+  });
+
+type UploadSession = {
+  upload_id: string;
+  part_size: number;
+  parts: number;
+  missing_parts: number[];
+};
+
+const PARALLEL_PARTS = 4;
+const PART_RETRIES = 3;
+
+const jsonOrThrow = async (response: Response) => {
+  if (!response.ok) {
+    const errorText = await response.text();
+    console.error(`Upload failed: ${response.status} ${response.statusText}`, errorText);
+    throw new Error(`Upload failed: ${response.statusText || 'Server error'}`);
+  }
+  return response.json();
+};
+
+// Upload a file as a resumable session: parts go up in parallel and are retried,
+// and an interrupted upload of the same file picks up from the parts the server is missing
+const uploadInParts = async (
+  file: File,
+  fields: Record<string, string>,
+  onProgress: (fraction: number) => void,
+) => {
+  const resumeKey = `upload:${file.name}:${file.size}:${file.lastModified}`;
+  let session: UploadSession | null = null;
+  const previousId = localStorage.getItem(resumeKey);
+  if (previousId) {
+    const response = await fetch(`${API_URL}/uploads/${previousId}`);
+    session = response.ok ? await response.json() : null;
+  }
+  if (!session) {
+    session = await jsonOrThrow(await fetch(`${API_URL}/uploads`, {
+      method: "POST",
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({
+        ...fields,
+        filename: file.name,
+        content_type: file.type || "application/octet-stream",
+        size: file.size,
+      }),
+    }));
+    localStorage.setItem(resumeKey, session!.upload_id);
+  }
+  const { upload_id, part_size, parts } = session!;
+  const queue = [...session!.missing_parts];
+  let done = parts - queue.length;
+  onProgress(done / parts);
+
+  const sendPart = async (part: number) => {
+    for (let attempt = 0; ; attempt++) {
+      try {
+        const body = file.slice(part * part_size, (part + 1) * part_size);
+        await jsonOrThrow(await fetch(`${API_URL}/uploads/${upload_id}/parts/${part}`, { method: "PUT", body }));
+        return;
+      } catch (err) {
+        if (attempt >= PART_RETRIES) throw err;
+        await new Promise((resolve) => setTimeout(resolve, 1000 * 2 ** attempt));
+      }
+    }
+  };
+  const worker = async () => {
+    for (let part = queue.shift(); part !== undefined; part = queue.shift()) {
+      await sendPart(part);
+      onProgress(++done / parts);
+    }
+  };
+  await Promise.all(Array.from({ length: PARALLEL_PARTS }, worker));
+
+  const result = await jsonOrThrow(await fetch(`${API_URL}/uploads/${upload_id}/complete`, { method: "POST" }));
+  localStorage.removeItem(resumeKey);
+  return result;
+};
+
 export default function Upload() {
   const navigate = useNavigate();
   const { user, loading: userLoading, error: userError } = useUser();
@@ -94,67 +200,29 @@ export default function Upload() {
     }
 
     setSubmitting(true);
-    setUploadProgress(10);
-    
-    const formData = new FormData();
-    formData.append("user_id", user.id);
-    formData.append("title", title);
-    formData.append("description", description);
-    formData.append("gender", gender);
-    formData.append("age", age);
-    formData.append("diagnosis", diagnosis);
-    formData.append("atlas", atlas);
-    formData.append("file", file as File);
+    setUploadProgress(0);
 
     try {
-      // Get access token from localStorage
-      const accessToken = localStorage.getItem('access_token');
-      
-      // Simulate upload progress
-      const progressInterval = setInterval(() => {
-        setUploadProgress(prev => {
-          if (prev >= 90) {
-            clearInterval(progressInterval);
-            return 90;
-          }
-          return prev + 10;
-        });
-      }, 500);
-
-      const response = await fetch(`${API_URL}/upload`, {
-        method: "POST",
-        headers: {
-          'Accept': 'application/json',
-          ...(accessToken ? { 'Authorization': `Bearer ${accessToken}` } : {})
-        },
-        body: formData,
-        credentials: 'include',
-        mode: 'cors'
-      });
-
-      clearInterval(progressInterval);
-      setUploadProgress(100);
-
-      if (!response.ok) {
-        const errorText = await response.text();
-        console.error(`Upload failed: ${response.status} ${response.statusText}`, errorText);
-        throw new Error(`Upload failed: ${response.statusText || 'Server error'}`);
-      }
-
-      const result = await response.json();
+      const result = await uploadInParts(
+        file as File,
+        { user_id: user.id, title, description, gender, age, diagnosis, atlas },
+        (fraction) => setUploadProgress(Math.round(fraction * 100)),
+      );
       console.log("Upload response:", result);
 
       toast({
         variant: "success",
         title: "Upload Successful",
-        description: "Your brain scan has been uploaded successfully!",
+        description: "Your brain scan has been uploaded and is being analysed.",
+      });
+
+      const job = await waitForJob(result.job_id, (progress) => {
+        console.log("Upload job progress:", progress.stage);
       });
 
       // Navigate to results page with the fMRI ID
-      if (result.fmri_id) {
-        setTimeout(() => {
-          navigate(`/results/${result.fmri_id}`);
-        }, 1000); // Give time for the user to see the success message
+      if (job.result?.fmri_id) {
+        navigate(`/results/${job.result.fmri_id}`);
       } else {
         throw new Error("No fMRI ID received from server");
       }